@@ -0,0 +1,10 @@
+"""
+Benchmarks for the Sofa request pipeline. Run `python -m benchmarks.run` from
+the repository root (see benchmarks/run.py for options).
+
+The suite was added together with two fixes to child collections in sofa
+itself (getapiattr accepting resource instances, and child collections being
+limited to their parent's children), so the child_list and child_read
+scenarios can't be compared with revisions from before the suite existed:
+those listed every child rather than the parent's.
+"""
@@ -0,0 +1,456 @@
+"""
+Checks the behavior of Sofa features that the timed scenarios don't exercise,
+by sending requests through the benchmark app (see benchmarks/run.py) and
+asserting on the responses.
+
+usage: python -m benchmarks.checks
+
+Prints one line per check and exits with a non-zero status if any failed.
+"""
+
+import os
+import sys
+import uuid
+import urllib
+import shutil
+import tempfile
+import traceback
+
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import Column, Integer, DateTime, create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from pyramid.config import Configurator
+from webob import Request
+
+import sofa
+
+from sofa import config, readonly, limits, instrumentation
+from sofa.parser import get_rate_limits
+from sofa.responses import ResourceException
+from sofa.exceptions import ConfigurationException
+from sofa.search import SQLiteSearchBackend, create_search_indexes
+from sofa.structure import APISession, APICollection
+
+from benchmarks import models
+from benchmarks.run import build_app, reset_database
+
+CHECKS = []
+
+
+class CheckSession(models.Base, APISession):
+    __tablename__ = 'check_sessions'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+def check(func):
+    """ Registers `func(app)` as a check """
+    CHECKS.append(func)
+    return func
+
+def get(app, path, **kwargs):
+    return Request.blank(path, **kwargs).get_response(app)
+
+def expect_status(response, status, path):
+    assert response.status_int == status, '%s returned %s: %s' % (path, response.status,
+                                                                 response.body[:200])
+
+@contextmanager
+def swapped_auth(class_name, key, auth, auth_sql=False):
+    """ Temporarily replaces the auth function of an attribute """
+    attr = next(attr for attr in config.api_config()[class_name]['attrs'] if attr.key == key)
+    original = attr.auth, attr.auth_sql
+    attr.auth, attr.auth_sql = auth, auth_sql
+    try:
+        yield attr
+    finally:
+        attr.auth, attr.auth_sql = original
+
+
+@check
+def reader_formats(app):
+    """ The built-in readers format values as they did with strftime() """
+    values = [datetime(2020, 1, 2, 3, 4, 5, 678901), date(2020, 1, 2), datetime(1850, 6, 7), None]
+    for reader, expected in (
+            (sofa.datetime_reader, ['2020-01-02T03:04:05Z', '2020-01-02T00:00:00Z',
+                                    '1850-06-07T00:00:00Z', None]),
+            (sofa.date_reader, ['2020-01-02', '2020-01-02', '1850-06-07', None])):
+        assert [ reader(value) for value in values ] == expected, [ reader(value) for value in values ]
+        assert reader.batch(values) == expected, reader.batch(values)
+
+@check
+def config_lambda_names(app):
+    """ Lambdas in api.yaml can use the names they could when evaluated in the parser """
+    from sofa.parser import get_handler_func
+    from sofa.tools import eval_with_deps
+    names = 'lambda: (ResourceException, get_resource, APIAttribute, APIValidator, ' \
+            'ConfigurationException, InstrumentedAttribute)'
+    for func in (get_handler_func(models.Author, names), eval_with_deps(names)):
+        assert func()[0] is ResourceException, func()
+        assert func()[1]('Author') is models.Author, func()
+
+@check
+def reserved_params(app):
+    """ Dynamic attributes can't take a param that list requests read themselves """
+    from sofa.parser import get_resource_info
+    assert '- factor\n' in models.API_CONFIG
+    fd, path = tempfile.mkstemp(suffix='.yaml')
+    with os.fdopen(fd, 'w') as f:
+        f.write(models.API_CONFIG.replace('- factor\n', '- format\n'))
+    try:
+        get_resource_info(path)
+    except ConfigurationException, e:
+        assert 'format' in str(e), e
+    else:
+        raise AssertionError('A dynamic param named format was accepted')
+    finally:
+        os.remove(path)
+
+@check
+def procedural_attr_auth(app):
+    """ Auth functions that take a target are called with each resource """
+    authors = models.DBSession.query(models.Author).order_by(models.Author.id).all()
+    for book in authors[0].books:
+        models.DBSession.delete(book)
+    models.DBSession.commit()
+    with swapped_auth('Author', 'bio', lambda ctx, target: len(target.books) > 0):
+        response = get(app, '/authors')
+        expect_status(response, 200, '/authors')
+        shown = [ 'bio' in row for row in response.json_body ]
+        assert shown == [False] + [True] * (len(authors) - 1), shown
+        for author, expected in ((authors[0], False), (authors[1], True)):
+            path = '/authors/%d' % author.id
+            response = get(app, path)
+            expect_status(response, 200, path)
+            assert ('bio' in response.json_body) is expected, response.json_body
+
+@check
+def sql_attr_auth(app):
+    """ Auth functions declared with auth_sql are evaluated by the database """
+    with swapped_auth('Author', 'bio', lambda ctx, target: target.rating > 5, auth_sql=True):
+        response = get(app, '/authors')
+        expect_status(response, 200, '/authors')
+        for row in response.json_body:
+            assert ('bio' in row) == (row['rating'] > 5), row
+
+@check
+def sql_attr_auth_single_pass(app):
+    """ SQL auth conditions are selected with the resources, not in a query of their own """
+    engine = models.DBSession.get_bind()
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    # An auth function called with each resource makes lists load the resources
+    with swapped_auth('Author', 'bio', lambda ctx, target: target.rating > 5, auth_sql=True), \
+         swapped_auth('Author', 'city', lambda ctx, target: target.id % 2 == 0):
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            list_response = get(app, '/authors')
+            read_responses = [ get(app, '/authors/%d' % i) for i in (1, 9) ]
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+    expect_status(list_response, 200, '/authors')
+    for row in list_response.json_body:
+        assert ('bio' in row) == (row['rating'] > 5), row
+        assert ('city' in row) == (row['id'] % 2 == 0), row
+    for response in read_responses:
+        expect_status(response, 200, '/authors/<id>')
+        row = response.json_body
+        assert ('bio' in row) == (row['rating'] > 5), row
+    separate = [ statement for statement in statements if 'authors.id IN (' in statement ]
+    assert not separate, separate
+
+@check
+def plain_columns_with_joins(app):
+    """ Lists read from plain columns don't repeat resources when their query joins """
+    original = APICollection.list_query
+    def joined_list_query(self, request):
+        # Stands in for list queries that join a to-many relationship; each
+        # book has two tags
+        query = original(self, request)
+        if query is None or self.resource is not models.Book:
+            return query
+        return query.join(models.BookTag, models.BookTag.book_id == models.Book.id)
+    APICollection.list_query = joined_list_query
+    try:
+        responses = [ get(app, path) for path in ('/books', '/books?format=columns') ]
+    finally:
+        APICollection.list_query = original
+    for response in responses:
+        expect_status(response, 200, '/books')
+    ids = [ row['id'] for row in responses[0].json_body ]
+    assert ids == range(1, 31), ids
+    assert responses[1].json_body['columns']['id'] == ids, responses[1].json_body
+
+@check
+def read_only_touch(app):
+    """ In read-only mode, the deferred session touch is not started read-only """
+    db = models.DBSession
+    last_used = datetime.utcnow() - timedelta(hours=1)
+    db.add(CheckSession(id=7, user_id=1, updated_at=last_used))
+    db.commit()
+    begins = []
+    def record(conn):
+        begins.append(readonly.starts_read_only(conn))
+    engine = db.get_bind()
+    list_config = config.api_config()['Book']['list']
+    original = config.session_lookup_func(), list_config['auth']
+    event.listen(engine, 'begin', record)
+    config.set_session_lookup_func(lambda token: db.query(CheckSession).get(int(token)))
+    config.set_read_only_gets(True)
+    # An auth function that needs the caller, so the session is looked up
+    list_config['auth'] = lambda ctx: ctx.caller_id == 1
+    try:
+        db.remove()
+        response = get(app, '/books', headers={'Authorization': 'Token 7'})
+    finally:
+        event.remove(engine, 'begin', record)
+        config.set_session_lookup_func(original[0])
+        config.set_read_only_gets(False)
+        list_config['auth'] = original[1]
+    expect_status(response, 200, '/books')
+    assert begins == [True, False], begins
+    db.remove()
+    assert db.query(CheckSession).get(7).updated_at > last_used, 'the session was not touched'
+
+@check
+def session_router(app):
+    """ Requests are routed to their tenant's database, or to the default one """
+    directory = tempfile.mkdtemp()
+    shards = {}
+    for name in ('a', 'b'):
+        engine = create_engine('sqlite:///' + os.path.join(directory, name + '.db'))
+        models.Base.metadata.create_all(engine)
+        shards[name] = scoped_session(sessionmaker(bind=engine))
+    shards['b'].add(models.Author(name='Author b', genre=models.GENRES[0], rating=1))
+    shards['b'].commit()
+    def router(ctx):
+        tenant = ctx.request.headers.get('X-Tenant')
+        if tenant == 'forbidden':
+            raise ResourceException(403, 'unknown_tenant', 'No such tenant.')
+        if tenant == 'broken':
+            raise RuntimeError('The router failed')
+        return shards.get(tenant)
+    def call(path, tenant=None, **kwargs):
+        response = get(app, path, headers={'X-Tenant': tenant} if tenant else {}, **kwargs)
+        for session in shards.values() + [models.DBSession]:
+            session.commit()
+        return response
+    config.set_session_router(router)
+    try:
+        # Each tenant sees only its own database; others use the default one
+        response = call('/authors')
+        expect_status(response, 200, '/authors')
+        assert len(response.json_body) == 10, response.json_body
+        assert call('/authors', 'a').json_body == []
+        assert [ row['name'] for row in call('/authors', 'b').json_body ] == ['Author b']
+        assert len(call('/authors', 'unknown').json_body) == 10
+
+        # Writes go to the tenant's database
+        response = call('/authors', 'a', method='POST',
+                        POST={'name': 'Author a', 'email': 'a@example.com'})
+        expect_status(response, 201, 'POST /authors')
+        assert [ row['name'] for row in call('/authors', 'a').json_body ] == ['Author a']
+        expect_status(call('/authors/1', 'a'), 200, '/authors/1')
+        assert shards['b'].query(models.Author).count() == 1
+        assert models.DBSession.query(models.Author).count() == 10
+
+        # A router that raises fails the request, without affecting later ones
+        expect_status(call('/authors', 'forbidden'), 403, '/authors')
+        try:
+            call('/authors', 'broken')
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('The router error was swallowed')
+        assert [ row['name'] for row in call('/authors', 'a').json_body ] == ['Author a']
+    finally:
+        config.set_session_router(None)
+        for session in shards.values():
+            session.remove()
+            session.get_bind().dispose()
+        shutil.rmtree(directory)
+
+@check
+def rate_limits(app):
+    """ Rate limits apply per client and action, without looking up sessions """
+    # Also serve the API under a route prefix
+    configurator = Configurator()
+    configurator.include('sofa')
+    configurator.add_route('api', '/api/*traverse', factory=sofa.TraversalRoot,
+                           use_global_views=True)
+    prefixed_app = configurator.make_wsgi_app()
+    lookups = []
+    def lookup(token):
+        lookups.append(token)
+        return None
+    book_config = config.api_config()['Book']
+    original = config.session_lookup_func(), book_config['rate_limit']
+    config.set_session_lookup_func(lookup)
+    book_config['rate_limit'] = get_rate_limits('books', {'list': {'rate': '1/hour', 'burst': 2}})
+    limits.backend().clear()
+    try:
+        for path_app, path in ((app, '/books'), (prefixed_app, '/api/books')):
+            statuses = [ get(path_app, path, remote_addr='10.0.0.1').status_int for i in range(3) ]
+            assert statuses == [200, 200, 429], (path, statuses)
+            limits.backend().clear()
+        for i in range(3):
+            response = get(app, '/books', remote_addr='10.0.0.1')
+        expect_status(response, 429, '/books')
+        assert response.headers.get('Retry-After'), response.headers
+        # Other callers, other actions, and other resources have their own limits
+        expect_status(get(app, '/books', remote_addr='10.0.0.2'), 200, '/books')
+        expect_status(get(app, '/books/1', remote_addr='10.0.0.1'), 200, '/books/1')
+        expect_status(get(app, '/authors', remote_addr='10.0.0.1'), 200, '/authors')
+        # Made-up access tokens don't get around the client's limit, and aren't looked up
+        for i in range(3):
+            headers = {'Authorization': 'Token ' + uuid.uuid4().hex}
+            expect_status(get(app, '/books', remote_addr='10.0.0.1', headers=headers),
+                          429, '/books')
+        headers = {'Authorization': 'Token 1'}
+        expect_status(get(app, '/books', remote_addr='10.0.0.3', headers=headers), 200, '/books')
+        assert lookups == [], lookups
+        # Paths that aren't in the API config aren't limited
+        expect_status(get(prefixed_app, '/api/unknown'), 404, '/api/unknown')
+    finally:
+        config.set_session_lookup_func(original[0])
+        book_config['rate_limit'] = original[1]
+        limits.backend().clear()
+
+@check
+def search_without_terms(app):
+    """ Full-text queries without any words fall back to LIKE instead of failing """
+    engine = models.DBSession.get_bind()
+    title = next(attr for attr in config.api_config()['Book']['attrs'] if attr.key == 'title')
+    title.search = True
+    try:
+        create_search_indexes(engine)
+        response = get(app, '/books?' + urllib.urlencode({'q': 'title:Book 1%'}))
+        expect_status(response, 200, '/books')
+        assert len(response.json_body) == 11, response.json_body
+        for value, count in (('', 0), ('%', 30), ('_', 0), ('%%', 30)):
+            response = get(app, '/books?' + urllib.urlencode({'q': 'title:' + value}))
+            expect_status(response, 200, '/books?q=title:' + value)
+            assert len(response.json_body) == count, (value, response.json_body)
+    finally:
+        title.search = False
+        engine.execute('DROP TABLE IF EXISTS %s' % SQLiteSearchBackend.fts_table_name(title))
+
+@check
+def config_pinned_per_request(app):
+    """ A config reload during a request doesn't affect that request """
+    started_with = config.current_config()
+    seen = []
+    def reload_midway(ctx):
+        # Stand in for a reload landing while the request is being handled
+        config._config = config.APIConfig()
+        seen.append(ctx.request.sofa_config is config.current_config())
+        return True
+    list_config = started_with.api['Book']['list']
+    original = list_config['auth']
+    list_config['auth'] = reload_midway
+    try:
+        response = get(app, '/books')
+    finally:
+        config._config = started_with
+        list_config['auth'] = original
+    expect_status(response, 200, '/books')
+    assert seen and all(seen), seen
+    assert len(response.json_body) == 30, response.json_body
+
+@check
+def exclusive_timing(app):
+    """ Time spent in a phase nested in another one is only counted once """
+    timers = []
+    original = config.request_timing(), config.server_timing_header(), config.timing_callback()
+    config.set_request_timing(True, callback=lambda request, timer: timers.append(timer))
+    instrumentation.install_statement_hooks()
+    try:
+        for path in ('/authors', '/authors/1', '/books'):
+            expect_status(get(app, path), 200, path)
+    finally:
+        config.set_request_timing(original[0], server_timing_header=original[1],
+                                  callback=original[2])
+    assert len(timers) == 3, timers
+    for timer in timers:
+        assert timer.phases['sql'] > 0 and timer.phases['render'] > 0, timer
+        assert sum(timer.phases.values()) <= timer.total, timer
+
+@check
+def timing_and_query_counting(app):
+    """ With timing and query counting both on, each statement is timed and counted once """
+    engine = models.DBSession.get_bind()
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    requests = []
+    original = (config.request_timing(), config.server_timing_header(), config.timing_callback(),
+                config.query_counting(), config.query_budget_mode())
+    config.set_request_timing(True, callback=lambda request, timer: requests.append(request))
+    config.set_query_counting(True)
+    instrumentation.install_statement_hooks()
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        expect_status(get(app, '/authors'), 200, '/authors')
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+        config.set_request_timing(original[0], server_timing_header=original[1],
+                                  callback=original[2])
+        config.set_query_counting(original[3], budget_mode=original[4])
+    request, = requests
+    assert request.sofa_query_stats.count == len(statements) > 0, request.sofa_query_stats
+    assert request.sofa_timer.phases['sql'] > 0, request.sofa_timer
+
+@check
+def read_replicas(app):
+    """ Replica reads see committed writes, and writes set the read-your-writes cookie """
+    # A second session on the same database stands in for a replica
+    replica = scoped_session(sessionmaker(bind=models.DBSession.get_bind()))
+    author_config = config.api_config()['Author']
+    config.set_sqla_session(models.DBSession, read_sessions=[replica], read_your_writes=0)
+    try:
+        expect_status(get(app, '/authors/1'), 200, '/authors/1')
+        # The replica session (and its transaction and identity map) ends with the request
+        assert not replica.registry.has(), 'the replica session outlived the request'
+        response = get(app, '/authors/1', method='PATCH', POST={'city': 'Changed'})
+        expect_status(response, 200, 'PATCH /authors/1')
+        models.DBSession.commit()
+        response = get(app, '/authors/1')
+        expect_status(response, 200, '/authors/1')
+        assert response.json_body['city'] == 'Changed', response.json_body
+
+        # Writes to resources that aren't read from replicas still count
+        config.set_sqla_session(models.DBSession, read_sessions=[replica], read_your_writes=5)
+        author_config['replica'] = False
+        response = get(app, '/authors/1', method='PATCH', POST={'city': 'Again'})
+        expect_status(response, 200, 'PATCH /authors/1')
+        models.DBSession.commit()
+        assert 'sofa_primary_until' in response.headers.get('Set-Cookie', ''), response.headers
+    finally:
+        author_config['replica'] = True
+        config.set_sqla_session(models.DBSession)
+        replica.remove()
+
+
+def main(argv=sys.argv):
+    engine, app = build_app()
+    failures = 0
+    for func in CHECKS:
+        reset_database(engine, 10)
+        try:
+            func(app)
+        except Exception:
+            failures += 1
+            print('FAIL %s' % func.__name__)
+            traceback.print_exc()
+        else:
+            print('ok   %s' % func.__name__)
+        finally:
+            models.DBSession.remove()
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
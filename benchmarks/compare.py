@@ -0,0 +1,45 @@
+"""
+Compares two benchmark result files (see benchmarks/run.py) and reports the
+change in mean latency for each scenario and size.
+
+usage: python -m benchmarks.compare <baseline.json> <candidate.json> [--threshold 10]
+
+Exits with status 1 if any scenario is slower than the baseline by more than
+the threshold (a percentage).
+"""
+
+import sys
+import json
+import argparse
+
+
+def load(path):
+    with open(path) as f:
+        return {(r['scenario'], r['size']): r for r in json.load(f)['results']}
+
+def compare(baseline, candidate, threshold):
+    regressions = []
+    for key in sorted(set(baseline) & set(candidate)):
+        before = baseline[key]['mean_ms']
+        after = candidate[key]['mean_ms']
+        change = (after - before) / before * 100 if before else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        print('%-20s size=%-6d %9.3fms -> %9.3fms (%+6.1f%%)%s'
+              % (key[0], key[1], before, after, change, flag))
+    return regressions
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percentage slowdown reported as a regression (default: 10)')
+    args = parser.parse_args(argv[1:])
+    regressions = compare(load(args.baseline), load(args.candidate), args.threshold)
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
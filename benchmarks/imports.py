@@ -0,0 +1,77 @@
+"""
+Measures how long it takes a fresh interpreter to import Sofa, and checks that
+heavy optional dependencies are not imported until they are used.
+
+usage: python -m benchmarks.imports [--repeat 10] [--output results.json]
+
+Each scenario runs in its own subprocess, since imports are cached for the
+rest of a process's life. Results use the same format as benchmarks.run, so
+two runs can be compared with benchmarks.compare.
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+from benchmarks.run import summarize, run_meta
+
+# Scenario name -> statement to time
+SCENARIOS = [
+    ('import_sofa', 'import sofa'),
+    ('import_resource', 'from sofa import APIResource'),
+    ('import_js_cli', 'import sofa.scripts.js'),
+]
+
+# Modules that should only be imported when a feature that needs them is used
+LAZY_MODULES = ['requests', 'transaction', 'validate_email', 'DNS', 'yaml']
+
+TIMER = """
+import sys, json, timeit
+started = timeit.default_timer()
+%s
+seconds = timeit.default_timer() - started
+print(json.dumps({'seconds': seconds,
+                  'modules': [ name for name in %r if name in sys.modules ]}))
+"""
+
+def time_import(statement):
+    """ Returns (seconds, lazy modules imported) for `statement` in a new interpreter """
+    output = subprocess.check_output([sys.executable, '-c', TIMER % (statement, LAZY_MODULES)])
+    result = json.loads(output.strip().splitlines()[-1])
+    return result['seconds'], result['modules']
+
+def run(repeat):
+    results = []
+    eager_modules = set()
+    for name, statement in SCENARIOS:
+        durations = []
+        for i in range(repeat):
+            seconds, modules = time_import(statement)
+            durations.append(seconds)
+            eager_modules.update(modules)
+        results.append(summarize(name, 0, durations))
+        sys.stderr.write('%-20s mean=%8.3fms\n' % (name, results[-1]['mean_ms']))
+    if eager_modules:
+        sys.stderr.write('Imported eagerly: %s\n' % ', '.join(sorted(eager_modules)))
+    meta = run_meta([0], repeat)
+    meta['eager_modules'] = sorted(eager_modules)
+    return {'meta': meta, 'results': results}
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Benchmark importing Sofa')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='interpreters to start per scenario (default: 10)')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(argv[1:])
+    results = run(args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    # Fail (e.g. in CI) if a lazily-imported dependency became eager again
+    sys.exit(1 if results['meta']['eager_modules'] else 0)
+
+if __name__ == '__main__':
+    main()
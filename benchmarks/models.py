@@ -0,0 +1,211 @@
+"""
+Synthetic models used by the benchmarks: authors with many attributes (one of
+them dynamic), a one-to-many `books` child collection, and a many-to-many
+`tags` child collection on books.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    Text,
+    Boolean,
+    DateTime,
+    Float,
+    ForeignKey,
+    )
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.hybrid import hybrid_method
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship
+
+from sofa import APIResource
+
+DBSession = scoped_session(sessionmaker())
+Base = declarative_base()
+
+GENRES = ['fiction', 'history', 'poetry', 'science', 'travel']
+
+
+class Author(Base, APIResource):
+    __tablename__ = 'authors'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(40), nullable=False)
+    email = Column(String(255))
+    genre = Column(String(20))
+    rating = Column(Integer, default=0)
+    score = Column(Float, default=0.0)
+    born = Column(DateTime)
+    last_seen = Column(DateTime)
+    city = Column(String(40))
+    zip_code = Column(String(5))
+    active = Column(Boolean, default=True)
+    bio = Column(Text)
+
+    books = relationship('Book', backref='author')
+
+    def __init__(self, name, email=None, genre='fiction', rating=0, born=None,
+                 city=None, zip_code=None, bio=None):
+        self.name = name
+        self.email = email
+        self.genre = genre
+        self.rating = int(rating)
+        self.born = datetime.strptime(born, '%Y-%m-%d') if born else None
+        self.city = city
+        self.zip_code = zip_code
+        self.bio = bio
+        self.last_seen = datetime.utcnow()
+
+    @hybrid_method
+    def weighted_rating(self, factor):
+        return self.rating * int(factor)
+
+
+class Book(Base, APIResource):
+    __tablename__ = 'books'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    author_id = Column(Integer, ForeignKey('authors.id'), nullable=False)
+    title = Column(String(80), nullable=False)
+    pages = Column(Integer)
+    published = Column(DateTime)
+
+    def __init__(self, author_id, title, pages=None):
+        self.author_id = int(author_id)
+        self.title = title
+        self.pages = int(pages) if pages is not None else None
+
+
+class Tag(Base, APIResource):
+    __tablename__ = 'tags'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(20), nullable=False)
+
+
+class BookTag(Base, APIResource):
+    __tablename__ = 'book_tags'
+
+    book_id = Column(Integer, ForeignKey('books.id'), primary_key=True)
+    tag_id = Column(Integer, ForeignKey('tags.id'), primary_key=True)
+
+
+API_CONFIG = """
+resource_modules:
+    - benchmarks.models
+
+resources:
+    authors:
+        class: Author
+        auth: |
+            lambda ctx: True
+        attrs:
+            - id:
+                mutable: false
+            - name:
+                type: String(min_len=1, max_len=40)
+            - email:
+                type: Email(nullable=True)
+                auth: |
+                    lambda ctx: ctx.http_method == 'GET'
+            - genre:
+                type: String(valid_values=%(genres)r)
+            - rating:
+                type: Integer(min=0, max=100)
+            - score:
+                type: Float
+            - born:
+                type: Date(nullable=True)
+            - last_seen:
+                type: Datetime(nullable=True)
+                mutable: false
+            - city
+            - zip_code:
+                type: ZipCode(nullable=True)
+            - active:
+                type: Boolean
+            - bio:
+                auth: |
+                    lambda ctx, target: target.active is not False
+            - weighted_rating:
+                dynamic: true
+                mutable: false
+                params:
+                    - factor
+        children:
+            - books:
+                references: Book
+        list:
+        create:
+            required_fields:
+                - name
+            optional_fields:
+                - email
+                - genre
+                - rating
+                - born
+                - city
+                - zip_code
+                - bio
+        read:
+        update:
+        delete:
+
+    books:
+        class: Book
+        attrs:
+            - id:
+                mutable: false
+            - author_id:
+                mutable: false
+            - title
+            - pages:
+                type: Integer(min=1, nullable=True)
+            - published:
+                type: Date(nullable=True)
+        children:
+            - tags:
+                references: Tag
+                secondary: BookTag
+        list:
+        read:
+
+    tags:
+        class: Tag
+        attrs:
+            - id
+            - name
+        list:
+        read:
+""" % {'genres': GENRES}
+
+
+def seed(size, books_per_author=3, tags=20, tags_per_book=2):
+    """ Fills the (empty) database with `size` authors and their books and tags """
+    session = DBSession()
+    session.add_all([ Tag(id=i + 1, name='tag%d' % i) for i in range(tags) ])
+    for i in range(size):
+        author = Author(name='Author %d' % i,
+                        email='author%d@example.com' % i,
+                        genre=GENRES[i % len(GENRES)],
+                        rating=i % 101,
+                        born='19%02d-01-01' % (i % 100),
+                        city='City %d' % (i % 50),
+                        zip_code='%05d' % (i % 100000),
+                        bio='Author %d has written %d books.' % (i, books_per_author))
+        author.score = i / 7.0
+        session.add(author)
+    session.flush()
+    book_id = 0
+    for author_id in range(1, size + 1):
+        for j in range(books_per_author):
+            book_id += 1
+            book = Book(author_id=author_id, title='Book %d' % book_id, pages=100 + j)
+            book.published = datetime(2000 + j, 1, 1)
+            session.add(book)
+            session.flush()
+            for k in range(tags_per_book):
+                session.add(BookTag(book_id=book_id, tag_id=(book_id + k) % tags + 1))
+    session.commit()
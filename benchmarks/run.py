@@ -0,0 +1,166 @@
+"""
+Runs the request pipeline benchmarks against an in-memory SQLite database and
+prints the results as JSON.
+
+usage: python -m benchmarks.run [--sizes 100,1000] [--repeat 20] [--output results.json]
+
+Each scenario sends real requests through a Pyramid app configured with
+`config.include('sofa')`, so traversal, auth, SQL, readers, and JSON rendering
+are all included in the timings. For list scenarios, `per_item_us` is the mean
+time divided by the number of items returned.
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import tempfile
+import argparse
+import subprocess
+
+from urllib import urlencode
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from pyramid.config import Configurator
+from webob import Request
+
+import sofa
+
+from benchmarks import models
+
+
+def build_app():
+    engine = create_engine('sqlite://', poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+    models.DBSession.configure(bind=engine)
+    models.Base.metadata.bind = engine
+    fd, path = tempfile.mkstemp(suffix='.yaml')
+    with os.fdopen(fd, 'w') as f:
+        f.write(models.API_CONFIG)
+    try:
+        sofa.configure(sqla_session=models.DBSession, api_config_path=path)
+    finally:
+        os.remove(path)
+    config = Configurator(root_factory=sofa.TraversalRoot)
+    config.include('sofa')
+    return engine, config.make_wsgi_app()
+
+def reset_database(engine, size):
+    models.DBSession.remove()
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    models.seed(size)
+
+def call(app, path, method='GET', data=None):
+    request = Request.blank(path, method=method, POST=data) if data is not None \
+              else Request.blank(path, method=method)
+    response = request.get_response(app)
+    if response.status_int >= 400:
+        raise RuntimeError('%s %s returned %s: %s' % (method, path, response.status,
+                                                     response.body[:200]))
+    if method != 'GET':
+        # Stand in for pyramid_tm, which would commit after each request
+        models.DBSession.commit()
+    return response
+
+def measure(func, repeat):
+    """ Calls func `repeat` times and returns the durations in seconds """
+    durations = []
+    for i in range(repeat):
+        started = timeit.default_timer()
+        func(i)
+        durations.append(timeit.default_timer() - started)
+    return durations
+
+def summarize(name, size, durations, items=None):
+    durations = sorted(durations)
+    mean = sum(durations) / len(durations)
+    result = {'scenario': name,
+              'size': size,
+              'iterations': len(durations),
+              'mean_ms': mean * 1000,
+              'median_ms': durations[len(durations) // 2] * 1000,
+              'p95_ms': durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000,
+              'min_ms': durations[0] * 1000,
+              'requests_per_second': 1 / mean if mean else None}
+    if items:
+        result['items'] = items
+        result['per_item_us'] = mean / items * 1000000
+    return result
+
+def scenarios(app, size):
+    """ Yields (name, func(i), items returned) for each benchmarked request """
+    yield 'list', lambda i: call(app, '/authors'), size
+    yield 'list_dynamic_attr', lambda i: call(app, '/authors?factor=2'), size
+    yield 'list_filtered', lambda i: call(app, '/authors?q=genre=fiction'), \
+          len([ n for n in range(size) if n % len(models.GENRES) == 0 ])
+    yield 'list_like', lambda i: call(app, '/authors?' + urlencode({'q': 'name:Author 1%'})), None
+    yield 'list_sorted', lambda i: call(app, '/authors?sort_by=rating&sort_dir=desc'), size
+    # Books have only plain column attributes, so they're listed without loading resources
+    yield 'list_plain_columns', lambda i: call(app, '/books'), size * 3
+    yield 'read', lambda i: call(app, '/authors/%d' % (i % size + 1)), None
+    yield 'child_list', lambda i: call(app, '/authors/%d/books' % (i % size + 1)), 3
+    yield 'child_read', lambda i: call(app, '/authors/%d/books/%d' % (i % size + 1,
+                                                                   (i % size) * 3 + 1)), None
+    yield 'many_to_many_list', lambda i: call(app, '/books/%d/tags' % (i % (size * 3) + 1)), 2
+    yield 'create', lambda i: call(app, '/authors', 'POST',
+                                   {'name': 'New author %d' % i, 'genre': 'poetry',
+                                    'rating': '50', 'born': '1970-01-01',
+                                    'email': 'new%d@example.com' % i, 'zip_code': '12345'}), None
+    yield 'update', lambda i: call(app, '/authors/%d' % (i % size + 1), 'PATCH',
+                                   {'rating': str(i % 100), 'city': 'Updated %d' % i}), None
+    yield 'delete', lambda i: call(app, '/authors/%d' % (size + i + 1), 'DELETE'), None
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes, repeat):
+    engine, app = build_app()
+    results = []
+    for size in sizes:
+        reset_database(engine, size)
+        for name, func, items in scenarios(app, size):
+            # Warm up (and, for delete, make sure the targets exist: they are
+            # the authors created by the create scenario)
+            if name != 'delete':
+                func(0)
+            durations = measure(func, repeat)
+            results.append(summarize(name, size, durations, items))
+            sys.stderr.write('%-20s size=%-6d mean=%8.3fms\n'
+                             % (name, size, results[-1]['mean_ms']))
+    return {'meta': run_meta(sizes, repeat), 'results': results}
+
+def run_meta(sizes, repeat):
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'sizes': sizes,
+            'repeat': repeat}
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Benchmark the Sofa request pipeline')
+    parser.add_argument('--sizes', default='100,1000',
+                        help='comma-separated numbers of authors to seed (default: 100,1000)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='requests per scenario (default: 20)')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(argv[1:])
+    results = run([ int(size) for size in args.sizes.split(',') ], args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,6 @@ requires = [
     'pyDNS',
     'passlib',
     'pycrypto',
-    'requests',
     'python-slugify',
     'uritemplate',
     'pyyaml',
@@ -24,10 +23,16 @@ setup(name='sofa',
       keywords=['rest', 'api'],
       packages=['sofa', 'sofa.scripts'],
       install_requires=requires,
+      extras_require={
+          'msgpack': ['msgpack'],
+          'cbor': ['cbor2'],
+          },
       entry_points="""\
       [paste.app_factory]
       main = sofa:main
       [console_scripts]
       sofa = sofa.scripts.js:main
+      sofa-indexes = sofa.scripts.indexes:main
+      sofa-sessions = sofa.scripts.sessions:main
       """
      )
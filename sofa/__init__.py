@@ -57,34 +57,133 @@ from responses import (
     ResourceDeleted,
     ResourceException,
     )
+from exceptions import ConfigurationException
 from tree import Root as TraversalRoot
+from search import create_search_indexes
 
 def includeme(config):
+    from pyramid.events import BeforeRender
     from structure import ContextPredicate
     config.add_view_predicate('api_context', ContextPredicate)
-    config.add_view('sofa.views.nopath_view', context=TraversalRoot, renderer='json')
-    config.add_view('sofa.views.updated_view', context=ResourceUpdated, renderer='json')
+    config.add_renderer('sofa', 'sofa.renderers.SofaRenderer')
+    config.add_tween('sofa.instrumentation.instrumentation_tween_factory')
+    config.add_tween('sofa.config.config_tween_factory')
+    config.add_subscriber('sofa.timing.before_render_subscriber', BeforeRender)
+    config.add_view('sofa.views.nopath_view', context=TraversalRoot, renderer='sofa')
+    config.add_view('sofa.views.updated_view', context=ResourceUpdated, renderer='sofa')
     config.add_view('sofa.views.CollectionViews', attr='get', context=APICollection,
-                    renderer='json', request_method='GET', api_context='list')
+                    renderer='sofa', request_method='GET', api_context='list')
     config.add_view('sofa.views.CollectionViews', attr='post', context=APICollection,
-                    renderer='json', request_method='POST', api_context='create')
+                    renderer='sofa', request_method='POST', api_context='create')
     config.add_view('sofa.views.CollectionViews', attr='other_verb', context=APICollection,
-                    renderer='json')
+                    renderer='sofa')
     config.add_view('sofa.views.ResourceViews', attr='get', context=APIResource,
-                    renderer='json', request_method='GET', api_context='read')
+                    renderer='sofa', request_method='GET', api_context='read')
     config.add_view('sofa.views.ResourceViews', attr='put', context=APIResource,
-                    renderer='json', request_method='PATCH', api_context='update')
+                    renderer='sofa', request_method='PATCH', api_context='update')
     config.add_view('sofa.views.ResourceViews', attr='delete', context=APIResource,
-                    renderer='json', request_method='DELETE', api_context='delete')
+                    renderer='sofa', request_method='DELETE', api_context='delete')
     config.add_view('sofa.views.ResourceViews', attr='other_verb', context=APIResource,
-                    renderer='json')
+                    renderer='sofa')
     config.add_view('sofa.views.resource_exception_view', context=ResourceException,
-                    renderer='json')
+                    renderer='sofa')
 
-def configure(sqla_session=None, api_config_path=None, session_lookup_func=None):
+def configure(sqla_session=None, api_config_path=None, session_lookup_func=None,
+              check_indexes=False, record_filter_shapes=False, request_timing=False,
+              server_timing_header=False, timing_callback=None, count_queries=False,
+              query_budget_mode='warn', api_config_snapshot=None, watch_api_config=False,
+              reload_on_sighup=False, json_encoder=None, compress_responses=False,
+              read_sessions=None, replica_selection='round_robin', read_your_writes=5,
+              session_router=None, read_only_gets=False, principal_cache_ttl=None,
+              rate_limit_backend=None):
     if sqla_session:
-        config.set_sqla_session(sqla_session)
+        config.set_sqla_session(sqla_session, read_sessions=read_sessions,
+                                selection=replica_selection, read_your_writes=read_your_writes)
     if api_config_path:
-        config.load_api_config(api_config_path)
+        config.load_api_config(api_config_path, snapshot_path=api_config_snapshot)
     if session_lookup_func:
         config.set_session_lookup_func(session_lookup_func)
+    if principal_cache_ttl:
+        config.set_principal_cache_ttl(principal_cache_ttl)
+    if session_router:
+        config.set_session_router(session_router)
+    if rate_limit_backend:
+        config.set_rate_limit_backend(rate_limit_backend)
+    if watch_api_config:
+        from watcher import watch_api_config as start_watching
+        start_watching()
+    if reload_on_sighup:
+        from watcher import install_reload_signal_handler
+        install_reload_signal_handler()
+    if check_indexes:
+        from indexes import log_missing_indexes
+        log_missing_indexes()
+    if record_filter_shapes:
+        config.set_filter_shape_recording(True)
+    if request_timing or server_timing_header or timing_callback:
+        from instrumentation import install_statement_hooks
+        config.set_request_timing(True, server_timing_header=server_timing_header,
+                                  callback=timing_callback)
+        install_statement_hooks()
+    if count_queries:
+        from instrumentation import install_statement_hooks
+        config.set_query_counting(True, budget_mode=query_budget_mode)
+        install_statement_hooks()
+    if json_encoder:
+        from renderers import find_json_encoder
+        config.set_json_encoder(find_json_encoder(json_encoder))
+    if compress_responses:
+        config.set_response_compression(True)
+    if read_only_gets:
+        config.set_read_only_gets(True)
+
+def preload():
+    """
+    Does all of the work Sofa would otherwise do lazily on the first requests
+    each process serves: resolves resource classes and handler functions,
+    configures SQLAlchemy mappers, and imports lazily-loaded dependencies. Call
+    it after configure() in the master process of a preforking server (e.g.
+    gunicorn with preload_app), so that forked workers share the result
+    instead of each building their own. It then runs gc.collect() so workers
+    don't inherit the garbage. (Sofa runs on Python 2, which has no
+    gc.freeze(), so reference counting and garbage collections in workers
+    still write to some of the shared pages.)
+    """
+    import gc
+    from sqlalchemy.orm import configure_mappers
+    from tools import preload_function
+
+    if not config.api_config():
+        raise ConfigurationException('sofa.preload() must be called after an API config '
+                                     'has been loaded with sofa.configure()')
+    configure_mappers()
+    config.freeze_resource_registry()
+
+    for info in config.api_config().itervalues():
+        preload_function(info['auth'])
+        for action in ('list', 'create', 'read', 'update', 'delete'):
+            if info[action]:
+                preload_function(info[action]['auth'])
+        for child in info['children'].itervalues():
+            if isinstance(child, dict):
+                for handler in ('auth', 'association_handler', 'disassociation_handler'):
+                    preload_function(child[handler])
+        for attr in info['attrs']:
+            preload_function(attr.auth)
+            for func in (attr._reader, attr._writer):
+                if isinstance(func, basestring):
+                    preload_function(func)
+            validators = [attr.validator] + [ p['validator'] for p in attr.dynamic_params ]
+            for validator in validators:
+                for validate in getattr(validator, '_chain', [validator.validate]):
+                    if hasattr(validate, 'resolve'):
+                        # A lambda string, which is otherwise resolved on first use
+                        validate.resolve()
+
+    for module in ('transaction', 'validate_email'):
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+    gc.collect()
@@ -1,45 +1,208 @@
+import os
+import threading
+import collections
+
 import structure
 
 from sqlalchemy.orm import _mapper_registry
+from pyramid.threadlocal import get_current_request
 
 from exceptions import ConfigurationException
 
 import logging
 log = logging.getLogger(__name__)
 
-_api_config = {}
-_root_collections = []
-_collection_class_map = {}
+_frozen_registry = None
 _dbsession = None
+_replicas = None
+_read_your_writes = 5
+_session_router = None
+_read_only_gets = False
+_principal_cache_ttl = 0
+_rate_limit_backend = None
 _session_lookup_func = None
 _session_duration = 86400   # one day
+_filter_shape_recording = False
+_request_timing = False
+_server_timing_header = False
+_timing_callback = None
+_query_counting = False
+_query_budget_mode = 'warn'
+_n_plus_one_threshold = 5
+_json_encoder = None
+_response_compression = False
+_compression_min_size = 1024
+_compression_level = 6
+
+# _config and _dbsession are private and wrapped in getter functions because
+# __init__ might import a module that imports one of those before
+# load_api_config has been called; then, if the module tries to use it, it'll
+# just be using an empty dict, since the import hasn't been updated. This is a
+# better way to make sure nobody tries reading api_config until __init__ has
+# finished and load_api_config has been called
+
+
+class APIConfig(object):
+    """
+    A loaded API config. An APIConfig is built completely before it is
+    published and is never modified afterwards (apart from the cache of
+    resolved lambdas in `functions`), so threads serving requests can read it
+    without locking while load_api_config replaces it with a new one.
+    """
+
+    def __init__(self, path=None, snapshot_path=None, mtime=None, resource_modules=(),
+                 dependencies=None, api=None, namespace=None):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.mtime = mtime
+        self.resource_modules = tuple(resource_modules)
+        self.dependencies = dependencies or {}
+        self.api = api or {}
+        self.collection_class_map = { v['group_name']: k for k, v in self.api.iteritems() }
+        self.root_collections = tuple(v['group_name'] for v in self.api.itervalues()
+                                      if v['root_accessible'])
+        self.attr_maps = { k: { attr.key: attr for attr in v['attrs'] }
+                           for k, v in self.api.iteritems() }
+        # Names available to lambdas in the config (see tools.eval_with_deps)
+        self.namespace = namespace or {}
+        # Maps lambda strings to the functions they evaluate to
+        self.functions = {}
+
+    def __repr__(self):
+        return "<APIConfig(path=%r, resources=%r)>" % (self.path, sorted(self.api.keys()))
+
+_config = APIConfig()
 
-# _api_config, _root_collections, _collection_class_map, and _dbsession are
-# private and wrapped in getter functions because __init__ might import a module
-# that imports one of those before load_api_config has been called; then, if the
-# module tries to use it, it'll just be using an empty dict, since the import
-# hasn't been updated. This is a better way to make sure nobody tries reading
-# api_config until __init__ has finished and load_api_config has been called
+# The config each thread's current request started with (see config_tween_factory)
+_pinned = threading.local()
 
-def load_api_config(api_config_path):
-    global _api_config
+def load_api_config(api_config_path, snapshot_path=None):
+    """
+    Loads the API config at `api_config_path` and makes it the current config.
+    The new config is fully parsed before it replaces the old one, so requests
+    in progress on other threads see either the old or the new config; if
+    parsing fails, the old config stays in place.
+    """
+    global _config
     from parser import get_resource_info
-    _api_config = get_resource_info(api_config_path)
-    for k, v in _api_config['api'].iteritems():
-        _collection_class_map[v['group_name']] = k
-        if v['root_accessible']:
-            _root_collections.append(v['group_name'])
-
-def set_sqla_session(session):
-    global _dbsession
+    from tools import build_namespace
+    mtime = os.path.getmtime(api_config_path)
+    info = get_resource_info(api_config_path, snapshot_path=snapshot_path)
+    _config = APIConfig(path=api_config_path,
+                        snapshot_path=snapshot_path,
+                        mtime=mtime,
+                        resource_modules=info['resource_modules'],
+                        dependencies=info['dependencies'],
+                        api=info['api'],
+                        namespace=build_namespace(info['dependencies']))
+    return _config
+
+def current_config():
+    """
+    Returns the APIConfig in use: while handling a request, the one that was
+    current when the request started, so a reload half-way through doesn't
+    mix two configs; otherwise, the one loaded last
+    """
+    return getattr(_pinned, 'config', None) or _config
+
+def latest_config():
+    """ Returns the APIConfig loaded last, even while handling a request """
+    return _config
+
+def config_tween_factory(handler, registry):
+    """
+    Pyramid tween that pins each request to the API config that was current
+    when it started (also available as request.sofa_config)
+    """
+    def config_tween(request):
+        outer = getattr(_pinned, 'config', None)
+        request.sofa_config = _pinned.config = _config
+        try:
+            return handler(request)
+        finally:
+            _pinned.config = outer
+    return config_tween
+
+def set_sqla_session(session, read_sessions=None, selection='round_robin', read_your_writes=5):
+    """
+    Sets the (primary) session factory. If `read_sessions` lists session
+    factories for read replicas, GET requests are served from them, chosen by
+    `selection` ('round_robin' or 'least_latency'); after a write, the caller's
+    reads use the primary for `read_your_writes` seconds (see sofa.replicas).
+    """
+    global _dbsession, _replicas, _read_your_writes
+    if read_sessions:
+        from replicas import ReplicaSet
+        _replicas = ReplicaSet(read_sessions, selection)
+    else:
+        _replicas = None
     _dbsession = session
+    _read_your_writes = read_your_writes
 
-def sqla_session():
+def sqla_session(request=None, read_only=False):
+    """
+    Returns the session factory for queries made while handling `request`
+    (by default, the current request). If a session router is set, it picks
+    the factory; otherwise read-only queries may be sent to a read replica, if
+    any are configured.
+    """
     if not _dbsession:
         log.warning('A SQLAlchemy session factory has not been configured. '
                     'Please call sofa.configure() and pass the sqla_session '
                     'argument')
-    return _dbsession
+    if request is None and (_session_router is not None or _read_only_gets):
+        request = get_current_request()
+    session = _dbsession
+    if _session_router is not None and request is not None:
+        session = routed_session(request)
+    if session is _dbsession and _replicas is not None and request is not None:
+        from replicas import choose_read_session, note_write
+        if read_only:
+            session = choose_read_session(request, _dbsession, _replicas, _read_your_writes)
+        else:
+            note_write(request, _read_your_writes)
+    if _read_only_gets and session is not None:
+        from readonly import is_read_only, prepare_session
+        if is_read_only(request):
+            prepare_session(request, session)
+    return session
+
+def set_read_only_gets(enabled):
+    """ Sets whether GET requests are handled in read-only mode (see sofa.readonly) """
+    global _read_only_gets
+    _read_only_gets = enabled
+
+def read_only_gets():
+    return _read_only_gets
+
+def set_session_router(func):
+    """
+    Sets a function that picks the session factory (e.g. for the caller's
+    tenant or shard) for each request. It's called once per request with the
+    request's AuthContext (whose `request` gives the URL) and returns a session
+    factory, or None to use the default one.
+    """
+    global _session_router
+    _session_router = func
+
+def session_router():
+    return _session_router
+
+def routed_session(request):
+    """ Returns the session factory the session router picked for `request` """
+    try:
+        return request.sofa_routed_session
+    except AttributeError:
+        # Queries made while routing (e.g. by the session lookup function,
+        # to authenticate the caller) use the default session factory
+        request.sofa_routed_session = _dbsession
+        try:
+            session = _session_router(structure.get_auth_context(request))
+        except Exception:
+            del request.sofa_routed_session
+            raise
+        request.sofa_routed_session = session or _dbsession
+        return request.sofa_routed_session
 
 def set_session_lookup_func(func):
     global _session_lookup_func
@@ -48,6 +211,30 @@ def set_session_lookup_func(func):
 def session_lookup_func():
     return _session_lookup_func
 
+def set_principal_cache_ttl(seconds):
+    """
+    Sets how long the caller an access token belongs to is remembered (see
+    sofa.principals); 0 looks up the session on every request
+    """
+    global _principal_cache_ttl
+    if seconds < 0:
+        raise ValueError('The principal cache TTL must not be negative')
+    _principal_cache_ttl = seconds
+
+def principal_cache_ttl():
+    return _principal_cache_ttl
+
+def set_rate_limit_backend(backend):
+    """
+    Sets the sofa.limits.RateLimitBackend that rate limits are kept in;
+    None keeps them in this process
+    """
+    global _rate_limit_backend
+    _rate_limit_backend = backend
+
+def rate_limit_backend():
+    return _rate_limit_backend
+
 def set_session_duration(time):
     global _session_duration
     _session_duration = time
@@ -55,33 +242,132 @@ def set_session_duration(time):
 def session_duration():
     return _session_duration
 
+def set_filter_shape_recording(enabled):
+    global _filter_shape_recording
+    _filter_shape_recording = enabled
+
+def filter_shape_recording():
+    return _filter_shape_recording
+
+def set_request_timing(enabled, server_timing_header=False, callback=None):
+    """
+    Enables per-request phase timing (see sofa.timing). If
+    `server_timing_header` is set, the breakdown is sent in a Server-Timing
+    response header. `callback`, if given, is called with the request and its
+    RequestTimer after every request.
+    """
+    global _request_timing, _server_timing_header, _timing_callback
+    _request_timing = enabled
+    _server_timing_header = server_timing_header
+    _timing_callback = callback
+
+def request_timing():
+    return _request_timing
+
+def server_timing_header():
+    return _server_timing_header
+
+def timing_callback():
+    return _timing_callback
+
+def set_query_counting(enabled, budget_mode='warn', n_plus_one_threshold=5):
+    """
+    Enables per-request SQL query counting (see sofa.queries). `budget_mode`
+    is 'warn' to log requests that exceed their resource's query_budget or
+    'raise' to raise QueryBudgetExceeded (useful in tests). Statements executed
+    `n_plus_one_threshold` or more times in one request are logged as possible
+    N+1 queries.
+    """
+    global _query_counting, _query_budget_mode, _n_plus_one_threshold
+    if budget_mode not in ('warn', 'raise'):
+        raise ValueError('%r is not a valid query budget mode' % budget_mode)
+    _query_counting = enabled
+    _query_budget_mode = budget_mode
+    _n_plus_one_threshold = n_plus_one_threshold
+
+def query_counting():
+    return _query_counting
+
+def query_budget_mode():
+    return _query_budget_mode
+
+def n_plus_one_threshold():
+    return _n_plus_one_threshold
+
+def set_json_encoder(dumps):
+    """
+    Sets the function used by the 'sofa' renderer to encode JSON (see
+    sofa.renderers.find_json_encoder), or None to use Pyramid's JSON renderer
+    """
+    global _json_encoder
+    _json_encoder = dumps
+
+def json_encoder():
+    return _json_encoder
+
+def set_response_compression(enabled, min_size=1024, level=6):
+    """
+    Enables gzip/deflate compression of responses rendered by the 'sofa'
+    renderer for callers that accept it. Responses smaller than `min_size`
+    bytes are sent uncompressed. `level` is the zlib compression level (1-9).
+    """
+    global _response_compression, _compression_min_size, _compression_level
+    if not 1 <= level <= 9:
+        raise ValueError('%r is not a valid compression level' % level)
+    _response_compression = enabled
+    _compression_min_size = min_size
+    _compression_level = level
+
+def response_compression():
+    return _response_compression
+
+def compression_min_size():
+    return _compression_min_size
+
+def compression_level():
+    return _compression_level
+
 def root_collections():
-    if not _root_collections:
+    root_collections = current_config().root_collections
+    if not root_collections:
         log.warning('No root collections were found. Either you have not '
             'called sofa.configure() with api_config_path or you have no '
             'root-accessible resources defined.')
-    return _root_collections
+    return root_collections
 
 def resource_modules():
-    return _api_config.get('resource_modules', [])
+    return current_config().resource_modules
 
 def dependencies():
-    return _api_config.get('dependencies', {})
+    return current_config().dependencies
 
 def api_config():
-    return _api_config.get('api', {})
+    return current_config().api
 
 def collection_class_map():
-    return _collection_class_map
+    return current_config().collection_class_map
 
 def get_class_name(collection_name):
     """
     Convenience function to look up the APIResource class associated with a
     collection
     """
-    return _collection_class_map[collection_name]
+    return current_config().collection_class_map[collection_name]
+
+def freeze_resource_registry():
+    """
+    Stops looking up resource classes in the SQLAlchemy mapper registry on
+    every call; the classes registered now are used from here on (see
+    sofa.preload)
+    """
+    global _frozen_registry
+    _frozen_registry = None
+    _frozen_registry = collections.OrderedDict((cls.__name__, cls)
+                                               for cls in resource_registry())
 
 def resource_registry():
+    if _frozen_registry is not None:
+        return _frozen_registry.values()
     sqla_classes = [ mapper_weakref().class_
                      for mapper_weakref, state in _mapper_registry.data.iteritems()
                      if state is True ]
@@ -92,6 +378,8 @@ def resource_class_names():
     return [x.__name__ for x in resource_registry()]
 
 def get_resource(resource_name):
+    if _frozen_registry is not None:
+        return _frozen_registry.get(resource_name)
     log.debug('Resolving {} in resource registry'.format(resource_name))
     resource = next((x for x in resource_registry() if x.__name__ == resource_name), None)
     log.debug('Resolved resource: {}'.format(resource))
@@ -104,4 +392,11 @@ def getapiattr(cls, name):
     """
     if isinstance(cls, basestring):
         cls = get_resource(cls)
-    return next(attr for attr in api_config()[cls.__name__]['attrs'] if attr.key == name)
+    elif not isinstance(cls, type):
+        # We were passed a resource instance (e.g. a collection's parent)
+        cls = cls.__class__
+    attrs = current_config().attr_maps[cls.__name__]
+    if name not in attrs:
+        # Raise the same error as searching the list of attrs would
+        raise StopIteration
+    return attrs[name]
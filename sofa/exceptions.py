@@ -7,3 +7,8 @@ class ConfigurationException(SofaException):
 
 	def __init__(self, message):
 		super(ConfigurationException, self).__init__(message)
+
+class QueryBudgetExceeded(SofaException):
+
+	def __init__(self, message):
+		super(QueryBudgetExceeded, self).__init__(message)
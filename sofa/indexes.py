@@ -0,0 +1,182 @@
+"""
+Contains the index advisor, which compares the columns the API can filter,
+sort, join, or check uniqueness on against the indexes that actually exist in
+the database
+"""
+
+import collections
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import ColumnProperty
+
+from config import sqla_session, api_config, get_resource
+from validators import NumericIdValidator, StringIdValidator
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def attr_column(attr):
+    """
+    Returns the Column backing an APIAttribute, or None if the attribute is
+    dynamic or is not a plain column (e.g. a property or a relationship)
+    """
+    if attr.dynamic_params:
+        return None
+    prop = attr.cls.__mapper__.get_property(attr.key) \
+           if attr.cls.__mapper__.has_property(attr.key) else None
+    if not isinstance(prop, ColumnProperty) or len(prop.columns) != 1:
+        return None
+    column = prop.columns[0]
+    return column if hasattr(column, 'table') and column.table is attr.cls.__table__ else None
+
+def indexed_columns(inspector, table_name):
+    """
+    Returns the names of the columns in `table_name` that lead an index, a
+    unique constraint, or the primary key (i.e. the columns that can be looked
+    up without a full scan)
+    """
+    leading = set()
+    primary_key = inspector.get_pk_constraint(table_name).get('constrained_columns') or []
+    if primary_key:
+        leading.add(primary_key[0])
+    for index in inspector.get_indexes(table_name):
+        if index['column_names'] and index['column_names'][0]:
+            leading.add(index['column_names'][0])
+    try:
+        for constraint in inspector.get_unique_constraints(table_name):
+            if constraint['column_names']:
+                leading.add(constraint['column_names'][0])
+    except NotImplementedError:
+        pass
+    return leading
+
+def is_unique_validator(validator):
+    return getattr(validator, 'unique', False) \
+        or isinstance(validator, (NumericIdValidator, StringIdValidator))
+
+def _child_join_columns(resource_class, children):
+    """ Yields the foreign key columns used to join `resource_class` to its child collections """
+    for name, child in children.iteritems():
+        if not isinstance(child, dict):
+            continue
+        joined_tables = [resource_class.__table__]
+        if child['secondary'] is not None:
+            joined_tables.append(child['references'].__table__)
+        for target in (child['references'], child['secondary']):
+            if target is None:
+                continue
+            for fk in target.__table__.foreign_keys:
+                if fk.column.table in joined_tables and fk.column.table is not target.__table__:
+                    yield target, fk.parent, name
+
+def index_usage(resource_info=None):
+    """
+    Maps each (table name, column name) the API may search on to a dict
+    containing the resource class, a list of reasons, and the columns an
+    index for them should cover (starting with that column)
+    """
+    if resource_info is None:
+        resource_info = api_config()
+    usage = collections.OrderedDict()
+    def note(cls, column, reason, columns=None):
+        entry = usage.setdefault((column.table.name, column.name),
+                                 {'class': cls, 'table': column.table.name,
+                                  'column': column.name, 'reasons': [],
+                                  'columns': [column.name]})
+        if reason not in entry['reasons']:
+            entry['reasons'].append(reason)
+        if columns and len(columns) > len(entry['columns']):
+            entry['columns'] = [ c.name for c in columns ]
+    for cls_name, info in resource_info.iteritems():
+        for attr in info['attrs']:
+            column = attr_column(attr)
+            if column is None:
+                continue
+            if attr.readable:
+                note(attr.cls, column, 'filter/sort on %s' % attr.key)
+            if is_unique_validator(attr.validator):
+                note(attr.cls, column, 'unique validator on %s' % attr.key)
+        for target, column, child_name in _child_join_columns(get_resource(cls_name),
+                                                              info['children']):
+            note(target, column, 'join for %s.%s' % (cls_name, child_name))
+    # Purging sessions (see sofa.sessions) looks up expired ones by updated_at
+    # and deleted ones by active and invalidated_at
+    from sessions import session_classes
+    for cls in session_classes():
+        columns = cls.__table__.c
+        if 'updated_at' in columns:
+            note(cls, columns.updated_at, 'expired session purge')
+        note(cls, columns.active, 'deleted session purge',
+             columns=[columns.active, columns.invalidated_at])
+    return usage
+
+def missing_indexes(bind=None, resource_info=None):
+    """
+    Returns a list of dicts describing columns the API queries on that do not
+    lead any index, each with the reasons they are queried and suggested DDL
+    """
+    if bind is None:
+        bind = sqla_session().get_bind()
+    inspector = inspect(bind)
+    existing = {}
+    report = []
+    for (table_name, column_name), entry in index_usage(resource_info).iteritems():
+        if table_name not in existing:
+            existing[table_name] = indexed_columns(inspector, table_name)
+        if column_name in existing[table_name]:
+            continue
+        entry = dict(entry)
+        entry['ddl'] = 'CREATE INDEX ix_{0}_{1} ON {0} ({2});'.format(
+            table_name, '_'.join(entry['columns']), ', '.join(entry['columns']))
+        report.append(entry)
+    return report
+
+def log_missing_indexes(bind=None):
+    """ Startup check: logs a warning for each column lacking an index """
+    report = missing_indexes(bind)
+    for entry in report:
+        log.warning('%s.%s is not indexed (used for %s). Suggested: %s',
+                    entry['table'], entry['column'], ', '.join(entry['reasons']),
+                    entry['ddl'])
+    return report
+
+
+# Runtime filter shape recording. A filter shape is the resource, the
+# (attribute, operator) pairs of a list request's querystring, and its sort_by
+# attribute, e.g. ('Contact', (('name', ':'),), 'created_at').
+
+REPORT_INTERVAL = 1000
+
+_filter_shapes = {}
+_recorded = [0]
+
+def record_filter_shape(shape, seconds):
+    stats = _filter_shapes.setdefault(shape, [0, 0.0])
+    stats[0] += 1
+    stats[1] += seconds
+    _recorded[0] += 1
+    if _recorded[0] % REPORT_INTERVAL == 0:
+        log_filter_shapes()
+
+def filter_shape_report():
+    """
+    Returns the recorded filter shapes as a list of dicts, ordered by total
+    time spent querying (i.e. weighted by latency)
+    """
+    report = [ {'resource': shape[0], 'filters': shape[1], 'sort_by': shape[2],
+                'count': count, 'total_seconds': total, 'mean_seconds': total / count}
+               for shape, (count, total) in _filter_shapes.items() ]
+    return sorted(report, key=lambda entry: entry['total_seconds'], reverse=True)
+
+def log_filter_shapes(limit=20):
+    for entry in filter_shape_report()[:limit]:
+        log.info('Filter shape %s filters=%s sort_by=%s: %d queries, %.3fs total, %.4fs mean',
+                 entry['resource'],
+                 ','.join(k + op for k, op in entry['filters']) or '-',
+                 entry['sort_by'] or '-', entry['count'],
+                 entry['total_seconds'], entry['mean_seconds'])
+
+def reset_filter_shapes():
+    _filter_shapes.clear()
+    _recorded[0] = 0
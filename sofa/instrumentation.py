@@ -0,0 +1,84 @@
+"""
+Contains the hooks shared by request timing (see sofa.timing) and query
+counting (see sofa.queries): one pair of listeners for the SQL statements run
+on every engine, and one tween that sets up each request's RequestTimer and
+QueryStats. Both features hang off that per-request state, so each statement
+looks up the current request once however many of them are enabled.
+"""
+
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from pyramid.threadlocal import get_current_request
+
+from config import request_timing, server_timing_header, timing_callback, query_counting
+from timing import RequestTimer
+from queries import QueryStats, check_query_stats
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    request = get_current_request()
+    if request is None:
+        return
+    timer = getattr(request, 'sofa_timer', None)
+    if timer is not None and not timer.is_running('sql'):
+        timer.start('sql')
+    if getattr(request, 'sofa_query_stats', None) is not None:
+        conn.info.setdefault('sofa_statement_started', []).append(time.time())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    request = get_current_request()
+    if request is None:
+        return
+    timer = getattr(request, 'sofa_timer', None)
+    if timer is not None:
+        timer.stop('sql')
+    started = conn.info.get('sofa_statement_started')
+    if started:
+        stats = getattr(request, 'sofa_query_stats', None)
+        if stats is not None:
+            stats.add(statement, time.time() - started.pop())
+
+_installed = [False]
+
+def install_statement_hooks():
+    """ Listens for SQL statements on every engine so that they can be timed and counted """
+    if not _installed[0]:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _installed[0] = True
+
+
+def instrumentation_tween_factory(handler, registry):
+    """
+    Pyramid tween that times each request and counts its queries, as enabled.
+    Rendering happens inside `handler` (after the view returns), so the render
+    phase runs from the BeforeRender event until `handler` returns, less the
+    phases that run inside it.
+    """
+    def instrumentation_tween(request):
+        timing, counting = request_timing(), query_counting()
+        if not timing and not counting:
+            return handler(request)
+        timer = request.sofa_timer = RequestTimer() if timing else None
+        stats = request.sofa_query_stats = QueryStats() if counting else None
+        response = handler(request)
+        if stats is not None:
+            check_query_stats(request, stats)
+        if timer is not None:
+            timer.finish()
+            if server_timing_header():
+                response.headers['Server-Timing'] = timer.header()
+            callback = timing_callback()
+            if callback:
+                try:
+                    callback(request, timer)
+                except Exception:
+                    log.exception('Request timing callback failed')
+        return response
+    return instrumentation_tween
@@ -0,0 +1,226 @@
+"""
+Contains the rate limiter. Resources can declare a rate_limit in api.yaml:
+token bucket limits (a sustained rate plus a burst) and a cap on the requests
+in flight at once, for the whole resource or per action. Limits apply to each
+caller separately -- identified by their user ID with principal_cache_ttl,
+and otherwise by the client's IP address (and their access token, if any) --
+and to each resource and action separately.
+
+Limits are checked while traversing to the requested resource, before any
+of its queries run, and requests over a limit are rejected with a 429.
+
+By default, buckets and in-flight counts are kept per process (see
+InProcessBackend). To share them between processes, pass an object
+implementing RateLimitBackend to sofa.configure(rate_limit_backend=...).
+"""
+
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from pyramid.traversal import split_path_info
+
+from config import api_config, get_class_name, principal_cache_ttl, rate_limit_backend
+from responses import ResourceException
+
+import logging
+log = logging.getLogger(__name__)
+
+# Most buckets kept at once by InProcessBackend; the least recently used
+# ones are dropped first
+MAX_TRACKED_BUCKETS = 100000
+
+# Maps request methods to the actions they perform on collections and resources
+COLLECTION_ACTIONS = {'GET': 'list', 'HEAD': 'list', 'POST': 'create'}
+RESOURCE_ACTIONS = {'GET': 'read', 'HEAD': 'read', 'PATCH': 'update', 'DELETE': 'delete'}
+
+
+class RateLimitBackend(object):
+    """
+    Stores token buckets and in-flight request counts. Each method must be
+    atomic with respect to other callers using the same key.
+    """
+
+    def take(self, key, rate, burst):
+        """
+        Takes a token from the bucket `key`, which holds up to `burst` tokens
+        and refills at `rate` tokens per second (a new bucket starts full).
+        Returns 0 if a token was taken, or otherwise the number of seconds
+        until one will be available.
+        """
+        raise NotImplementedError
+
+    def acquire(self, key, limit):
+        """
+        Counts a request in flight under `key` if fewer than `limit` are
+        already, and returns whether it did
+        """
+        raise NotImplementedError
+
+    def release(self, key):
+        """ Stops counting a request acquired under `key` """
+        raise NotImplementedError
+
+
+class InProcessBackend(RateLimitBackend):
+    """ Keeps buckets and in-flight counts in memory, for this process only """
+
+    def __init__(self, max_buckets=MAX_TRACKED_BUCKETS):
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()    # Maps keys to (tokens, time updated)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def acquire(self, key, limit):
+        with self.lock:
+            count = self.in_flight.get(key, 0)
+            if count >= limit:
+                return False
+            self.in_flight[key] = count + 1
+        return True
+
+    def release(self, key):
+        with self.lock:
+            count = self.in_flight.pop(key, 0) - 1
+            if count > 0:
+                self.in_flight[key] = count
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+            self.in_flight.clear()
+
+_in_process_backend = InProcessBackend()
+
+
+def backend():
+    """ Returns the configured RateLimitBackend """
+    return rate_limit_backend() or _in_process_backend
+
+def traversal_segments(request, key):
+    """
+    Returns the path segments traversed for `request` from the root
+    collection `key` on, or just (`key`,) if the rest can't be told
+    """
+    matchdict = request.matchdict or {}
+    path = matchdict.get('traverse', request.path_info or '/')
+    segments = tuple(path) if not isinstance(path, basestring) else split_path_info(path)
+    if key not in segments:
+        return (key,)
+    return segments[segments.index(key):]
+
+def resolve_target(request, segments):
+    """
+    Returns the name of the APIResource class that the path `segments`
+    (starting at a root collection) lead to, and the action `request`
+    performs on it, or None if it isn't one of the standard actions.
+    Returns (None, None) if the segments don't lead to a resource. Only the
+    API config is used; nothing is looked up in the database.
+    """
+    try:
+        class_name = get_class_name(segments[0])
+    except KeyError:
+        return None, None
+    is_collection = True
+    for segment in segments[1:]:
+        if is_collection:
+            is_collection = False
+            continue
+        child = api_config()[class_name]['children'].get(segment)
+        if not isinstance(child, dict):
+            # A direct child resource or another action; count it as a
+            # request to this resource
+            return class_name, None
+        class_name = child['references'].__name__
+        is_collection = True
+    actions = COLLECTION_ACTIONS if is_collection else RESOURCE_ACTIONS
+    return class_name, actions.get(request.method)
+
+def caller_keys(request):
+    """
+    Returns the keys identifying the caller of `request`, each of which is
+    limited: with a principal cache (see sofa.principals), the caller's ID;
+    otherwise a hash of the access token, so no session has to be looked up,
+    and the client's IP address, since an unverified token could be made up
+    to get a fresh bucket; or, for requests without a (well-formed) access
+    token, just the client's IP address
+    """
+    from structure import access_token, get_auth_context
+    ip = 'ip:%s' % request.client_addr
+    if 'Authorization' not in request.headers:
+        return [ip]
+    try:
+        token = access_token(request)
+        principal = get_auth_context(request).principal if principal_cache_ttl() else None
+    except ResourceException:
+        # A bad access token; auth will reject it later, unless the resource
+        # doesn't need one
+        return [ip]
+    if principal is not None:
+        return ['%s:%s' % (principal.caller_type, principal.caller_id)]
+    return ['token:%s' % hashlib.sha1(token.encode('utf-8')).hexdigest(), ip]
+
+def check_rate_limits(request, key):
+    """
+    Applies the rate_limit declared for the resource and action `request`
+    is for, if any, where `key` is the root collection being traversed.
+    Raises a 429 ResourceException if the caller is over it.
+    """
+    class_name, action = resolve_target(request, traversal_segments(request, key))
+    if class_name is None:
+        return
+    limits = api_config()[class_name].get('rate_limit')
+    limit = limits and limits.get(action)
+    if not limit:
+        return
+    buckets = [ '%s:%s:%s' % (caller, class_name, action or '*')
+                for caller in caller_keys(request) ]
+    limiter = backend()
+
+    if limit['concurrency']:
+        acquired = []
+        for bucket in buckets:
+            if not limiter.acquire(bucket, limit['concurrency']):
+                for held in acquired:
+                    limiter.release(held)
+                log.info('Rejected %s %s: %s has too many requests in flight',
+                         request.method, request.path_info, bucket)
+                raise ResourceException(429, 'too_many_concurrent_requests',
+                                        'You have too many requests to this resource in progress. '
+                                        'Please wait for them to finish and try again.')
+            acquired.append(bucket)
+        def release(request):
+            for bucket in acquired:
+                limiter.release(bucket)
+        request.add_finished_callback(release)
+
+    if limit['rate']:
+        for bucket in buckets:
+            wait = limiter.take(bucket, limit['rate'], limit['burst'])
+            if wait:
+                log.info('Rejected %s %s: %s is over its rate limit',
+                         request.method, request.path_info, bucket)
+                retry_after = str(int(wait) + 1)
+                def set_retry_after(request, response):
+                    response.headers['Retry-After'] = retry_after
+                request.add_response_callback(set_retry_after)
+                raise ResourceException(429, 'rate_limited',
+                                        'You have made too many requests to this resource. '
+                                        'Please try again in %s seconds.' % retry_after)
@@ -1,10 +1,11 @@
-import yaml
 import inspect
+import cPickle as pickle
 
 from structure import APIAttribute, APIValidator
 from responses import ResourceException
 from config import get_resource
-from tools import eval_with_deps
+from tools import eval_with_deps, build_namespace
+from snapshot import load_yaml, load_snapshot, save_snapshot, compile_expression
 from exceptions import (
     ConfigurationException,
     )
@@ -16,6 +17,10 @@ from pprint import pformat
 import logging
 log = logging.getLogger(__name__)
 
+# GET parameters that Sofa reads itself on list requests (see
+# views.CollectionViews), so dynamic attributes can't take them as params
+RESERVED_PARAMS = ('format',)
+
 def find_class(name):
     cls = get_resource(name)
     if not cls:
@@ -36,14 +41,9 @@ def get_handler_func(cls, string, dependencies={}):
     elif 'lambda ' in string or 'lambda:' in string:
         try:
             # Eval the lambda to ensure proper syntax
-            func = eval(string)
+            func = eval(compile_expression(string), build_namespace(dependencies))
         except (NameError, SyntaxError, ImportError), e:
             raise ConfigurationException('Could not parse "%s" as a lambda function: %s, %s' % (string, type(e).__name__, e.message))
-        for name, dep in dependencies.iteritems():
-            # TODO: fix this
-            # if name in func.__globals__:
-            #     raise ConfigurationException('Import %r conflicts with global namespace' % name)
-            func.__globals__[name] = dep
         return func
     else:
         # Try parsing the string as a symbol
@@ -127,6 +127,19 @@ def parse_attribute(name, attr_config, resource_class, dependencies, inherit_aut
         raise ConfigurationException('readable directive on %s:%s must be a boolean' \
                         % (key, name))
     readable = attr_config.get('readable', True)
+    # Get full-text search info
+    if not isinstance(attr_config.get('search', False), (bool, basestring)):
+        raise ConfigurationException('search directive on %s:%s must be a boolean or the name '
+                                     'of a text search configuration' % (resource_class.__name__, name))
+    search = attr_config.get('search', False)
+    # Get whether the auth function returns SQL conditions for the class
+    if not isinstance(attr_config.get('auth_sql', False), bool):
+        raise ConfigurationException('auth_sql directive on %s:%s must be a boolean' \
+                        % (resource_class.__name__, name))
+    auth_sql = attr_config.get('auth_sql', False)
+    if auth_sql and 'auth' not in attr_config:
+        raise ConfigurationException('auth_sql directive on %s:%s needs an auth function' \
+                        % (resource_class.__name__, name))
     # Get reader/writer functions
     reader = get_handler_func(resource_class, attr_config.get('reader', 'None'), dependencies=dependencies)
     writer = get_handler_func(resource_class, attr_config.get('writer', 'None'), dependencies=dependencies)
@@ -155,14 +168,23 @@ def parse_attribute(name, attr_config, resource_class, dependencies, inherit_aut
             else:
                 dynamic_params.append({'name': param,
                                        'validator': None})
+    reserved = [ param['name'] for param in dynamic_params if param['name'] in RESERVED_PARAMS ]
+    if reserved:
+        raise ConfigurationException('The dynamic attribute %s:%s cannot take the param %r, '
+                                     'which is reserved for list requests (?%s=)' \
+                                     % (resource_class.__name__, name, reserved[0], reserved[0]))
     if 'params' in attr_config.keys() and 'dynamic' not in attr_config.keys():
         raise ConfigurationException(
             'Params have been declared for the attribute {} in {} '
             'but the attribute is not dynamic!'.format(name, info['class']))
+    if search and 'dynamic' in attr_config.keys():
+        raise ConfigurationException('Dynamic attribute %s:%s cannot be searchable' \
+                        % (resource_class.__name__, name))
     leftover_keys = set(attr_config.keys()) - set(['name', 'validator', 'mutable',
                                                   'readable', 'reader',
                                                   'writer', 'auth', 'type',
-                                                  'params', 'dynamic'])
+                                                  'params', 'dynamic', 'search',
+                                                  'auth_sql'])
     if leftover_keys:
         raise ConfigurationException('The directives %r are unrecognized in attrs context' \
                         % ', '.join(list(leftover_keys)))
@@ -172,9 +194,89 @@ def parse_attribute(name, attr_config, resource_class, dependencies, inherit_aut
                               reader=reader, writable=mutable,
                               writer=writer, auth=attr_auth,
                               dynamic_params=dynamic_params,
+                              search=search, auth_sql=auth_sql,
                               cls=resource_class)
 
 
+RATE_LIMIT_ACTIONS = ('list', 'create', 'read', 'update', 'delete')
+RATE_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600}
+
+def parse_rate(key, rate):
+    """
+    Parses the rate of a rate_limit, a number of requests per second or a
+    string like "100/minute", into a (requests per second, default burst)
+    tuple
+    """
+    count, period = rate, 'second'
+    if isinstance(rate, basestring) and '/' in rate:
+        count, period = [ part.strip() for part in rate.split('/', 1) ]
+        try:
+            count = float(count)
+        except ValueError:
+            count = None
+    if period not in RATE_PERIODS or isinstance(count, bool) \
+       or not isinstance(count, (int, float)) or count <= 0:
+        raise ConfigurationException('The rate_limit rate for %r must be a number of requests '
+                                     'per second or a string like "100/minute"' % key)
+    return float(count) / RATE_PERIODS[period], max(1, int(count))
+
+def get_rate_limits(key, config):
+    """
+    Parses the rate_limit directive of the resource `key` into a dict mapping
+    each action (and None, for other requests) to its limits: the rate in
+    requests per second, the burst size, and the concurrency cap, each None
+    if not limited. Returns None if the resource has no rate_limit.
+    """
+    if config is None:
+        return None
+    if not isinstance(config, dict):
+        raise ConfigurationException('The rate_limit for %r must be a dictionary' % key)
+    unknown_keys = set(config.keys()) - set(('rate', 'burst', 'concurrency') + RATE_LIMIT_ACTIONS)
+    if unknown_keys:
+        raise ConfigurationException('The rate_limit for %r has unknown directives %s' \
+                        % (key, ', '.join(unknown_keys)))
+
+    def parse_limits(directives, defaults):
+        limits = dict(defaults)
+        limits.update(directives)
+        if limits.get('rate') is not None:
+            rate, default_burst = parse_rate(key, limits['rate'])
+        elif limits.get('burst') is not None:
+            raise ConfigurationException('The rate_limit for %r sets a burst without a rate' % key)
+        else:
+            rate = default_burst = None
+        burst = limits.get('burst', default_burst)
+        concurrency = limits.get('concurrency')
+        for name, value in (('burst', burst), ('concurrency', concurrency)):
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int)
+                                      or value < 1):
+                raise ConfigurationException('The rate_limit %s for %r must be a positive '
+                                             'whole number' % (name, key))
+        if rate is None and concurrency is None:
+            return None
+        return {'rate': rate, 'burst': burst, 'concurrency': concurrency}
+
+    defaults = dict((name, value) for name, value in config.iteritems()
+                    if name not in RATE_LIMIT_ACTIONS)
+    rate_limit = {None: parse_limits({}, defaults)}
+    for action in RATE_LIMIT_ACTIONS:
+        directives = config.get(action) or {}
+        if not isinstance(directives, dict):
+            raise ConfigurationException('The rate_limit for %r > %s must be a dictionary' \
+                            % (key, action))
+        unknown_keys = set(directives.keys()) - set(['rate', 'burst', 'concurrency'])
+        if unknown_keys:
+            raise ConfigurationException('The rate_limit for %r > %s has unknown directives %s' \
+                            % (key, action, ', '.join(unknown_keys)))
+        # A rate set for the action also replaces the resource's burst
+        if 'rate' in directives and 'burst' not in directives:
+            action_defaults = dict(defaults)
+            action_defaults.pop('burst', None)
+        else:
+            action_defaults = defaults
+        rate_limit[action] = parse_limits(directives, action_defaults)
+    return rate_limit
+
 def parse_resources(resource_config, dependencies):
     resource_info = {}
 
@@ -216,14 +318,12 @@ def parse_resources(resource_config, dependencies):
             if filter_key not in attr_names:
                 raise ConfigurationException('Attribute %r (specified in %r > default_filters) is unknown' % (filter_key, key))
             # Make sure the specified value is an accepted value
+            # and convert it into a format that can be used in comparisons
             apiattr = next(attr for attr in attrs if attr.key == filter_key)
             try:
-                apiattr.validate(filter_value)
+                default_filters[filter_key] = apiattr.coerce(filter_value)
             except ResourceException:
                 raise ConfigurationException('The validator for attribute %r rejected the value %r (specified in %r > default_filters)' % (filter_key, filter_value, key))
-            # If necessary, convert the value specified in the config into a
-            # format that can be used in comparisons
-            default_filters[filter_key] = apiattr._writer(filter_value)
         info.pop('default_filters', None)
 
         # Get child info
@@ -283,8 +383,8 @@ def parse_resources(resource_config, dependencies):
             info['create'] = {}
         create = {'method': 'POST',
                   'url': key,
-                  'required_fields': info['create'].get('required_fields', []),
-                  'optional_fields': info['create'].get('optional_fields', []),
+                  'required_fields': tuple(info['create'].get('required_fields', [])),
+                  'optional_fields': tuple(info['create'].get('optional_fields', [])),
                   'auth': get_handler_func(resource_class, info['create']['auth'], dependencies=dependencies) \
                           if 'auth' in info['create'] else auth} \
                   if 'create' in info else None
@@ -325,6 +425,29 @@ def parse_resources(resource_config, dependencies):
                   if 'delete' in info else None
         info.pop('delete', None)
 
+        # Get the per-request query budget
+        query_budget = info.pop('query_budget', None)
+        if isinstance(query_budget, dict):
+            unknown_actions = set(query_budget.keys()) - set(['list', 'create', 'read',
+                                                              'update', 'delete'])
+            if unknown_actions:
+                raise ConfigurationException('The query_budget for %r lists unknown actions %s' \
+                                % (key, ', '.join(unknown_actions)))
+            budget_values = query_budget.values()
+        else:
+            budget_values = [query_budget] if query_budget is not None else []
+        if not all(isinstance(value, int) and value >= 0 for value in budget_values):
+            raise ConfigurationException('The query_budget for %r must be a number of queries '
+                                         'or a dictionary of numbers by action' % key)
+
+        # Whether GET requests may be served from read replicas
+        replica = info.pop('replica', True)
+        if not isinstance(replica, bool):
+            raise ConfigurationException('The replica directive for %r must be true or false' % key)
+
+        # Get the per-caller rate limits
+        rate_limit = get_rate_limits(key, info.pop('rate_limit', None))
+
         # Get other actions
         other_actions = {}
         for action, directives in info.iteritems():
@@ -344,14 +467,30 @@ def parse_resources(resource_config, dependencies):
                                                   'create': create,
                                                   'read': read,
                                                   'update': update,
-                                                  'delete': delete}
+                                                  'delete': delete,
+                                                  'query_budget': query_budget,
+                                                  'replica': replica,
+                                                  'rate_limit': rate_limit}
         resource_info[resource_class.__name__].update(other_actions)
     return resource_info
 
 
-def get_resource_info(path):
+def get_resource_info(path, snapshot_path=None):
+    """
+    Parses the API config at `path`. If `snapshot_path` is given, the parsed
+    YAML and compiled handlers are loaded from that snapshot when it matches
+    the config, and the snapshot is (re)written otherwise.
+    """
     with open(path, 'r') as f:
-        data = yaml.load(f)
+        source = f.read()
+    data = load_snapshot(snapshot_path, source) if snapshot_path else None
+    # parse_resources consumes the data as it goes, so keep a pristine copy to
+    # store in the snapshot
+    pristine_data = None
+    if data is None:
+        data = load_yaml(source)
+        if snapshot_path:
+            pristine_data = pickle.loads(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
 
     try:
         resource_module_names = data['resource_modules']
@@ -377,6 +516,9 @@ def get_resource_info(path):
 
     resource_info = parse_resources(resources_data, dependencies)
 
+    if pristine_data is not None:
+        save_snapshot(snapshot_path, source, pristine_data)
+
     log.info('Loaded resources %s', ', '.join([cls for cls, info in resource_info.iteritems()]))
     log.debug(pformat(resource_info))
     return {'resource_modules': resource_modules,
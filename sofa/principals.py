@@ -0,0 +1,57 @@
+"""
+Contains the principal cache. With sofa.configure(principal_cache_ttl=N), the
+caller an access token belongs to (its user ID and type, and when its session
+expires) is remembered for N seconds, so repeated requests with the same token
+don't look up (and touch) its session every time.
+
+Principals are cached per process. A session deleted with APISession.delete()
+is forgotten by the process that deleted it, but other processes keep
+accepting its token for up to N seconds; likewise, a session used only from
+the cache is touched at most every N seconds. Keep N well below the session
+duration.
+"""
+
+import time
+import threading
+
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+# The caller an access token belongs to, as exposed by AuthContext
+Principal = namedtuple('Principal', ['caller_id', 'caller_type', 'user_type', 'expires'])
+
+# Most tokens remembered at once; the ones cached longest ago are dropped first
+MAX_CACHED_PRINCIPALS = 10000
+
+# Maps access tokens to (Principal, time cached)
+_principals = OrderedDict()
+_lock = threading.Lock()
+
+
+def cached_principal(token, ttl):
+    """ Returns the Principal cached for `token` within the last `ttl` seconds, or None """
+    with _lock:
+        entry = _principals.get(token)
+    if entry is None:
+        return None
+    principal, cached_at = entry
+    if time.time() - cached_at > ttl or principal.expires < datetime.utcnow():
+        forget_principal(token)
+        return None
+    return principal
+
+def cache_principal(token, principal):
+    with _lock:
+        _principals.pop(token, None)
+        _principals[token] = (principal, time.time())
+        while len(_principals) > MAX_CACHED_PRINCIPALS:
+            _principals.popitem(last=False)
+
+def forget_principal(token):
+    """ Removes `token` from the cache, e.g. because its session was deleted """
+    with _lock:
+        _principals.pop(token, None)
+
+def clear_principals():
+    with _lock:
+        _principals.clear()
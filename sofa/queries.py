@@ -0,0 +1,88 @@
+"""
+Contains per-request SQL query counting. When enabled (see sofa.configure),
+every statement executed during a request is counted and timed, statements
+repeated with the same shape (the classic lazy-loading N+1 pattern) are
+flagged, and requests that exceed their resource's `query_budget` are logged or
+rejected. Statements are counted by the hooks in sofa.instrumentation.
+"""
+
+import re
+
+from config import query_budget_mode, n_plus_one_threshold
+from exceptions import QueryBudgetExceeded
+
+import logging
+log = logging.getLogger(__name__)
+
+_whitespace_re = re.compile(r'\s+')
+# Lists of bind parameters, e.g. "IN (?, ?, ?)" or "IN (%(id_1)s, %(id_2)s)"
+_param_list_re = re.compile(r'\(\s*(\?|%\(\w+\)s|:\w+|%s)(\s*,\s*(\?|%\(\w+\)s|:\w+|%s))+\s*\)')
+
+def statement_shape(statement):
+    """
+    Normalizes a SQL statement so that statements that differ only in
+    whitespace or in the length of a list of bind parameters have the same shape
+    """
+    return _param_list_re.sub('(?)', _whitespace_re.sub(' ', statement).strip())
+
+
+class QueryStats(object):
+    """ Counts and times the SQL statements executed during one request """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = {}
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        stats = self.shapes.setdefault(statement_shape(statement), [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+    def repeated(self, threshold):
+        """ Returns (shape, count, seconds) for every shape executed at least `threshold` times """
+        return [ (shape, count, seconds) for shape, (count, seconds) in self.shapes.iteritems()
+                 if count >= threshold ]
+
+    def __repr__(self):
+        return "<QueryStats(count=%r, seconds=%.4f)>" % (self.count, self.seconds)
+
+
+def request_action(request):
+    """
+    Returns the resource class and API action (list, create, read, update, or
+    delete) served by a request, or (None, None) if it is not a Sofa request
+    """
+    from structure import APIResource, APICollection
+    context = getattr(request, 'context', None)
+    if isinstance(context, APICollection):
+        return context.resource, {'GET': 'list', 'POST': 'create'}.get(request.method)
+    elif isinstance(context, APIResource):
+        return context.__class__, {'GET': 'read', 'PATCH': 'update',
+                                   'DELETE': 'delete'}.get(request.method)
+    return None, None
+
+def query_budget(resource, action):
+    """ Returns the query budget declared for `action` on `resource`, or None """
+    budget = resource.get_api_config('query_budget')
+    if isinstance(budget, dict):
+        return budget.get(action)
+    return budget
+
+def check_query_stats(request, stats):
+    resource, action = request_action(request)
+    if resource is None or action is None:
+        return
+    for shape, count, seconds in stats.repeated(n_plus_one_threshold()):
+        log.warning('Possible N+1 query on %s %s %s: executed %d times (%.4fs): %s',
+                    request.method, request.path, action, count, seconds, shape)
+    budget = query_budget(resource, action)
+    if budget is not None and stats.count > budget:
+        message = '%s %s (%s %s) executed %d queries, exceeding its budget of %d' \
+                  % (request.method, request.path, resource.__name__, action,
+                     stats.count, budget)
+        if query_budget_mode() == 'raise':
+            raise QueryBudgetExceeded(message)
+        log.warning(message)
@@ -0,0 +1,108 @@
+"""
+Contains the read-only mode for GET requests, enabled with
+sofa.configure(read_only_gets=True). While handling a GET or HEAD request:
+
+* the SQLAlchemy session doesn't autoflush (there's nothing to flush, and
+  checking costs time for every query);
+* on databases that support it (PostgreSQL and MySQL), the request's
+  transaction is started with SET TRANSACTION READ ONLY, which lets the
+  database skip taking write locks and rejects accidental writes;
+* the caller's APISession is touched after the response has been sent, in a
+  transaction of its own, instead of in the middle of the read.
+
+Applications whose GET handlers (or auth functions) write to the database
+should leave this mode off.
+"""
+
+from datetime import datetime
+
+from pyramid.threadlocal import get_current_request
+from sqlalchemy import event, inspect, orm
+
+from config import read_only_gets
+from replicas import READ_METHODS
+
+import logging
+log = logging.getLogger(__name__)
+
+# Dialects that support SET TRANSACTION READ ONLY
+READ_ONLY_DIALECTS = ('postgresql', 'mysql')
+
+# Execution option marking connections whose transactions may write even
+# during read-only requests (e.g. the deferred session touch)
+READ_WRITE_OPTION = 'sofa_read_write'
+
+
+def is_read_only(request):
+    """ Returns whether `request` is handled in read-only mode """
+    return read_only_gets() and request is not None and request.method in READ_METHODS
+
+def prepare_session(request, session):
+    """
+    Turns off autoflush on the session factory `session` for the rest of
+    `request`, and makes sure its transactions will be started read-only
+    """
+    prepared = getattr(request, 'sofa_read_only_sessions', None)
+    if prepared is None:
+        prepared = request.sofa_read_only_sessions = set()
+    if id(session) in prepared:
+        return
+    prepared.add(id(session))
+    watch_transactions(session.get_bind())
+    autoflush = session.autoflush
+    session.autoflush = False
+    def restore_autoflush(request):
+        session.autoflush = autoflush
+    request.add_finished_callback(restore_autoflush)
+
+def watch_transactions(engine):
+    """ Starts the transactions of read-only requests on `engine` with SET TRANSACTION READ ONLY """
+    if engine.dialect.name not in READ_ONLY_DIALECTS \
+       or event.contains(engine, 'begin', _begin_read_only):
+        return
+    event.listen(engine, 'begin', _begin_read_only)
+
+def starts_read_only(conn):
+    """ Returns whether a transaction beginning on `conn` is started read-only """
+    return not conn.get_execution_options().get(READ_WRITE_OPTION) \
+           and is_read_only(get_current_request())
+
+def _begin_read_only(conn):
+    if starts_read_only(conn):
+        conn.execute('SET TRANSACTION READ ONLY')
+
+def defer_touch(request, session):
+    """
+    Touches the APISession `session` in a transaction of its own once
+    `request` has finished, rather than in the request's (read-only)
+    transaction
+    """
+    state = inspect(session, raiseerr=False)
+    if state is None or state.identity is None or state.session is None:
+        # Not loaded from the database, so there's nothing to update later
+        session.touch()
+        return
+    cls = state.mapper.class_
+    identity = state.identity
+    bind = state.session.get_bind(state.mapper)
+    def touch(request):
+        # The request is still the current one, so mark the connection to keep
+        # its transaction from being started read-only
+        try:
+            connection = bind.connect().execution_options(**{READ_WRITE_OPTION: True})
+        except Exception:
+            log.exception('Could not touch the session %r', session)
+            return
+        db = orm.Session(bind=connection)
+        try:
+            db.query(cls).filter(*[ column == value for column, value
+                                    in zip(state.mapper.primary_key, identity) ]) \
+                         .update({cls.updated_at: datetime.utcnow()}, synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            log.exception('Could not touch the session %r', session)
+        finally:
+            db.close()
+            connection.close()
+    request.add_finished_callback(touch)
@@ -0,0 +1,247 @@
+"""
+Contains the 'sofa' renderer, which renders view results as JSON or, if the
+caller asks for one in its Accept header and the library for it is installed,
+in a compact binary format (MessagePack or CBOR). Every format is built from
+the same __json__ output of resources, collections, and responses.
+
+The binary formats are optional:
+
+    pip install sofa[msgpack]   # application/msgpack (msgpack)
+    pip install sofa[cbor]      # application/cbor (cbor2)
+
+JSON can also be encoded with a faster library than the standard json module
+(see find_json_encoder), and responses can be compressed with gzip or deflate
+for callers that send Accept-Encoding (see config.set_response_compression).
+"""
+
+import zlib
+
+from pyramid.interfaces import IRendererFactory
+from pyramid.renderers import JSON
+
+from config import (
+    json_encoder,
+    response_compression,
+    compression_min_size,
+    compression_level,
+    )
+
+import logging
+log = logging.getLogger(__name__)
+
+JSON_CONTENT_TYPE = 'application/json'
+
+# Content encodings the 'sofa' renderer can compress responses with, in order
+# of preference, and the zlib window bits that produce them
+CONTENT_ENCODINGS = [('gzip', 16 + zlib.MAX_WBITS),
+                     ('deflate', zlib.MAX_WBITS)]
+
+# Lists with more items than this are encoded (and so compressed) in chunks of
+# this many items
+JSON_CHUNK_ITEMS = 200
+
+# Compressed responses are compressed and sent in pieces of this many bytes
+COMPRESSION_CHUNK_SIZE = 64 * 1024
+
+def _msgpack_serializer():
+    import msgpack
+    return lambda value: msgpack.packb(value, use_bin_type=True)
+
+def _cbor_serializer():
+    import cbor2
+    return cbor2.dumps
+
+# Maps content types to functions returning a serializer (which takes a value
+# prepared by to_primitive and returns bytes). Their libraries are imported on
+# first use, and formats whose library is missing are not offered.
+BINARY_FORMATS = [('application/msgpack', _msgpack_serializer),
+                  ('application/x-msgpack', _msgpack_serializer),
+                  ('application/cbor', _cbor_serializer)]
+
+# Maps content types to serializers, or to None if the library isn't installed
+_serializers = {}
+
+def get_serializer(content_type):
+    """ Returns the serializer for a binary content type, or None if it's not available """
+    if content_type not in _serializers:
+        factory = dict(BINARY_FORMATS)[content_type]
+        try:
+            _serializers[content_type] = factory()
+        except ImportError:
+            log.debug('%s responses are not available: its library is not installed',
+                      content_type)
+            _serializers[content_type] = None
+    return _serializers[content_type]
+
+def available_content_types():
+    """ Returns the content types the 'sofa' renderer can produce, JSON first """
+    return [JSON_CONTENT_TYPE] + [ content_type for content_type, factory in BINARY_FORMATS
+                                   if get_serializer(content_type) ]
+
+def _stdlib_json_encoder():
+    import json
+    return json.dumps
+
+def _simplejson_encoder():
+    import simplejson
+    return simplejson.dumps
+
+def _rapidjson_encoder():
+    import rapidjson
+    return rapidjson.dumps
+
+# Maps JSON encoder names to functions returning a function that takes a value
+# and a `default` function (as json.dumps does) and returns the encoded JSON
+JSON_ENCODERS = {'json': _stdlib_json_encoder,
+                 'simplejson': _simplejson_encoder,
+                 'rapidjson': _rapidjson_encoder}
+
+# Encoders tried by find_json_encoder('auto'), fastest first. (ujson is not
+# supported: it rounds floats and silently encodes objects it doesn't know,
+# such as datetimes, instead of calling `default`.)
+FAST_JSON_ENCODERS = ['rapidjson', 'simplejson']
+
+def find_json_encoder(name):
+    """
+    Returns the dumps function of the JSON encoder `name` (a key of
+    JSON_ENCODERS), or with 'auto', of the first installed encoder in
+    FAST_JSON_ENCODERS (or the json module if none are). Raises
+    ConfigurationException if the encoder is unknown or not installed.
+    """
+    from exceptions import ConfigurationException
+    if name == 'auto':
+        for candidate in FAST_JSON_ENCODERS:
+            try:
+                return JSON_ENCODERS[candidate]()
+            except ImportError:
+                continue
+        log.info('No faster JSON encoder is installed (tried %s); using the json module',
+                 ', '.join(FAST_JSON_ENCODERS))
+        return JSON_ENCODERS['json']()
+    if name not in JSON_ENCODERS:
+        raise ConfigurationException('Unknown JSON encoder %r (expected "auto" or one of: %s)'
+                                     % (name, ', '.join(sorted(JSON_ENCODERS))))
+    try:
+        return JSON_ENCODERS[name]()
+    except ImportError:
+        raise ConfigurationException('The %s JSON encoder is not installed' % name)
+
+# Types that every serializer handles as they are
+_primitive_types = frozenset([type(None), bool, int, long, float, unicode])
+
+def to_primitive(value, request):
+    """
+    Converts a view's return value into dictionaries, lists, and unicode text,
+    calling __json__ on objects that have it (as the JSON renderer does).
+    Byte strings are decoded as UTF-8 so that they are encoded as text.
+    """
+    value_type = type(value)
+    if value_type in _primitive_types:
+        return value
+    if value_type is str:
+        return value.decode('utf-8')
+    if isinstance(value, dict):
+        return { to_primitive(k, request): to_primitive(v, request) for k, v in value.iteritems() }
+    if isinstance(value, (list, tuple)):
+        return [ to_primitive(v, request) for v in value ]
+    if hasattr(value, '__json__'):
+        return to_primitive(value.__json__(request), request)
+    raise TypeError('%r is not serializable' % (value,))
+
+def encode_json(value, request, dumps, chunked=False):
+    """
+    Encodes `value` with the JSON encoder function `dumps` (see
+    JSON_ENCODERS), returning a list of strings that make up the JSON. If
+    `chunked` is set, long lists are encoded a chunk of items at a time, so
+    that the pieces can be compressed while the rest is encoded.
+    """
+    def default(obj):
+        if hasattr(obj, '__json__'):
+            return obj.__json__(request)
+        raise TypeError('%r is not JSON serializable' % (obj,))
+    # Call __json__ up front, since it may query the database (which must
+    # happen while the request's transaction is still open)
+    if hasattr(value, '__json__'):
+        value = value.__json__(request)
+    if not chunked or not isinstance(value, list) or len(value) <= JSON_CHUNK_ITEMS:
+        return [dumps(value, default=default)]
+    chunks = ['[']
+    for start in range(0, len(value), JSON_CHUNK_ITEMS):
+        if start:
+            chunks.append(',')
+        # Strip the brackets from each chunk's list
+        chunks.append(dumps(value[start:start+JSON_CHUNK_ITEMS], default=default)[1:-1])
+    chunks.append(']')
+    return chunks
+
+def compress(chunks, window_bits, level):
+    """ Yields the compressed contents of the strings in `chunks` """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, window_bits)
+    for chunk in chunks:
+        for start in range(0, len(chunk), COMPRESSION_CHUNK_SIZE):
+            data = compressor.compress(chunk[start:start+COMPRESSION_CHUNK_SIZE])
+            if data:
+                yield data
+    yield compressor.flush()
+
+
+class SofaRenderer(object):
+    """
+    Renderer factory for the 'sofa' renderer, registered by includeme. The
+    format is chosen from the request's Accept header; JSON is used when the
+    caller accepts it, doesn't say, or accepts nothing that is available.
+    Unless a JSON encoder has been configured (see config.set_json_encoder),
+    JSON is rendered by the application's 'json' renderer, so JSON adapters
+    registered with Pyramid keep working.
+    """
+
+    def __init__(self, info):
+        json_factory = info.registry.queryUtility(IRendererFactory, name='json') or JSON()
+        self.render_json = json_factory(info)
+
+    def __call__(self, value, system):
+        request = system.get('request')
+        if request is None:
+            return self.render_json(value, system)
+        response = request.response
+        compressing = response_compression()
+        self.add_vary(response, 'Accept', 'Accept-Encoding' if compressing else None)
+        content_type = self.negotiate(request)
+        encoding = self.negotiate_encoding(request) if compressing else None
+        if content_type != JSON_CONTENT_TYPE:
+            chunks = [get_serializer(content_type)(to_primitive(value, request))]
+            response.content_type = content_type
+        elif json_encoder() is not None:
+            chunks = encode_json(value, request, json_encoder(), chunked=bool(encoding))
+            response.content_type = content_type
+        else:
+            chunks = [self.render_json(value, system)]
+        if encoding is None or response.content_encoding \
+           or sum(len(chunk) for chunk in chunks) < compression_min_size():
+            return ''.join(chunks)
+        # Pyramid sends an iterable result as the response's app_iter, so the
+        # body is compressed as the server sends it
+        response.content_encoding = encoding
+        return compress(chunks, dict(CONTENT_ENCODINGS)[encoding], compression_level())
+
+    @staticmethod
+    def add_vary(response, *headers):
+        vary = response.vary or ()
+        missing = tuple( header for header in headers if header and header not in vary )
+        if missing:
+            response.vary = tuple(vary) + missing
+
+    def negotiate(self, request):
+        """ Returns the content type to render for `request` """
+        if 'Accept' not in request.headers:
+            return JSON_CONTENT_TYPE
+        offers = request.accept.acceptable_offers(available_content_types())
+        return offers[0][0] if offers else JSON_CONTENT_TYPE
+
+    def negotiate_encoding(self, request):
+        """ Returns the content encoding to compress the response for `request` with, or None """
+        if 'Accept-Encoding' not in request.headers:
+            return None
+        offers = request.accept_encoding.acceptable_offers([ encoding for encoding, window_bits
+                                                             in CONTENT_ENCODINGS ])
+        return offers[0][0] if offers else None
@@ -0,0 +1,140 @@
+"""
+Contains read replica routing. When sofa.configure() is given read_sessions
+(session factories bound to read-only replicas), the queries sofa makes for GET
+requests use one of them instead of the primary session. Each request uses a
+single replica throughout, so it sees one consistent copy of the data.
+
+Requests that change data always use the primary. So that callers see their own
+changes even though replicas lag behind the primary, a successful write sets a
+cookie that sends the caller's reads to the primary for a few seconds (the
+read-your-writes window). Resources can opt out of replicas entirely with
+`replica: false` in api.yaml.
+"""
+
+import time
+import itertools
+
+from sqlalchemy import event
+
+import logging
+log = logging.getLogger(__name__)
+
+# Methods whose requests may be served from a replica
+READ_METHODS = ('GET', 'HEAD')
+
+# Cookie holding the time until which the caller's reads go to the primary
+READ_YOUR_WRITES_COOKIE = 'sofa_primary_until'
+
+# Weight of the newest measurement in a replica's average query latency
+LATENCY_SMOOTHING = 0.2
+
+
+class ReplicaSet(object):
+    """
+    Chooses among read session factories, either in turn ('round_robin') or
+    by lowest average query latency ('least_latency')
+    """
+    SELECTIONS = ('round_robin', 'least_latency')
+
+    def __init__(self, sessions, selection='round_robin'):
+        if selection not in self.SELECTIONS:
+            raise ValueError('%r is not a valid replica selection (expected one of: %s)'
+                             % (selection, ', '.join(self.SELECTIONS)))
+        if not sessions:
+            raise ValueError('A ReplicaSet needs at least one session factory')
+        self.sessions = list(sessions)
+        self.selection = selection
+        self._turns = itertools.count()
+        # Average query latency (in seconds) of each replica. Replicas start
+        # at zero, so each is tried before the averages are compared.
+        self.latencies = [0.0] * len(self.sessions)
+        if selection == 'least_latency':
+            for i, session in enumerate(self.sessions):
+                self.watch_latency(i, session)
+
+    def choose(self):
+        """ Returns the session factory to use for the next request """
+        if self.selection == 'least_latency':
+            i = min(range(len(self.sessions)), key=self.latencies.__getitem__)
+        else:
+            i = next(self._turns) % len(self.sessions)
+        return self.sessions[i]
+
+    def watch_latency(self, i, session):
+        """ Times the queries sent to replica `i` through its session's engine """
+        try:
+            engine = session.get_bind()
+        except Exception, e:
+            log.warning('Cannot measure the latency of read replica %d (%r): %r. It will '
+                        'only be chosen while other replicas are slower.', i, session, e)
+            return
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('sofa_replica_query_started', []).append(time.time())
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info.get('sofa_replica_query_started')
+            if started:
+                elapsed = time.time() - started.pop()
+                self.latencies[i] += LATENCY_SMOOTHING * (elapsed - self.latencies[i])
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def reads_own_writes(request):
+    """ Returns whether `request` comes from a caller that wrote within the read-your-writes window """
+    try:
+        return float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+def choose_read_session(request, primary, replicas, window):
+    """
+    Returns the session factory for read-only queries made while handling
+    `request`: a replica chosen from the ReplicaSet `replicas`, or the
+    `primary` for requests that may write and for callers that wrote within
+    the last `window` seconds
+    """
+    session = getattr(request, 'sofa_read_session', None)
+    if session is None:
+        if request.method not in READ_METHODS:
+            note_write(request, window)
+            session = primary
+        elif reads_own_writes(request):
+            session = primary
+        else:
+            session = replicas.choose()
+            # Don't carry the replica session's identity map and transaction
+            # over to the thread's next request, which would keep seeing the
+            # data as it was
+            request.add_finished_callback(lambda request: end_session(session))
+        request.sofa_read_session = session
+    return session
+
+def end_session(session):
+    """ Closes the replica session factory `session`'s session for this thread """
+    if hasattr(session, 'remove'):
+        session.remove()
+    else:
+        session.close()
+
+def note_write(request, window):
+    """
+    Calls record_write for `request` (once) if it may write, whether or not
+    its resource is read from replicas
+    """
+    if request.method in READ_METHODS or getattr(request, 'sofa_write_recorded', False):
+        return
+    request.sofa_write_recorded = True
+    record_write(request, window)
+
+def record_write(request, window):
+    """
+    Sends the caller's reads to the primary for the next `window` seconds if
+    `request` succeeds
+    """
+    if not window:
+        return
+    def set_cookie(request, response):
+        if response.status_int < 400:
+            response.set_cookie(READ_YOUR_WRITES_COOKIE, '%.3f' % (time.time() + window),
+                                max_age=window, httponly=True)
+    request.add_response_callback(set_cookie)
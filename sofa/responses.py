@@ -63,7 +63,7 @@ class ResourceException(Exception):
     """
     def __init__(self, status_code, error_id, message):
         log.debug("ResourceException({}, {}): {}".format(status_code, error_id, message))
-        if status_code not in (304, 400, 401, 403, 404, 422, 500):
+        if status_code not in (304, 400, 401, 403, 404, 422, 429, 500):
             raise ValueError("%s is not a valid status code" % status_code)
         self.status_code = status_code
         self.error_id = error_id
@@ -0,0 +1,30 @@
+import os
+import sys
+
+from sqlalchemy import create_engine
+
+from sofa.config import load_api_config
+from sofa.indexes import missing_indexes
+
+def main(argv=sys.argv):
+    if len(argv) != 3:
+        cmd = os.path.basename(argv[0])
+        print('usage: %s <api_config> <sqlalchemy_url>\n'
+              '(example: "%s api.yaml postgresql://localhost/mydb")' % (cmd, cmd))
+        sys.exit(1)
+    load_api_config(argv[1])
+    engine = create_engine(argv[2])
+    report = missing_indexes(bind=engine)
+    if not report:
+        print('All filterable, sortable, unique, and joined columns are indexed.')
+        return
+    for entry in report:
+        print('%s.%s (%s): %s' % (entry['table'], entry['column'],
+                                  entry['class'].__name__, ', '.join(entry['reasons'])))
+    print('\nSuggested DDL:\n')
+    for entry in report:
+        print(entry['ddl'])
+    sys.exit(2)
+
+if __name__ == '__main__':
+    main()
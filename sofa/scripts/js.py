@@ -192,6 +192,9 @@ def main(argv=sys.argv):
         info.pop('delete')
         info.pop('default_filters')
         info.pop('root_accessible')
+        info.pop('query_budget', None)
+        info.pop('replica', None)
+        info.pop('rate_limit', None)
         for action, directives in info.iteritems():
             if directives:
                 verb = snake_to_camel(action)
@@ -0,0 +1,51 @@
+import argparse
+import logging
+import sys
+
+from sqlalchemy import create_engine
+
+from sofa.config import load_api_config, set_session_duration, session_duration
+from sofa.indexes import missing_indexes
+from sofa.sessions import purge_expired_sessions, session_classes, PURGE_BATCH_SIZE
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(prog='sofa-sessions',
+                                     description='Delete expired and logged out sessions')
+    parser.add_argument('api_config', help='path to api.yaml')
+    parser.add_argument('url', help='SQLAlchemy database URL (e.g. postgresql://localhost/mydb)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report how many sessions would be deleted')
+    parser.add_argument('--session-duration', type=int, default=session_duration(),
+                        help='seconds a session stays valid after its last use '
+                             '(default: %(default)s)')
+    parser.add_argument('--grace', type=int, default=0,
+                        help='keep sessions for this many seconds after they expire or are deleted')
+    parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE,
+                        help='sessions deleted per transaction (default: %(default)s)')
+    parser.add_argument('--max-batches', type=int, default=None,
+                        help='stop after this many batches per table')
+    parser.add_argument('--pause', type=float, default=0,
+                        help='seconds to wait between batches')
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    load_api_config(args.api_config)
+    set_session_duration(args.session_duration)
+    engine = create_engine(args.url)
+    if not session_classes():
+        print('No APISession classes found in the API config\'s resource modules.')
+        sys.exit(1)
+    report = purge_expired_sessions(bind=engine, batch_size=args.batch_size, grace=args.grace,
+                                    max_batches=args.max_batches, pause=args.pause,
+                                    dry_run=args.dry_run)
+    for table_name, count in sorted(report.items()):
+        print('%s: %d sessions %s' % (table_name, count,
+                                      'would be deleted' if args.dry_run else 'deleted'))
+    unindexed = [ (reason, entry) for entry in missing_indexes(bind=engine)
+                  for reason in entry['reasons'] if reason.endswith('session purge') ]
+    if unindexed:
+        print('\nPurging scans the whole table without these indexes:\n')
+        for reason, entry in unindexed:
+            print('-- %s\n%s' % (reason, entry['ddl']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Contains full-text search backends used for the `:` querystring operator on
+attributes declared with the `search` directive in the API config
+"""
+
+import re
+
+from sqlalchemy import func, select, and_, literal_column
+from sqlalchemy.sql import table, column
+
+from config import sqla_session, api_config
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class SearchBackend(object):
+    """
+    Dummy search backend. Subclasses translate a `:` query on a searchable
+    APIAttribute into an indexed SQL expression, produce an expression that can
+    be used to order results by relevance (lowest value = best match), and
+    create the index.
+    """
+    name = None
+
+    def has_terms(self, value):
+        """
+        Returns whether the `:` query `value` has anything to search the index
+        for; those without (e.g. "%") fall back to LIKE
+        """
+        return bool(re.sub(r'[\s%_]', '', value))
+
+    def match(self, attr, value):
+        raise NotImplementedError
+
+    def rank(self, attr, value):
+        raise NotImplementedError
+
+    def index_ddl(self, attr):
+        """ Returns a list of statements that create and populate the index """
+        raise NotImplementedError
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    Searches an external-content FTS5 virtual table named
+    <table>_<column>_fts. The table is kept up to date by triggers on the
+    content table, so inserts, updates, and deletes made through Sofa (or
+    anything else) are indexed.
+    """
+    name = 'sqlite'
+
+    @staticmethod
+    def fts_table_name(attr):
+        return '%s_%s_fts' % (attr.cls.__tablename__, attr.key)
+
+    def _fts_table(self, attr):
+        return table(self.fts_table_name(attr), column('rowid'), column('rank'),
+                     column(attr.key))
+
+    @staticmethod
+    def _content_rowid(attr):
+        return literal_column('%s.rowid' % attr.cls.__tablename__)
+
+    @staticmethod
+    def build_query(value):
+        """
+        Converts a LIKE-style pattern (e.g. "%bob%") into an FTS5 query. Each
+        word becomes a quoted term; a word followed by a `%` wildcard becomes a
+        prefix query.
+        """
+        terms = []
+        for word, wildcard in re.findall(r'([^\s%_"]+)(%?)', value):
+            terms.append('"%s"%s' % (word, '*' if wildcard else ''))
+        return ' '.join(terms)
+
+    def has_terms(self, value):
+        # An empty MATCH is a syntax error in FTS5
+        return bool(self.build_query(value))
+
+    def match(self, attr, value):
+        fts = self._fts_table(attr)
+        return self._content_rowid(attr).in_(
+            select([fts.c.rowid]).where(fts.c[attr.key].match(self.build_query(value))))
+
+    def rank(self, attr, value):
+        # FTS5's bm25() rank is negative; lower values are better matches
+        fts = self._fts_table(attr)
+        return select([fts.c.rank]).where(and_(fts.c.rowid == self._content_rowid(attr),
+                                               fts.c[attr.key].match(self.build_query(value)))) \
+                                   .as_scalar()
+
+    def index_ddl(self, attr):
+        params = {'fts': self.fts_table_name(attr),
+                  'table': attr.cls.__tablename__,
+                  'col': attr.key}
+        statements = [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({col}, content='{table}')",
+            "CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+            "INSERT INTO {fts}(rowid, {col}) VALUES (new.rowid, new.{col}); END",
+            "CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+            "INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.rowid, old.{col}); END",
+            "CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {col} ON {table} BEGIN "
+            "INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.rowid, old.{col}); "
+            "INSERT INTO {fts}(rowid, {col}) VALUES (new.rowid, new.{col}); END",
+            "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+            ]
+        return [ statement.format(**params) for statement in statements ]
+
+
+class PostgreSQLSearchBackend(SearchBackend):
+    """
+    Searches a tsvector expression over the column, backed by a GIN index on
+    the same expression (which PostgreSQL maintains on every write).
+    """
+    name = 'postgresql'
+
+    @staticmethod
+    def language(attr):
+        return attr.search if isinstance(attr.search, basestring) else 'english'
+
+    def _document(self, attr):
+        return func.to_tsvector(self.language(attr),
+                                func.coalesce(getattr(attr.cls, attr.key), ''))
+
+    def _query(self, attr, value):
+        return func.plainto_tsquery(self.language(attr),
+                                    value.replace('%', ' ').replace('_', ' '))
+
+    def match(self, attr, value):
+        return self._document(attr).op('@@')(self._query(attr, value))
+
+    def rank(self, attr, value):
+        return -func.ts_rank(self._document(attr), self._query(attr, value))
+
+    def index_ddl(self, attr):
+        return ["CREATE INDEX IF NOT EXISTS ix_{table}_{col}_search ON {table} "
+                "USING gin (to_tsvector('{lang}', coalesce({col}, '')))".format(
+                    table=attr.cls.__tablename__, col=attr.key, lang=self.language(attr))]
+
+
+_backends = {'sqlite': SQLiteSearchBackend(),
+             'postgresql': PostgreSQLSearchBackend()}
+
+# (dialect, resource name) pairs already warned about falling back to LIKE
+_warned_unsupported = set()
+
+def get_search_backend(resource):
+    """
+    Returns the SearchBackend for the database that `resource` is stored in, or
+    None if the dialect has no full-text search support (in which case `:`
+    queries fall back to LIKE)
+    """
+    dialect = sqla_session().get_bind(resource.__mapper__).dialect.name
+    backend = _backends.get(dialect)
+    if not backend and (dialect, resource.__name__) not in _warned_unsupported:
+        _warned_unsupported.add((dialect, resource.__name__))
+        log.warning('Full-text search is not supported on %s; falling back to LIKE '
+                    'queries for %s', dialect, resource.__name__)
+    return backend
+
+def searchable_attrs():
+    """ Yields every APIAttribute declared with the `search` directive """
+    for cls_name, info in api_config().iteritems():
+        for attr in info['attrs']:
+            if attr.search:
+                yield attr
+
+def create_search_indexes(bind=None):
+    """
+    Creates (if necessary) and populates the full-text index for every
+    searchable attribute. `bind` defaults to the configured SQLAlchemy
+    session's engine.
+    """
+    for attr in searchable_attrs():
+        engine = bind or sqla_session().get_bind(attr.cls.__mapper__)
+        backend = _backends.get(engine.dialect.name)
+        if not backend:
+            log.warning('Cannot create a full-text index for %s.%s on %s',
+                        attr.cls.__name__, attr.key, engine.dialect.name)
+            continue
+        with engine.begin() as connection:
+            for statement in backend.index_ddl(attr):
+                connection.execute(statement)
+        log.info('Created full-text index for %s.%s', attr.cls.__name__, attr.key)
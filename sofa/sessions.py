@@ -0,0 +1,100 @@
+"""
+Contains the expired session purge. APISession.delete() only marks a session
+inactive, and expired sessions stay in the table, so the sessions table grows
+with every login unless old sessions are removed. purge_expired_sessions()
+deletes sessions that are inactive or whose last use (updated_at) was more
+than the session duration ago, in small batches that each run in their own
+short transaction, so it can run from cron alongside live traffic. The
+sofa-sessions command runs it (or, with --dry-run, reports what it would
+delete).
+
+Expired sessions are looked up by updated_at and deleted ones by active and
+invalidated_at, in separate passes, so each should be indexed; the index
+advisor (sofa-indexes) suggests both indexes.
+"""
+
+import time
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, not_, select, func
+
+from config import sqla_session, session_duration, resource_registry
+from structure import APISession
+
+import logging
+log = logging.getLogger(__name__)
+
+# Sessions deleted per transaction
+PURGE_BATCH_SIZE = 1000
+
+
+def session_classes():
+    """ Returns the mapped classes that inherit APISession """
+    return [ cls for cls in resource_registry()
+             if issubclass(cls, APISession) and hasattr(cls, '__table__') ]
+
+def purge_conditions(cls, now=None, grace=0):
+    """
+    Returns the SQL conditions matching sessions of `cls` that can be purged,
+    as a list of (description, condition): those that expired, and those
+    that were deleted, more than `grace` seconds ago. Each is purged
+    separately so that it can use its own index (on updated_at, and on
+    active and invalidated_at).
+    """
+    table = cls.__table__
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=grace)
+    expired = table.c.updated_at < cutoff - timedelta(seconds=session_duration())
+    deleted = and_(table.c.active == False,
+                   or_(table.c.invalidated_at == None, table.c.invalidated_at < cutoff))
+    return [('expired', expired), ('deleted', deleted)]
+
+def purge_expired_sessions(cls=None, bind=None, batch_size=PURGE_BATCH_SIZE, grace=0,
+                           max_batches=None, pause=0, dry_run=False):
+    """
+    Deletes purgeable sessions (see purge_conditions) of the session class
+    `cls`, or of every APISession subclass, `batch_size` at a time, pausing
+    `pause` seconds between batches and stopping after `max_batches` batches
+    of each kind if set. `bind` defaults to the configured SQLAlchemy
+    session's engine. Returns a dict mapping table names to the number of
+    sessions deleted, or with `dry_run`, the number that would be deleted.
+    """
+    if bind is None:
+        bind = sqla_session().get_bind()
+    now = datetime.utcnow()
+    report = {}
+    for session_class in ([cls] if cls is not None else session_classes()):
+        table = session_class.__table__
+        conditions = purge_conditions(session_class, now, grace)
+        if dry_run:
+            # Don't count sessions matching an earlier condition twice
+            report[table.name] = sum(
+                bind.execute(select([func.count()]).select_from(table)
+                             .where(and_(condition,
+                                         *[ not_(earlier) for _, earlier in conditions[:i] ])))
+                    .scalar()
+                for i, (_, condition) in enumerate(conditions))
+            continue
+        primary_key = list(table.primary_key.columns)[0]
+        deleted = 0
+        for description, condition in conditions:
+            count = batches = 0
+            while max_batches is None or batches < max_batches:
+                with bind.begin() as connection:
+                    keys = [ row[0] for row in connection.execute(select([primary_key])
+                                                                  .where(condition)
+                                                                  .limit(batch_size)) ]
+                    if not keys:
+                        break
+                    connection.execute(table.delete().where(primary_key.in_(keys)))
+                count += len(keys)
+                batches += 1
+                log.debug('Purged %d %s sessions from %s', len(keys), description, table.name)
+                if len(keys) < batch_size:
+                    break
+                if pause:
+                    time.sleep(pause)
+            log.info('Purged %d %s sessions from %s', count, description, table.name)
+            deleted += count
+        report[table.name] = deleted
+    return report
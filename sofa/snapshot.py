@@ -0,0 +1,134 @@
+"""
+Contains the API config snapshot cache. Every process that calls
+load_api_config parses api.yaml and compiles every handler lambda in it; with
+many workers restarting on every deploy, that work adds up. A snapshot file
+stores the parsed YAML document and the compiled handler code so that later
+processes can skip both. A snapshot is only used if it was written from the
+same api.yaml (by content hash), by the same Python and PyYAML versions, and
+while the resource and dependency modules it lists were unchanged; otherwise
+the config is parsed in full and the snapshot is rewritten.
+"""
+
+import os
+import sys
+import marshal
+import hashlib
+import pkgutil
+import tempfile
+import cPickle as pickle
+
+import logging
+log = logging.getLogger(__name__)
+
+# Bump this whenever the layout of the snapshot file changes
+SNAPSHOT_FORMAT = 1
+
+# Maps handler source strings to compiled code objects
+_compiled = {}
+
+# PyYAML is only imported when a config is actually parsed, so that processes
+# that import sofa without loading a config don't pay for it
+def yaml_loader():
+    """ Returns the C-accelerated YAML loader if libyaml is available """
+    import yaml
+    return getattr(yaml, 'CLoader', yaml.Loader)
+
+def load_yaml(stream):
+    import yaml
+    return yaml.load(stream, Loader=yaml_loader())
+
+def compile_expression(source):
+    """
+    Compiles a handler string (e.g. a lambda from api.yaml) for eval, reusing
+    code loaded from a snapshot or compiled earlier
+    """
+    code = _compiled.get(source)
+    if code is None:
+        code = _compiled[source] = compile(source, '<api config>', 'eval')
+    return code
+
+def config_key(source):
+    """ Returns the key identifying snapshots of an api.yaml with contents `source` """
+    import yaml
+    key = hashlib.sha1(source)
+    key.update('\0'.join([str(SNAPSHOT_FORMAT), sys.version, yaml.__version__]))
+    return key.hexdigest()
+
+def module_version(name):
+    """
+    Returns (mtime, size) of the file a module is loaded from without importing
+    it (its parent packages are imported, though), or None if it has no file
+    """
+    try:
+        loader = pkgutil.find_loader(name)
+        path = loader.get_filename(name) if loader else None
+    except (ImportError, AttributeError):
+        return None
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+def config_modules(data):
+    """ Returns the names of the resource and dependency modules listed in parsed api.yaml data """
+    names = list(data.get('resource_modules', []))
+    for dep in data.get('dependencies', []):
+        if isinstance(dep, dict):
+            names.append(dep.keys()[0].strip())
+        else:
+            names.append(dep.split(':', 1)[0].strip())
+    return names
+
+def load_snapshot(snapshot_path, source):
+    """
+    Returns the parsed api.yaml data stored in the snapshot at `snapshot_path`
+    (and registers its compiled handler code), or None if there is no usable
+    snapshot for an api.yaml with contents `source`
+    """
+    try:
+        with open(snapshot_path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except IOError:
+        return None
+    except Exception, e:
+        log.warning('Could not read API config snapshot %s: %r', snapshot_path, e)
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('key') != config_key(source):
+        log.info('API config snapshot %s is out of date', snapshot_path)
+        return None
+    for name, version in snapshot['modules'].iteritems():
+        if module_version(name) != version:
+            log.info('API config snapshot %s is out of date: module %s has changed',
+                     snapshot_path, name)
+            return None
+    try:
+        data = pickle.loads(snapshot['data'])
+        code = marshal.loads(snapshot['code'])
+    except Exception, e:
+        log.warning('Could not read API config snapshot %s: %r', snapshot_path, e)
+        return None
+    _compiled.update(code)
+    log.debug('Loaded API config snapshot %s', snapshot_path)
+    return data
+
+def save_snapshot(snapshot_path, source, data):
+    """
+    Writes a snapshot of parsed api.yaml `data` and of every handler compiled
+    so far. The file is replaced atomically, so workers starting at the same
+    time never read a partial snapshot.
+    """
+    snapshot = {'key': config_key(source),
+                'modules': { name: module_version(name) for name in config_modules(data) },
+                'data': pickle.dumps(data, pickle.HIGHEST_PROTOCOL),
+                'code': marshal.dumps(_compiled)}
+    directory = os.path.dirname(os.path.abspath(snapshot_path))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.sofa-snapshot-')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, snapshot_path)
+    except (IOError, OSError), e:
+        log.warning('Could not write API config snapshot %s: %r', snapshot_path, e)
@@ -1,11 +1,7 @@
-import os
-import requests
+import time
 import collections
-import transaction
 
-from pprint import pformat
-
-from inspect import isclass
+from inspect import isclass, ismethod, getargspec
 
 from datetime import datetime, timedelta
 
@@ -13,11 +9,12 @@ from pyramid.httpexceptions import HTTPNotModified
 from pyramid.threadlocal import get_current_request
 
 from sqlalchemy import Column, Boolean, DateTime
-from sqlalchemy.sql.expression import func
+from sqlalchemy.orm import object_session
+from sqlalchemy.sql.expression import func, and_, case, true, false, ClauseElement
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy import orm
 
 from responses import ResourceUpdated, ResourceException
+from readers import datetime_reader
 
 from config import (
     sqla_session,
@@ -27,8 +24,13 @@ from config import (
     session_duration,
     getapiattr,
     get_resource,
+    filter_shape_recording,
+    principal_cache_ttl,
     )
 from tools import exec_function, func_params
+from principals import Principal, cached_principal, cache_principal, forget_principal
+from search import get_search_backend
+from timing import timed
 
 import logging
 log = logging.getLogger(__name__)
@@ -45,7 +47,8 @@ def get_auth_context(request):
 
 class APIAttribute(object):
     def __init__(self, key, _type=None, validator=None, readable=True, reader=None,
-                 writable=True, writer=None, auth=None, cls=None, dynamic_params=[]):
+                 writable=True, writer=None, auth=None, cls=None, dynamic_params=[],
+                 search=False, auth_sql=False):
         """
         Initializes an APIAttribute object, representing an attribute of an
         object in an API. Takes a `key` param, the name of the attribute to be
@@ -61,6 +64,12 @@ class APIAttribute(object):
         param, indicating whether or not the attribute should be mutable in
         API PATCH requests; and a `writer` function that translates values
         from API requests to database values (see `._writer()` docstring).
+        If `search` is set, `:` queries on the attribute use a full-text index
+        (see sofa.search) instead of LIKE; it may be True or, on PostgreSQL,
+        the name of a text search configuration (e.g. 'english'). If
+        `auth_sql` is set, the `auth` function returns a SQL condition when
+        its target is the resource class, and lists evaluate it in the
+        database (see auth_condition) instead of calling it per resource.
 
         Note that `readable` and `writable` do NOT affect the APIAttribute's
         readability/writability within the read() and write() methods -- they
@@ -99,7 +108,9 @@ class APIAttribute(object):
         if writer:
             self._writer = writer
         self.auth = auth
+        self.auth_sql = auth_sql
         self.cls = cls
+        self.search = search
         self.dynamic_params = dynamic_params
         for param in self.dynamic_params:
             if param['validator'] and isclass(param['validator']):
@@ -131,12 +142,45 @@ class APIAttribute(object):
         Reads the attribute's value from the specified resource instance using the _reader()
         function.
         """
-        if self.dynamic_params:
-            # This is a dynamic attribute, and we need to pass the "attribute"
-            # the appropriate parameters in order to get a value
-            return exec_function(self._reader)(getattr(instance, self.key)(**{p['name']: instance.__request__.GET.get(p['name'], None) for p in self.dynamic_params}))
-        else:
-            return exec_function(self._reader)(getattr(instance, self.key))
+        with timed(instance.__request__, 'reader'):
+            if self.dynamic_params:
+                # This is a dynamic attribute, and we need to pass the "attribute"
+                # the appropriate parameters in order to get a value
+                return exec_function(self._reader)(getattr(instance, self.key)(**{p['name']: instance.__request__.GET.get(p['name'], None) for p in self.dynamic_params}))
+            else:
+                return exec_function(self._reader)(getattr(instance, self.key))
+
+    def read_many(self, instances, request=None):
+        """
+        Reads the attribute's value from each of the specified resource instances,
+        which are being serialized for `request` (by default, the first instance's
+        request). If the reader has a batch form (see sofa.readers), it is called
+        once for all of the values.
+        """
+        if request is None:
+            request = instances[0].__request__
+        with timed(request, 'reader'):
+            if self.dynamic_params:
+                params = {p['name']: request.GET.get(p['name'], None) for p in self.dynamic_params}
+                values = [ getattr(instance, self.key)(**params) for instance in instances ]
+            else:
+                key = self.key
+                values = [ getattr(instance, key) for instance in instances ]
+        return self.read_values(values, request)
+
+    def read_values(self, values, request=None):
+        """
+        Interprets a list of the attribute's values (e.g. as selected from the
+        database) with its reader, using the reader's batch form if it has one
+        """
+        with timed(request, 'reader'):
+            if self._reader is APIAttribute._reader:
+                return values
+            reader = exec_function(self._reader)
+            batch = getattr(reader, 'batch', None)
+            if batch:
+                return batch(values)
+            return [ reader(value) for value in values ]
 
     @staticmethod
     def _reader(value):
@@ -158,18 +202,23 @@ class APIAttribute(object):
         Also validates the new value before writing using the APIAttribute's validator
         (APIValidator) object.
         """
-        # Validate the value we'll be using
-        self.validate(value)
-        # OK, we're ready to do the update... Get the class of the object we're updating
+        self.set(instance, self.coerce(value))
+
+    def set(self, instance, value):
+        """
+        Sets the attribute on the specified resource instance to `value`, which
+        must already be validated and converted (see coerce)
+        """
+        # Get the class of the object we're updating
         resource_class = instance.__class__
         # Get the target class variable that we want to update (probably Column object)
         target = resource_class.__getattribute__(resource_class, self.key)
         # If that target class variable is a descriptor, use its __set__ to update the value
         if hasattr(target, '__set__'):
-            target.__set__(instance, exec_function(self._writer)(value))
+            target.__set__(instance, value)
         # Otherwise, just change the value
         else:
-            setattr(instance, self.key, exec_function(self._writer)(value))
+            setattr(instance, self.key, value)
 
     @staticmethod
     def _writer(value):
@@ -188,35 +237,55 @@ class APIAttribute(object):
     def validate(self, value):
         self.validator.validate(value, self)
 
+    def validate_many(self, values):
+        """ Validates a list of values, returning a ResourceException or None for each """
+        return self.validator.validate_many(values, self)
+
+    def coerce(self, value):
+        """
+        Validates a value received from the API and converts it into the value
+        to be written to the database using the _writer() function. When the
+        validator and writer are the ones from the attribute's type, the type
+        does both in one step (see SofaType.coerce), so the value is only parsed
+        once.
+        """
+        if self.validator is self.type.validator \
+           and 'validate' not in self.validator.__dict__ \
+           and self.__dict__.get('_writer') is self.type.writer:
+            return self.type.coerce(value, self)
+        self.validate(value)
+        return exec_function(self._writer)(value)
+
     def check_authorization(self, request, target=None, auth_func=None):
-        if not target:
-            target = self.cls
+        with timed(request, 'auth'):
+            if not target:
+                target = self.cls
 
-        if not auth_func:
-            auth_func = self.auth
-        if not auth_func:
-            return True
+            if not auth_func:
+                auth_func = self.auth
+            if not auth_func:
+                return True
 
-        # An auth function could take an auth context, a context and a target
-        # that we're authorizing against, or nothing at all. Try to provide the
-        # right parameters based on the number of params the function has
-        auth_func_param_names = func_params(auth_func)
-        if not auth_func_param_names:
-            auth_function_out = exec_function(auth_func)
-        elif len(auth_func_param_names) == 1:
-            auth_function_out = exec_function(auth_func)(get_auth_context(request))
-        else:
-            auth_function_out = exec_function(auth_func)(get_auth_context(request), target)
+            # An auth function could take an auth context, a context and a target
+            # that we're authorizing against, or nothing at all. Try to provide the
+            # right parameters based on the number of params the function has
+            auth_func_param_names = func_params(auth_func)
+            if not auth_func_param_names:
+                auth_function_out = exec_function(auth_func)
+            elif len(auth_func_param_names) == 1:
+                auth_function_out = exec_function(auth_func)(get_auth_context(request))
+            else:
+                auth_function_out = exec_function(auth_func)(get_auth_context(request), target)
 
-        if isinstance(auth_function_out, collections.Sequence):
-            # We got a list of stuff (since the lambdas returns are designed
-            # to be compatible with SQLAlchemy filters, i.e. the lambda might
-            # be like "condition1, condition2, condition3"). If this is a list
-            # of booleans, flatten it
-            if all([isinstance(x, bool) for x in auth_function_out]):
-                auth_function_out = all(auth_function_out)
+            if isinstance(auth_function_out, collections.Sequence):
+                # We got a list of stuff (since the lambdas returns are designed
+                # to be compatible with SQLAlchemy filters, i.e. the lambda might
+                # be like "condition1, condition2, condition3"). If this is a list
+                # of booleans, flatten it
+                if all([isinstance(x, bool) for x in auth_function_out]):
+                    auth_function_out = all(auth_function_out)
 
-        return auth_function_out
+            return auth_function_out
 
     def _determine_visibility(self, request, target=None):
         if not self.readable:
@@ -246,6 +315,101 @@ class APIAttribute(object):
                     self._determine_visibility(request, target)
             return cache[(id(self), id(request), target)]
 
+    def auth_condition(self, request):
+        """
+        Returns which resources the attribute is visible for to the caller:
+        True if all of them, False if none, a SQL expression that is true for
+        the rows it is visible for (if the attribute was declared with
+        auth_sql), or None if the auth function has to be called for each
+        resource
+        """
+        if self.auth and len(func_params(self.auth)) >= 2 and not self.auth_sql:
+            # The auth function takes a target, which may only be an instance
+            if not self.readable or not all(param['name'] in request.GET
+                                            for param in self.dynamic_params):
+                return False
+            return None
+        if not self.is_visible(request):
+            return False
+        if not self.auth:
+            return True
+        auth_function_out = self.check_authorization(request)
+        if self.auth_sql:
+            condition = sql_condition(auth_function_out)
+            if condition is not None:
+                return condition
+        if isinstance(auth_function_out, collections.Sequence):
+            return all(auth_function_out)
+        return bool(auth_function_out)
+
+
+def is_sql(value):
+    """ Returns whether `value` is a SQLAlchemy expression (or mapped attribute) """
+    return isinstance(value, ClauseElement) or hasattr(value, '__clause_element__')
+
+def sql_condition(auth_function_out):
+    """
+    Returns the SQL expression an auth function returned (a list of them and
+    of booleans is combined with AND), or None if it didn't return one
+    """
+    if is_sql(auth_function_out):
+        return auth_function_out
+    if isinstance(auth_function_out, collections.Sequence) \
+       and any(is_sql(value) for value in auth_function_out):
+        return and_(*[ value if is_sql(value) else (true() if value else false())
+                       for value in auth_function_out ])
+    return None
+
+def visibility_flag(condition):
+    """ Returns a SQL expression selecting whether `condition` holds for a row """
+    return case([(condition, true())], else_=false())
+
+def _evaluate_conditions(resources, conditions):
+    """
+    Returns, for each SQL condition in `conditions`, the list of whether it
+    holds for each of `resources` (loaded resources of the same class),
+    using one query per 500 resources
+    """
+    cls = resources[0].__class__
+    primary_key = getattr(cls, cls.primary_key_name())
+    keys = [ getattr(resource, cls.primary_key_name()) for resource in resources ]
+    session = object_session(resources[0]) or sqla_session(resources[0].__request__)
+    flags = {}
+    for start in range(0, len(keys), 500):
+        query = session.query(primary_key, *[ visibility_flag(condition) for condition in conditions ])
+        for row in query.filter(primary_key.in_(keys[start:start+500])):
+            flags[row[0]] = row[1:]
+    return [ [ bool(flags[key][j]) if key in flags else False for key in keys ]
+             for j in range(len(conditions)) ]
+
+
+def compile_validator(func):
+    """
+    Returns a function taking (value, attr) that calls the validator function
+    `func`. Quick-and-dirty validator functions may take only `value`; their
+    arity is checked here once, rather than on every call.
+    """
+    try:
+        args, varargs, keywords, defaults = getargspec(func)
+    except TypeError:
+        # Not a Python function (e.g. a builtin or a callable object); assume
+        # it takes both arguments
+        return func
+    if ismethod(func) and func.__self__ is not None:
+        args = args[1:]
+    if len(args) == 1 and not varargs:
+        return lambda value, attr: func(value)
+    return func
+
+def chain_validators(validators):
+    """ Returns one function taking (value, attr) that runs each validator in turn """
+    if len(validators) == 1:
+        return validators[0]
+    def run_chain(value, attr):
+        for validate in validators:
+            validate(value, attr)
+    return run_chain
+
 
 class APIValidator(object):
     def validate(self, value, attr):
@@ -255,65 +419,89 @@ class APIValidator(object):
         """
         pass
 
+    def validate_many(self, values, attr):
+        """
+        Validates each value in the list `values`, returning a list with the
+        ResourceException raised for each value (or None if it is valid).
+        Validators that can check many values at once (e.g. uniqueness with
+        one query) override this.
+        """
+        errors = []
+        for value in values:
+            try:
+                self.validate(value, attr)
+            except ResourceException, e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
     def validator(self, func):
         """
         Decorator to change the class's validate function
         """
-        obj = self
-        obj.validate = func
-        return obj
+        self._chain = [self._compile(func)]
+        self.validate = self._chain[0]
+        return self
 
     def extend(self, func):
         """
         Decorator to change the class's validate function. This will
         use the class's existing validate function, and then perform
-        func on top of it.
+        func on top of it. Repeated extensions are kept in one flat list,
+        rather than wrapping the previous function each time.
         """
-        old_validator = object.__getattribute__(self, 'validate')
-        def new_validator(*args, **kwargs):
-            old_validator(*args, **kwargs)
-            func(*args, **kwargs)
-        obj = self
-        obj.validate = new_validator
-        return obj
+        self._chain = getattr(self, '_chain', [self.validate]) + [self._compile(func)]
+        self.validate = chain_validators(self._chain)
+        return self
 
     def __init__(self, func=None):
         # If func is specified, we will use it as the validation function
         if func:
-            self.validate = func
-
-    # The following two functions are an ugly hack so that we can override
-    # validatorobj.validate, but if that happens to be a lambda from the API
-    # config (in the form of a string) and something tries to call it, it won't
-    # freak out (because strings obviously aren't callable)
-    def _exec_validator(self, value, attr):
-        try:
-            exec_function(object.__getattribute__(self, 'validate'))(value, attr)
-        except TypeError, e:
-            if 'takes exactly' in e:
-                # This might be a quick-and-dirty validator function that
-                # doesn't care for `attr`
-                exec_function(object.__getattribute__(self, 'validate'))(value)
-            else:
-                raise
-
-    def __getattribute__(self, key):
-        if key == 'validate':
-            return self._exec_validator
-        else:
-            return object.__getattribute__(self, key)
+            self.validator(func)
+
+    def _compile(self, func):
+        if isinstance(func, basestring):
+            # This is a lambda from the API config. It may refer to names in
+            # an API config that hasn't been loaded yet, so it's resolved on
+            # first use
+            compiled = []
+            def resolve():
+                if not compiled:
+                    compiled.append(compile_validator(exec_function(func)))
+                return compiled[0]
+            def validate_lambda(value, attr):
+                return resolve()(value, attr)
+            validate_lambda.resolve = resolve
+            return validate_lambda
+        return compile_validator(func)
 
 
 class SofaType(object):
     """
     Encapsulates a default reader, writer, and validator for a certain type
     """
+    # Defaults for subclasses that only set some of these
+    reader = None
+    writer = None
+    validator = None
 
     def __init__(self, reader=None, writer=None, validator=None):
         self.reader = reader
         self.writer = writer
         self.validator = validator
 
+    def coerce(self, value, attr):
+        """
+        Validates a value received from the API and converts it into the value
+        to be written to the database. Types whose validators already parse the
+        value (e.g. into a datetime) override this so that the value is parsed
+        only once.
+        """
+        if self.validator:
+            self.validator.validate(value, attr)
+        return exec_function(self.writer)(value) if self.writer else value
+
     def __repr__(self):
         return "<SofaType(reader=%r, writer=%r, validator=%r)>" % (self.reader, self.writer, self.validator)
 
@@ -353,22 +541,33 @@ def remove_circular_references(response_dict, refs, request, depth=0):
     return response_dict
 
 
+class RequestAttribute(object):
+    """
+    Descriptor for the __request__ attribute of resources: the Pyramid request
+    set by the resource's traversal parent or, for resources that weren't
+    reached by traversal (e.g. loaded by SQLAlchemy for a list or a
+    relationship), the current request at the time it's read. Looking the
+    request up when it's needed, rather than as each row is loaded, keeps large
+    loads cheap, and keeps resources cached between requests from holding on
+    to the request they were loaded in.
+    """
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return None
+        request = instance.__dict__.get('_sofa_request')
+        return request if request is not None else get_current_request()
+
+    def __set__(self, instance, request):
+        instance.__dict__['_sofa_request'] = request
+
+
 class APIResource(object):
 
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
     updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    __request__ = None    # Pyramid request object should be set by traversal parent
-
-    # re 6/18/15 this is a really ugly hack to set the __request__ attribute
-    # when the object wasn't produced via traversal, but was instead loaded by
-    # SQLAlchemy and is now being used in the API. In this case, there would be
-    # no parent that we have control over to set __request__, but the resource
-    # might still try to use that... Pyramid strongly discourages use of
-    # get_current_request, so a different solution would be better
-    @orm.reconstructor
-    def load_request(self):
-        self.__request__ = get_current_request()
+    __request__ = RequestAttribute()
 
     @classmethod
     def primary_key_name(cls):
@@ -383,44 +582,50 @@ class APIResource(object):
             target = target[key]
         return target
 
+    @classmethod
+    def allows_replica_reads(cls):
+        """ Returns False if the resource opted out of read replicas in api.yaml (`replica: false`) """
+        return api_config()[cls.__name__].get('replica', True)
+
     @classmethod
     def get_api_attr(cls, name):
         return next(attr for attr in cls.get_api_config('attrs') if attr.key == name)
 
     def check_authorization(self, request, auth_func, raise_exc=True):
-        if not auth_func:
-            # No auth func specified
-            return True
+        with timed(request, 'auth'):
+            if not auth_func:
+                # No auth func specified
+                return True
 
-        # An auth function could take an auth context, a context and a target
-        # that we're authorizing against, or nothing at all. Try to provide the
-        # right parameters based on the number of params the function has
-        auth_func_param_names = func_params(auth_func)
-        if not auth_func_param_names:
-            auth_function_out = exec_function(auth_func)
-        elif len(auth_func_param_names) == 1:
-            auth_function_out = exec_function(auth_func)(get_auth_context(request))
-        else:
-            auth_function_out = exec_function(auth_func)(get_auth_context(request), self)
+            # An auth function could take an auth context, a context and a target
+            # that we're authorizing against, or nothing at all. Try to provide the
+            # right parameters based on the number of params the function has
+            auth_func_param_names = func_params(auth_func)
+            if not auth_func_param_names:
+                auth_function_out = exec_function(auth_func)
+            elif len(auth_func_param_names) == 1:
+                auth_function_out = exec_function(auth_func)(get_auth_context(request))
+            else:
+                auth_function_out = exec_function(auth_func)(get_auth_context(request), self)
 
-        if isinstance(auth_function_out, collections.Sequence):
-            # We got a list of booleans (since the lambdas returns are designed
-            # to be compatible with SQLAlchemy filters, i.e. the lambda might
-            # be like "condition1, condition2, condition3"). Convert this to
-            # "condition1 and condition2 and condition3"
-            auth_function_out = all(auth_function_out)
-
-        if not auth_function_out:
-            if raise_exc:
-                raise ResourceException(403,
-                                        'unauthorized_caller',
-                                        'You do not have sufficient privileges to perform ' + \
-                                        'this action.')
-            return False
-        if auth_function_out is not True:
-            log.warning('The auth function for {} returned a non-boolean value!', self)
+            if isinstance(auth_function_out, collections.Sequence):
+                # We got a list of booleans (since the lambdas returns are designed
+                # to be compatible with SQLAlchemy filters, i.e. the lambda might
+                # be like "condition1, condition2, condition3"). Convert this to
+                # "condition1 and condition2 and condition3"
+                auth_function_out = all(auth_function_out)
+
+            if not auth_function_out:
+                if raise_exc:
+                    raise ResourceException(403,
+                                            'unauthorized_caller',
+                                            'You do not have sufficient privileges to perform ' + \
+                                            'this action.')
+                return False
+            if auth_function_out is not True:
+                log.warning('The auth function for {} returned a non-boolean value!', self)
         
-        return True
+            return True
 
     @classmethod
     def create(cls, post_params, parent, request, defaults={}):
@@ -438,16 +643,13 @@ class APIResource(object):
         # to the resource object's __init__ function after validation succeeds
         init_params = {}
 
-        required_fields = cls.get_api_config('create', 'required_fields')
-        optional_fields = cls.get_api_config('create', 'optional_fields')
-
-        # If the parent collection supplies defaults, remove them from the acceptable fields
-        for key, value in defaults.iteritems():
-            if key in required_fields:
-                required_fields.remove(key)
-            if key in optional_fields:
-                optional_fields.remove(key)
-            init_params[key] = value
+        # If the parent collection supplies defaults, remove them from the acceptable
+        # fields (without modifying the lists in the API config, which are shared)
+        required_fields = [ field for field in cls.get_api_config('create', 'required_fields')
+                            if field not in defaults ]
+        optional_fields = [ field for field in cls.get_api_config('create', 'optional_fields')
+                            if field not in defaults ]
+        init_params.update(defaults)
 
         # Go through mandatory parameters
         for field in required_fields:
@@ -488,67 +690,112 @@ class APIResource(object):
         log.debug("Created {} {}".format(cls.__name__, obj))
         return obj
 
+    @classmethod
+    def validate_payloads(cls, payloads, action='create', defaults={}):
+        """
+        Validates a list of payloads (dictionaries like the post_params passed to
+        create or update) without creating or changing anything, e.g. before a
+        bulk import. The values are validated one field at a time across all of
+        the payloads, so validators can check a whole column at once (unique
+        fields are checked with one query per field rather than one per value).
+        Returns a list with every ResourceException found in each payload, in
+        the same order as `payloads`; valid payloads have an empty list.
+        """
+        if action == 'create':
+            required_fields = [ field for field in cls.get_api_config('create', 'required_fields')
+                                if field not in defaults ]
+            fields = required_fields + [ field for field
+                                         in cls.get_api_config('create', 'optional_fields')
+                                         if field not in defaults ]
+        elif action == 'update':
+            required_fields = []
+            fields = [ attr.key for attr in cls.get_api_config('attrs') if attr.writable ]
+        else:
+            raise ValueError('Cannot validate payloads for the %r action' % action)
+
+        errors = [ [] for payload in payloads ]
+        for payload, payload_errors in zip(payloads, errors):
+            for field in required_fields:
+                if field not in payload:
+                    payload_errors.append(ResourceException(400, 'bad_'+field,
+                                                            'The %s field is mandatory.' % field))
+            unrecognized_keys = set(payload.keys()) - set(fields)
+            if unrecognized_keys:
+                payload_errors.append(ResourceException(400, 'unrecognized_fields',
+                                                        'The following key(s) are not recognized ' + \
+                                                        'fields for this resource: %s.' \
+                                                        % ', '.join(unrecognized_keys)))
+        for field in fields:
+            rows = [ i for i, payload in enumerate(payloads) if field in payload ]
+            if not rows:
+                continue
+            field_errors = cls.get_api_attr(field).validate_many([ payloads[i][field] for i in rows ])
+            for i, error in zip(rows, field_errors):
+                if error is not None:
+                    errors[i].append(error)
+        return errors
+
+    @classmethod
+    def default_attrs(cls):
+        """ Returns the attributes every resource has (its creation and update times) """
+        attrs = _default_attrs.get(cls)
+        if attrs is None:
+            attrs = _default_attrs[cls] = [
+                APIAttribute('created_at', writable=False, reader=datetime_reader, cls=cls),
+                APIAttribute('updated_at', writable=False, reader=datetime_reader, cls=cls)]
+        return attrs
+
     def __json__(self, request, remove_circular_refs=True):
         """
         Creates and returns a dictionary with all keys and values of this resource's
         public attributes, for rendering to JSON (used in GET requests)
         """
-        default_attrs = [APIAttribute('created_at', writable=False,
-                                      reader=lambda x: x.strftime("%Y-%m-%dT%H:%M:%SZ") if x
-                                                       else None,
-                                      cls=self.__class__),
-                         APIAttribute('updated_at', writable=False,
-                                      reader=lambda x: x.strftime("%Y-%m-%dT%H:%M:%SZ") if x
-                                                       else None,
-                                      cls=self.__class__)]
-        to_return = { attr.key:attr.read(self) for attr
-                                               in default_attrs + self.get_api_config('attrs')
-                                               if attr.is_visible(self.__request__, target=self)
-                                               and self.check_authorization(self.__request__, attr.auth, raise_exc=False) }
+        to_return = _read_rows([self], request if request is not None else self.__request__)[0]
         return remove_circular_references(to_return, [self], request) if remove_circular_refs else to_return
 
     def __getitem__(self, key):
-        log.info('Getting key {} on {}...'.format(key, self))
-        if key not in self.get_api_config('children').keys():
-            # other_actions = self.get_api_config()
-            # [other_actions.pop(key, None) for key in ['group_name', 'attrs', 'children',
-            #                                           'list', 'create', 'read', 'update',
-            #                                           'delete', 'auth']]
-            # dynamic_subpaths = [ action['url'] for key, action in other_actions.iteritems()
-            #                      if 'url' in action ]
-            # from pprint import pformat
-            # raise Exception(pformat(dynamic_subpaths))
-            raise ResourceException(404,
-                                     'child_not_found',
-                                     'No child "%s" could be found in this resource.' \
-                                     % key)
-        target = self.get_api_config('children', key)
-        if isinstance(target, dict):
-            # Child is a subcollection
-            log.info('The requested key is a subcollection. Authorizing...')
-            self.check_authorization(self.__request__, target['auth'])
-            log.info('Returning...')
-            target = APICollection(target['references'], parent=self,
-                                   secondary=target.get('secondary', None),
-                                   default_pk=target.get('default_pk', None),
-                                   defaults=target.get('defaults', {}),
-                                   foreign_key=target.get('foreign_key', None),
-                                   association_handler=target.get('association_handler', None),
-                                   disassociation_handler=target.get('disassociation_handler',
-                                                                     None),
-                                   delete_behavior=target.get('delete_behavior', 'delete'),
-                                   **target.get('filters', {}))
-            target.__traversal_parent__ = self
-            target.__request__ = self.__request__
-            return target
-        else:
-            # Child is a child resource
-            log.info('The requested key is a direct APIResource. Returning...')
-            # Set parent reference, so resource can be context-sensitive
-            item = getattr(self, key)
-            item.__traversal_parent__ = self
-            item.__request__ = self.__request__
-            return item
+        with timed(self.__request__, 'traversal'):
+            log.info('Getting key {} on {}...'.format(key, self))
+            if key not in self.get_api_config('children').keys():
+                # other_actions = self.get_api_config()
+                # [other_actions.pop(key, None) for key in ['group_name', 'attrs', 'children',
+                #                                           'list', 'create', 'read', 'update',
+                #                                           'delete', 'auth']]
+                # dynamic_subpaths = [ action['url'] for key, action in other_actions.iteritems()
+                #                      if 'url' in action ]
+                # from pprint import pformat
+                # raise Exception(pformat(dynamic_subpaths))
+                raise ResourceException(404,
+                                         'child_not_found',
+                                         'No child "%s" could be found in this resource.' \
+                                         % key)
+            target = self.get_api_config('children', key)
+            if isinstance(target, dict):
+                # Child is a subcollection
+                log.info('The requested key is a subcollection. Authorizing...')
+                self.check_authorization(self.__request__, target['auth'])
+                log.info('Returning...')
+                target = APICollection(target['references'], parent=self,
+                                       secondary=target.get('secondary', None),
+                                       default_pk=target.get('default_pk', None),
+                                       defaults=target.get('defaults', {}),
+                                       foreign_key=target.get('foreign_key', None),
+                                       association_handler=target.get('association_handler', None),
+                                       disassociation_handler=target.get('disassociation_handler',
+                                                                         None),
+                                       delete_behavior=target.get('delete_behavior', 'delete'),
+                                       **target.get('filters', {}))
+                target.__traversal_parent__ = self
+                target.__request__ = self.__request__
+                return target
+            else:
+                # Child is a child resource
+                log.info('The requested key is a direct APIResource. Returning...')
+                # Set parent reference, so resource can be context-sensitive
+                item = getattr(self, key)
+                item.__traversal_parent__ = self
+                item.__request__ = self.__request__
+                return item
 
     def update(self, post_params):
         """
@@ -571,16 +818,17 @@ class APIResource(object):
         keys_to_update = set(writable_attrs.keys()).intersection(post_params.keys())
         if not keys_to_update:
             raise HTTPNotModified
-        # Validate all the changes before making any of them
+        # Validate and convert all the changes before making any of them
+        values = {}
         for key in keys_to_update:
             try:
-                writable_attrs[key].validate(post_params[key])
+                values[key] = writable_attrs[key].coerce(post_params[key])
             except ResourceException as e:
                 e.message = e.message.strip() + ' No data has been modified.'
                 raise e
         # Try updating
         for key in keys_to_update:
-            writable_attrs[key].write(self, post_params[key])
+            writable_attrs[key].set(self, values[key])
             # Mark this resource as updated
             self.updated_at = datetime.utcnow()
         log.debug('Successfully updated {}'.format(self))
@@ -597,8 +845,96 @@ class APIResource(object):
                                                              self.__request__)
         else:
             log.debug('Deleting {}'.format(self))
-            sqla_session().delete(self)
+            sqla_session(self.__request__).delete(self)
+
 
+# Types of attribute values that never need remove_circular_references
+_scalar_types = frozenset([type(None), bool, int, long, float, str, unicode])
+
+# Maps resource classes to their default attributes (see APIResource.default_attrs)
+_default_attrs = {}
+
+def _attr_conditions(cls, request):
+    """
+    Returns (attribute, auth condition) for each public attribute of the
+    resource class `cls` (see APIAttribute.auth_condition)
+    """
+    return [ (attr, attr.auth_condition(request))
+             for attr in cls.default_attrs() + cls.get_api_config('attrs') ]
+
+def _sql_conditions(attrs):
+    """ Returns the auth conditions in `attrs` (see _attr_conditions) that are SQL expressions """
+    return [ condition for attr, condition in attrs
+             if condition is not True and condition is not False and condition is not None ]
+
+def _read_columns(resources, request, attrs=None, flags=None):
+    """
+    Reads the public attributes of a list of resources of the same class for
+    `request`. Each attribute is read for all of the resources at once (see
+    APIAttribute.read_many), so a reader runs once per column rather than once
+    per resource. Returns a list of (key, indexes, values) for each attribute
+    visible to the caller, where `indexes` lists the resources the attribute is
+    visible for (None if it is visible for all of them) and `values` holds
+    their values. If the resources were loaded along with whether their SQL
+    auth conditions hold (see APICollection.visible_items_with_flags), pass
+    the `attrs` and `flags` that were used.
+    """
+    cls = resources[0].__class__
+    if attrs is None:
+        attrs = _attr_conditions(cls, request)
+    flags = dict(flags or {})
+    expressions = [ condition for condition in _sql_conditions(attrs) if id(condition) not in flags ]
+    if expressions and len(resources) == 1:
+        # The auth functions can be called with a single resource instead of
+        # querying the database, as long as they return a plain value for it
+        pending = set(map(id, expressions))
+        for attr, condition in attrs:
+            if id(condition) in pending:
+                auth_function_out = attr.check_authorization(request, target=resources[0])
+                if sql_condition(auth_function_out) is None:
+                    if isinstance(auth_function_out, collections.Sequence):
+                        auth_function_out = all(auth_function_out)
+                    flags[id(condition)] = [bool(auth_function_out)]
+        expressions = [ condition for condition in expressions if id(condition) not in flags ]
+    if expressions:
+        # The rest are evaluated by the database, all in one query
+        flags.update(zip(map(id, expressions), _evaluate_conditions(resources, expressions)))
+    columns = []
+    for attr, condition in attrs:
+        if condition is True:
+            # Visibility doesn't depend on the resource, so it's only checked once
+            visible = None
+        elif condition is False:
+            continue
+        else:
+            if condition is None:
+                visible = [ i for i, resource in enumerate(resources)
+                            if attr.is_visible(request, target=resource)
+                            and resource.check_authorization(request, attr.auth, raise_exc=False) ]
+            else:
+                visible = [ i for i, flag in enumerate(flags[id(condition)]) if flag ]
+            if not visible:
+                continue
+            if len(visible) == len(resources):
+                visible = None
+        if visible is None:
+            values = attr.read_many(resources, request)
+        else:
+            values = attr.read_many([ resources[i] for i in visible ], request)
+        columns.append((attr.key, visible, values))
+    return columns
+
+def _read_rows(resources, request, attrs=None, flags=None):
+    """ Reads the public attributes of a list of resources into a dictionary for each """
+    return _build_rows(_read_columns(resources, request, attrs, flags), len(resources))
+
+def _build_rows(columns, count):
+    """ Turns the columns of `count` resources (see _read_columns) into a dictionary for each """
+    rows = [ {} for i in range(count) ]
+    for key, visible, values in columns:
+        for i, value in zip(visible or range(count), values):
+            rows[i][key] = value
+    return rows
 
 class RegistryMeta(type):
     def __init__(cls, name, bases, attrs):
@@ -644,6 +980,8 @@ class APICollection(object):
         if isinstance(resource, basestring):
             resource = get_resource(resource)
         self.resource = resource
+        # Used by the index advisor to record which filters are used in practice
+        self.filter_shape = (resource.__name__, tuple((k, op) for k, op, v in filters), sort_by)
         # Prepare the SQLAlchemy query that will be used based on parent
         if parent:
             # We need to assemble relationship between the parent class and the child
@@ -717,6 +1055,10 @@ class APICollection(object):
                 log.debug('Found target column %r' % matching_columns[0])
                 query_target = [resource, parent.__class__]
                 query_constraints = [matching_columns[0]==getapiattr(parent, parent_primary_key).get_class_attr(self.__request__)]
+            # The constraints above only join the tables; limit the collection
+            # to this parent's children
+            query_constraints.append(getattr(parent.__class__, parent_primary_key) ==
+                                     getattr(parent, parent_primary_key))
         else:
             query_target = [resource]
             query_constraints = []
@@ -752,18 +1094,35 @@ class APICollection(object):
         # e.g. filters specified in `filters` override filters specified in
         # `kwargs` which override filters specified in `default_filters`
         hard_filters = [ (key, '=', value) for key, value in kwargs.iteritems() if key not in [k for k,o,v in filters] ] + filters
-        soft_filters = [ (key, '=', value) for key, value in resource.get_api_config()['default_filters'].iteritems() if key not in [k for k,o,v in hard_filters] ] + hard_filters
+        default_filters = [ (key, '=', value) for key, value in resource.get_api_config()['default_filters'].iteritems() if key not in [k for k,o,v in hard_filters] ]
+        soft_filters = default_filters + hard_filters
         # Convert these lists of "tuple-filters" into filterable SQLAlchemy
-        # expressions
+        # expressions. Each value is validated and converted only once, even
+        # though the hard filters are in both lists (keyed by the filter
+        # tuple's id); default_filters values were already converted when the
+        # API config was loaded
+        converted_values = { id(tuple_filter): tuple_filter[2] for tuple_filter in default_filters }
         soft_query_constraints = list(query_constraints)
+        search_rank = None
         for tuple_filter_list, expression_filter_list in [(hard_filters, query_constraints), (soft_filters, soft_query_constraints)]:
-            for key, op, value in tuple_filter_list:
+            for tuple_filter in tuple_filter_list:
+                key, op, value = tuple_filter
                 try:
                     apiattr = getapiattr(resource, key)
                 except AttributeError:
                     raise AttributeError("Class {} has no attribute {}.".format(resource.__name__, key))
-                apiattr.validate(value)
-                value = exec_function(apiattr._writer)(value)
+                search_backend = get_search_backend(resource) if op == ':' and apiattr.search else None
+                if search_backend and search_backend.has_terms(value):
+                    # Use the full-text index instead of a LIKE scan. The
+                    # first searched attribute determines relevance ordering
+                    apiattr.validate(value)
+                    expression_filter_list.append(search_backend.match(apiattr, value))
+                    if search_rank is None:
+                        search_rank = search_backend.rank(apiattr, value)
+                    continue
+                if id(tuple_filter) not in converted_values:
+                    converted_values[id(tuple_filter)] = apiattr.coerce(value)
+                value = converted_values[id(tuple_filter)]
                 if op == ':':
                     expression_filter_list.append(apiattr.get_class_attr(self.__request__).like(value))
                 elif op == '=':
@@ -779,7 +1138,12 @@ class APICollection(object):
                 else:
                     raise ValueError('The operator %r is invalid' % op)
         # sort_by support
-        if sort_by:
+        sort_expression = None
+        if sort_by == 'relevance' and search_rank is not None \
+          and not any(attr.key == sort_by for attr in resource.get_api_config()['attrs']):
+            # Order full-text search results by how well they match
+            sort_expression = search_rank
+        elif sort_by:
             target_attr = next((attr for attr in resource.get_api_config()['attrs'] if attr.is_visible(self.__request__) and attr.key == sort_by), None)
             target_attr_auth = target_attr.check_authorization(self.__request__) if target_attr else False
             if isinstance(target_attr_auth, bool) and not target_attr_auth:
@@ -798,17 +1162,23 @@ class APICollection(object):
                     soft_query_constraints.append(target_attr_auth)
         else:
             sort_by = resource.primary_key_name()
+        if sort_expression is None:
+            sort_expression = getapiattr(resource, sort_by).get_class_attr(self.__request__)
         # sort_dir support
         if not sort_dir or sort_dir.lower() in ['asc', 'a', 'ascending']:
-            query_order_by = getapiattr(resource, sort_by).get_class_attr(self.__request__)
+            query_order_by = sort_expression
         elif sort_dir.lower() in ['desc', 'd', 'descending']:
-            query_order_by = getapiattr(resource, sort_by).get_class_attr(self.__request__).desc()
+            query_order_by = sort_expression.desc()
         else:
             raise ResourceException(400, 'bad_sort_dir',
                 '\"{}\" is not a valid sort direction.'.format(sort_dir))
         # Construct SQLA query
         self.query_target = query_target
-        self.query = sqla_session().query(query_target[0])
+        # Child collections are created before their __request__ is set
+        request = self.__request__ if self.__request__ is not None \
+                  else getattr(parent, '__request__', None)
+        self.query = sqla_session(request, read_only=resource.allows_replica_reads()) \
+                         .query(query_target[0])
         if len(query_target) > 1:
             for target in query_target[1:]:
                 self.query = getattr(self.query, 'join')(target)
@@ -835,6 +1205,7 @@ class APICollection(object):
     def add(self, resource, key):
         if self.association_handler:
             log.debug('Calling association handler for {}'.format(self))
+            import transaction
             with transaction.manager:
                 self.association_handler(resource, self.parent, self.__request__)
             log.debug('Association handler called')
@@ -854,24 +1225,210 @@ class APICollection(object):
         return self.items == x
 
     def __getitem__(self, key):
-        DBSession = sqla_session()
-        item = DBSession.query(self.resource).get(key)
-        if item is None or (item not in self.items and self.__request__.method != 'PUT'):
-            raise ResourceException(404,
-                                     'resource_not_found',
-                                     'No resource "%s" could be found in this collection.' \
-                                     % key)
-        elif item not in self.items and self.__request__.method == 'PUT':
-            # Try associating adding the resource to this collection
-            return self.add(DBSession.query(self.resource).get(key), key)
-        else:
-            # Set parent reference, so resource can be context-sensitive
-            item.__traversal_parent__ = self
-            item.__request__ = self.__request__
-            return item
+        with timed(self.__request__, 'traversal'):
+            DBSession = sqla_session(self.__request__,
+                                     read_only=self.resource.allows_replica_reads())
+            item = DBSession.query(self.resource).get(key)
+            if item is None or (item not in self.items and self.__request__.method != 'PUT'):
+                raise ResourceException(404,
+                                         'resource_not_found',
+                                         'No resource "%s" could be found in this collection.' \
+                                         % key)
+            elif item not in self.items and self.__request__.method == 'PUT':
+                # Try associating adding the resource to this collection
+                return self.add(DBSession.query(self.resource).get(key), key)
+            else:
+                # Set parent reference, so resource can be context-sensitive
+                item.__traversal_parent__ = self
+                item.__request__ = self.__request__
+                return item
 
     def __json__(self, request):
         """ List resources in collection """
+        plain_columns = self.read_plain_columns(request)
+        if plain_columns is not None:
+            count, columns = plain_columns
+            return _build_rows(columns, count)
+        attrs = _attr_conditions(self.resource, request)
+        items, flags = self.visible_items_with_flags(request, attrs)
+        if not items or not self.serializes_columns(items):
+            return items
+        return [ remove_circular_references(row, [item], request)
+                 for row, item in zip(_read_rows(items, request, attrs, flags), items) ]
+
+    def columns(self, request):
+        """
+        Lists resources in collection in columnar form: the keys of the
+        attributes returned, and for each attribute the list of its values
+        (None where it isn't visible for a resource), in the same order for
+        every attribute
+        """
+        plain_columns = self.read_plain_columns(request)
+        if plain_columns is not None:
+            count, read_columns = plain_columns
+            items = None
+        else:
+            attrs = _attr_conditions(self.resource, request)
+            items, flags = self.visible_items_with_flags(request, attrs)
+            if items and not self.serializes_columns(items):
+                rows = [ item.__json__(request) for item in items ]
+                attrs = sorted(set(key for row in rows for key in row))
+                return {'attrs': attrs,
+                        'columns': { key: [ row.get(key) for row in rows ] for key in attrs }}
+            count = len(items)
+            read_columns = _read_columns(items, request, attrs, flags) if items else []
+        if not count:
+            return {'attrs': [], 'columns': {}}
+        attrs = []
+        columns = {}
+        for key, visible, values in read_columns:
+            if visible is None:
+                column = list(values)
+            else:
+                column = [None] * count
+                for i, value in zip(visible, values):
+                    column[i] = value
+            if items is not None:
+                for i, value in enumerate(column):
+                    if type(value) not in _scalar_types \
+                       and isinstance(value, (APIResource, dict, list)):
+                        column[i] = remove_circular_references({key: value}, [items[i]],
+                                                               request).get(key)
+            attrs.append(key)
+            columns[key] = column
+        return {'attrs': attrs, 'columns': columns}
+
+    def plain_column_attrs(self, request):
+        """
+        Returns a list of (attribute, auth condition) for the attributes visible
+        to the caller (see APIAttribute.auth_condition) if the collection can be
+        listed from their columns alone, without loading resources: each must
+        be a plain column whose visibility is decided without calling its auth
+        function for each resource, and the resource class must neither
+        override __json__ nor use inheritance. Otherwise returns None.
+        """
+        resource = self.resource
+        mapper = resource.__mapper__
+        if getattr(resource.__json__, '__func__', None) is not APIResource.__json__.__func__ \
+           or mapper.inherits is not None or len(mapper.self_and_descendants) > 1:
+            return None
+        attrs = []
+        for attr in resource.default_attrs() + resource.get_api_config('attrs'):
+            condition = attr.auth_condition(request)
+            if condition is None:
+                return None
+            if condition is False:
+                continue
+            if attr.dynamic_params or attr.key not in mapper.column_attrs:
+                return None
+            attrs.append((attr, condition))
+        return attrs or None
+
+    def read_plain_columns(self, request):
+        """
+        Lists resources in collection by selecting just the columns of their
+        visible attributes (see plain_column_attrs), skipping the construction
+        of ORM instances. An attribute whose auth function returned a SQL
+        expression is selected as CASE WHEN <expression> THEN <column> END,
+        along with whether the expression holds, so the database masks the
+        values the caller may not see. Returns the number of resources and
+        their columns (see _read_columns), or None if the resources have to be
+        loaded instead.
+        """
+        attrs = self.plain_column_attrs(request)
+        if attrs is None:
+            return None
+        query = self.list_query(request)
+        if query is None:
+            return 0, []
+        selected = []
+        for attr, condition in attrs:
+            column = getattr(self.resource, attr.key)
+            if condition is True:
+                selected.append(column)
+            else:
+                selected.extend([case([(condition, column)]), visibility_flag(condition)])
+        primary_key = getattr(self.resource, self.resource.primary_key_name())
+        rows = []
+        seen = set()
+        for row in self.fetch(query.with_entities(primary_key, *selected)):
+            # Unlike queries for resources, queries for columns aren't made
+            # unique, so drop the repeats that joining a to-many relationship
+            # (or another table) adds
+            if row[0] not in seen:
+                seen.add(row[0])
+                rows.append(row[1:])
+        if not rows:
+            return 0, []
+        selected_columns = iter(zip(*rows))
+        columns = []
+        for attr, condition in attrs:
+            values = next(selected_columns)
+            visible = None
+            if condition is not True:
+                flags = next(selected_columns)
+                visible = [ i for i, flag in enumerate(flags) if flag ]
+                if not visible:
+                    continue
+                if len(visible) == len(rows):
+                    visible = None
+                else:
+                    values = [ values[i] for i in visible ]
+            values = attr.read_values(list(values), request)
+            for i, value in enumerate(values):
+                if type(value) not in _scalar_types \
+                   and isinstance(value, (APIResource, dict, list)):
+                    values[i] = remove_circular_references({attr.key: value}, [],
+                                                           request).get(attr.key)
+            columns.append((attr.key, visible, values))
+        return len(rows), columns
+
+    def visible_items(self, request):
+        """ Returns the resources in collection that the caller may list """
+        query = self.list_query(request)
+        if query is None:
+            return []
+        items = self.fetch(query)
+        # Items are serialized with the request passed explicitly, and their
+        # __request__ falls back to the current request (see RequestAttribute)
+        for item in items:
+            item.__traversal_parent__ = self
+        return items
+
+    def visible_items_with_flags(self, request, attrs):
+        """
+        Returns the resources in collection that the caller may list (see
+        visible_items), and whether each of the SQL auth conditions in `attrs`
+        (see _attr_conditions) holds for each of them, selected in the same
+        query, as a dictionary mapping the id of each condition to a list of
+        flags (see _read_columns)
+        """
+        expressions = _sql_conditions(attrs)
+        if not expressions:
+            return self.visible_items(request), {}
+        query = self.list_query(request)
+        if query is None:
+            return [], {}
+        items = []
+        rows = []
+        seen = set()
+        for row in self.fetch(query.add_columns(*[ visibility_flag(condition)
+                                                   for condition in expressions ])):
+            # Unlike queries for just the resources, these aren't made unique
+            if id(row[0]) not in seen:
+                seen.add(id(row[0]))
+                items.append(row[0])
+                rows.append(row[1:])
+        for item in items:
+            item.__traversal_parent__ = self
+        return items, { id(condition): [ bool(row[j]) for row in rows ]
+                        for j, condition in enumerate(expressions) }
+
+    def list_query(self, request):
+        """
+        Returns the query for the resources in collection that the caller may
+        list, or None if the caller may not list any
+        """
         auth_function = self.resource.get_api_config('list', 'auth')
         # Get SQLAlchemy constraints to apply based on read-context authorization
         if not auth_function:
@@ -880,20 +1437,21 @@ class APICollection(object):
             # An auth function could take an auth context, a context and a target
             # that we're authorizing against, or nothing at all. Try to provide the
             # right parameters based on the number of params the function has
-            auth_func_param_names = func_params(auth_function)
-            if not auth_func_param_names:
-                auth_function_out = exec_function(auth_function)
-            elif len(auth_func_param_names) == 1:
-                auth_function_out = exec_function(auth_function)(get_auth_context(request))
-            else:
-                auth_function_out = exec_function(auth_function)(get_auth_context(request), self.resource)
+            with timed(request, 'auth'):
+                auth_func_param_names = func_params(auth_function)
+                if not auth_func_param_names:
+                    auth_function_out = exec_function(auth_function)
+                elif len(auth_func_param_names) == 1:
+                    auth_function_out = exec_function(auth_function)(get_auth_context(request))
+                else:
+                    auth_function_out = exec_function(auth_function)(get_auth_context(request), self.resource)
 
             if auth_function_out is True:
                 # There is no auth function, or it's passive (returns True)
                 filters = self.soft_query_constraints
             elif auth_function_out is False:
                 # There is no auth function, or it's passive (returns False)
-                return []
+                return None
             elif isinstance(auth_function_out, collections.Sequence):
                 # Auth function returned a list or tuple of constraints
                 filters = self.soft_query_constraints + list(auth_function_out)
@@ -901,45 +1459,61 @@ class APICollection(object):
                 # Auth function returned a single constraint
                 filters = self.soft_query_constraints + [auth_function_out]
 
-        # Return filtered set of items for JSON serialization
-        items = self.query.filter(*filters).order_by(self.query_order_by).all()
-        for item in items:
-            item.__traversal_parent__ = self
-            item.__request__ = self.__request__
-        return items
+        return self.query.filter(*filters).order_by(self.query_order_by)
+
+    def fetch(self, query):
+        """ Runs a list query, recording its filter shape if that is enabled """
+        started = time.time()
+        results = query.all()
+        if filter_shape_recording():
+            from indexes import record_filter_shape
+            record_filter_shape(self.filter_shape, time.time() - started)
+        return results
+
+    def serializes_columns(self, items):
+        """
+        Returns whether `items` can be serialized column-wise (see
+        _read_columns): they must all be of the collection's resource class,
+        and that class must not override __json__
+        """
+        if getattr(self.resource.__json__, '__func__', None) is not APIResource.__json__.__func__:
+            return False
+        resource = self.resource
+        return all(item.__class__ is resource for item in items)
 
     def check_authorization(self, request, auth_func, raise_exc=True):
-        if not auth_func:
-            # No auth func specified
-            return True
+        with timed(request, 'auth'):
+            if not auth_func:
+                # No auth func specified
+                return True
 
-        # An auth function could take an auth context, a context and a target
-        # that we're authorizing against, or nothing at all. Try to provide the
-        # right parameters based on the number of params the function has
-        auth_func_param_names = func_params(auth_func)
-        if not auth_func_param_names:
-            auth_function_out = exec_function(auth_func)
-        else:
-            auth_function_out = exec_function(auth_func)(get_auth_context(request))
+            # An auth function could take an auth context, a context and a target
+            # that we're authorizing against, or nothing at all. Try to provide the
+            # right parameters based on the number of params the function has
+            auth_func_param_names = func_params(auth_func)
+            if not auth_func_param_names:
+                auth_function_out = exec_function(auth_func)
+            else:
+                auth_function_out = exec_function(auth_func)(get_auth_context(request))
 
-        if isinstance(auth_function_out, collections.Sequence):
-            # We got a list of booleans (since the lambdas returns are designed
-            # to be compatible with SQLAlchemy filters, i.e. the lambda might
-            # be like "condition1, condition2, condition3"). Convert this to
-            # "condition1 and condition2 and condition3"
-            auth_function_out = all(auth_function_out)
-
-        if not auth_function_out:
-            if raise_exc:
-                raise ResourceException(403,
-                                        'unauthorized_caller',
-                                        'You do not have sufficient privileges to perform ' + \
-                                        'this action.')
-            return False
-        if auth_function_out is not True:
-            log.warning('The auth function for {} returned a non-boolean value!', self)
+            if isinstance(auth_function_out, collections.Sequence):
+                # We got a list of booleans (since the lambdas returns are designed
+                # to be compatible with SQLAlchemy filters, i.e. the lambda might
+                # be like "condition1, condition2, condition3"). Convert this to
+                # "condition1 and condition2 and condition3"
+                auth_function_out = all(auth_function_out)
+
+            if not auth_function_out:
+                if raise_exc:
+                    raise ResourceException(403,
+                                            'unauthorized_caller',
+                                            'You do not have sufficient privileges to perform ' + \
+                                            'this action.')
+                return False
+            if auth_function_out is not True:
+                log.warning('The auth function for {} returned a non-boolean value!', self)
         
-        return True
+            return True
 
 
 class VirtualCollection(object):
@@ -976,6 +1550,7 @@ class APISession(object):
     def delete(self):
         self.active = False
         self.invalidated_at = datetime.utcnow()
+        forget_principal(self.id)
 
 
 class ContextPredicate(object):
@@ -1010,69 +1585,112 @@ class ContextPredicate(object):
             raise TypeError('ContextPredicate got unexpected context %r; ' % context \
                           + 'was expecting an APIResource or APICollection')
 
-def check_access_token(request):
-    if hasattr(request, 'sofa_access_token_verified'):
-        return request.sofa_session
-
+def access_token(request):
+    """ Returns the access token in the request's Authorization header """
     if 'Authorization' not in request.headers:
         raise ResourceException(401,
                                 'authentication_required',
                                 'You must be authenticated to perform this action.')
-    elif 'Authorization' in request.headers \
-      and request.headers['Authorization'].split(None, 1)[0].lower() != 'token':
+    elif request.headers['Authorization'].split(None, 1)[0].lower() != 'token':
         raise ResourceException(400,
                                 'bad_authorization_scheme',
                                 'The "%s" authorization scheme is not supported. ' \
                                 % request.headers['Authorization'].split(None, 1)[0] \
                                 + 'Please use an authentication token from /sessions.')
-    # Check the session ID
-    session_id = request.headers['Authorization'].split(None, 1)[-1]
-    session = session_lookup_func()(session_id)
-    if not session or not session.is_valid:
-        raise ResourceException(400,
-                                'bad_access_token',
-                                'The access token in the Authorization ' + \
-                                'header is invalid or expired.')
-    # Make sure the session hasn't expired
-    if session.expires < datetime.utcnow():
-        raise ResourceException(401,
-                                'expired_access_token',
-                                'The access token in the Authorization ' + \
-                                'header has expired.')
-    # Someone is using this session, so let's touch it
-    session.touch()
-    request.sofa_access_token_verified = True
-    request.sofa_session = session
-    return session
+    return request.headers['Authorization'].split(None, 1)[-1]
 
+def check_access_token(request):
+    with timed(request, 'auth'):
+        if hasattr(request, 'sofa_access_token_verified'):
+            return request.sofa_session
+
+        # Check the session ID
+        session_id = access_token(request)
+        session = session_lookup_func()(session_id)
+        if not session or not session.is_valid:
+            raise ResourceException(400,
+                                    'bad_access_token',
+                                    'The access token in the Authorization ' + \
+                                    'header is invalid or expired.')
+        # Make sure the session hasn't expired
+        if session.expires < datetime.utcnow():
+            raise ResourceException(401,
+                                    'expired_access_token',
+                                    'The access token in the Authorization ' + \
+                                    'header has expired.')
+        # Someone is using this session, so let's touch it (after the response,
+        # if the request is read-only)
+        from readonly import is_read_only, defer_touch
+        if is_read_only(request):
+            defer_touch(request, session)
+        else:
+            session.touch()
+        request.sofa_access_token_verified = True
+        request.sofa_session = session
+        return session
 
-class AuthContext(object):
-    """ Contains the context for authorization """
 
-    @property
-    def session_id(self):
-        return self.session.id if self.session else None
+class AuthContext(object):
+    """
+    Contains the context for authorization. The caller's details are looked
+    up the first time one of them is read, so auth functions that don't use
+    them don't cost a session lookup. Note that the caller's session is only
+    touched (and kept from expiring) when it is looked up.
+    """
 
     def __init__(self, request):
-        # Set caller info
-        if 'Authorization' not in request.headers:
-            self.session = None
-            self.caller_id = None
-            self.caller_type = None
-            self.user_type = None
-        else:
-            self.session = check_access_token(request)
-            self.caller_id = self.session.user_id
-            self.caller_type = 'user'
-            if hasattr(self.session, 'user_type'):
-                self.user_type = self.session.user_type
-            else:
-                self.user_type = None
         # Set request info
         self.http_method = request.method
         self.params = request.params
         self.request = request
 
+    @property
+    def session(self):
+        if 'Authorization' not in self.request.headers:
+            return None
+        return check_access_token(self.request)
+
+    @property
+    def session_id(self):
+        return self.session.id if self.session else None
+
+    @property
+    def principal(self):
+        """
+        The caller's Principal (see sofa.principals), or None if the request
+        has no Authorization header
+        """
+        request = self.request
+        if 'Authorization' not in request.headers:
+            return None
+        principal = getattr(request, 'sofa_principal', None)
+        if principal is None:
+            ttl = principal_cache_ttl()
+            if ttl:
+                principal = cached_principal(access_token(request), ttl)
+            if principal is None:
+                session = check_access_token(request)
+                principal = Principal(caller_id=session.user_id,
+                                      caller_type='user',
+                                      user_type=getattr(session, 'user_type', None),
+                                      expires=session.expires)
+                if ttl:
+                    cache_principal(access_token(request), principal)
+            request.sofa_principal = principal
+        return principal
+
+    @property
+    def caller_id(self):
+        return self.principal.caller_id if self.principal else None
+
+    @property
+    def caller_type(self):
+        return self.principal.caller_type if self.principal else None
+
+    @property
+    def user_type(self):
+        return self.principal.user_type if self.principal else None
+
     def __repr__(self):
         return "<AuthContext(caller=%r, method=%r, params=%r)>" \
                 % (self.caller_id, self.http_method, self.params)
@@ -0,0 +1,117 @@
+"""
+Contains per-request phase timing. When enabled (see sofa.configure), every
+request gets a RequestTimer that accumulates the time spent in traversal,
+authorization, SQL, readers, and rendering. Phases are exclusive: while one
+runs inside another (e.g. SQL during traversal), only the inner one is
+charged, so the phases never add up to more than the total. The breakdown can
+be sent in a Server-Timing header and/or passed to a callback. The timer is
+set up, and SQL statements are timed, by sofa.instrumentation.
+"""
+
+import time
+
+PHASES = ('traversal', 'auth', 'sql', 'reader', 'render')
+
+
+class RequestTimer(object):
+    """ Accumulates the time spent in each phase of a request, in seconds """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.total = None
+        self._running = []  # [phase, time resumed] of running phases, innermost last
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def is_running(self, name):
+        return any(running[0] == name for running in self._running)
+
+    def start(self, name):
+        """ Starts charging time to `name`, pausing the phase that was running """
+        now = time.time()
+        if self._running:
+            outer = self._running[-1]
+            self.add(outer[0], now - outer[1])
+        self._running.append([name, now])
+
+    def stop(self, name):
+        """
+        Stops the innermost running `name` phase (and any phases still running
+        inside it), and resumes the phase it paused
+        """
+        if not self.is_running(name):
+            return
+        now = time.time()
+        while True:
+            phase, resumed = self._running.pop()
+            self.add(phase, now - resumed)
+            if phase == name:
+                break
+        if self._running:
+            self._running[-1][1] = now
+
+    def phase(self, name):
+        if self.is_running(name):
+            # Nested in the same phase (e.g. an auth function that calls
+            # check_access_token); the outer timer already counts this
+            return _null_phase
+        return _Phase(self, name)
+
+    def finish(self):
+        if self._running:
+            self.stop(self._running[0][0])
+        self.total = time.time() - self.started
+        return self.total
+
+    def header(self):
+        """ Formats the phases as a Server-Timing header value """
+        entries = [ '%s;dur=%.2f' % (name, self.phases[name] * 1000)
+                    for name in PHASES if self.phases.get(name) ]
+        if self.total is not None:
+            entries.append('total;dur=%.2f' % (self.total * 1000))
+        return ', '.join(entries)
+
+    def __repr__(self):
+        return "<RequestTimer(%s)>" % self.header()
+
+
+class _Phase(object):
+    __slots__ = ('timer', 'name')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.start(self.name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.stop(self.name)
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_null_phase = _NullPhase()
+
+def timed(request, phase):
+    """
+    Returns a context manager that adds the time spent inside it to `phase` on
+    the request's timer. Does nothing if the request is not being timed.
+    """
+    timer = getattr(request, 'sofa_timer', None)
+    return timer.phase(phase) if timer is not None else _null_phase
+
+
+def before_render_subscriber(event):
+    timer = getattr(event.get('request'), 'sofa_timer', None)
+    if timer is not None:
+        timer.start('render')
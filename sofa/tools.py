@@ -1,10 +1,11 @@
 # Renamed to avoid potential conflicts with user imports
 import re as _re
-import cPickle as _cPickle
 
 from config import resource_class_names as _resource_class_names
 from config import get_resource as _get_resource
-from config import dependencies as _dependencies
+from config import resource_registry as _resource_registry
+from config import current_config as _current_config
+from snapshot import compile_expression as _compile_expression
 import logging as _logging
 import inspect as _inspect
 _log = _logging.getLogger(__name__)
@@ -35,94 +36,103 @@ def _core_deps():
                                   if name[0] == name[0].upper()
                                   and not name.endswith('Validator')
                                   and not name.startswith('_')})
+        # Lambdas used to be evaluated in the parser module's globals, so
+        # configs may refer to the names imported there
+        import inspect, logging
+        from pprint import pformat
+        from sqlalchemy.orm.attributes import InstrumentedAttribute
+        from structure import APIAttribute, APIValidator
+        from responses import ResourceException
+        from exceptions import ConfigurationException
+        _loaded_core_deps.update({'inspect': inspect,
+                                  'logging': logging,
+                                  'pformat': pformat,
+                                  'InstrumentedAttribute': InstrumentedAttribute,
+                                  'APIAttribute': APIAttribute,
+                                  'APIValidator': APIValidator,
+                                  'ResourceException': ResourceException,
+                                  'ConfigurationException': ConfigurationException,
+                                  'get_resource': _get_resource,
+                                  'eval_with_deps': eval_with_deps})
         return _loaded_core_deps
 
+def build_namespace(dependencies):
+    """
+    Returns the namespace that lambdas and other expressions from the API
+    config are evaluated in: the core validators, readers, writers, and types
+    (and the names the parser module used to provide), the dependencies listed in the API config, and the resource classes (which
+    take precedence, in that order)
+    """
+    namespace = {'__builtins__': __builtins__}
+    namespace.update(_core_deps())
+    namespace.update(dependencies)
+    namespace.update({ cls.__name__: cls for cls in _resource_registry() })
+    return namespace
+
 def eval_with_deps(target, dependencies=None):
     """
-    Can eval a string using dependencies listed in the API config
+    Can eval a string using dependencies listed in the API config. The string
+    is evaluated in the current config's namespace (see build_namespace), or in
+    one built from `dependencies` if given; neither is modified, so this is
+    safe to call from several threads.
     """
-    if not dependencies:
-        dependencies = _dependencies()
-    if isinstance(target, basestring):
-        # Loop until we complete successfully (i.e. dependencies successfully
-        # resolved) or we raise an exception
-        last_dependency_error = None
-        while True:
-            try:
-                return eval(target)
-            except NameError, e:
-                # Let's try resolving the dependency
-                if _re.findall("name '(\w+)' is not defined",str(e)):
-                    dep = _re.findall("name '(\w+)' is not defined",str(e))[0]
-                    if dep == last_dependency_error:
-                        # We're in a loop. The NameError must be coming from
-                        # somewhere else deeper in the code
-                        raise
-                    last_dependency_error = dep
-                    if dep in globals():
-                        # We can't import this name or it will conflict with an
-                        # existing name and potentially mess up this function.
-                        raise ImportError('Import {} conflicts with an existing name in the global namespace'.format(dep))
-                    if dep in _resource_class_names():
-                        # This is the name of a resource class. Let's try
-                        # importing it
-                        _log.debug('Importing %r from resource class list', dep)
-                        globals()[dep] = _get_resource(dep)
-                    elif dep in _core_deps():
-                        _log.debug('Importing %r from validators', dep)
-                        globals()[dep] = _core_deps()[dep]
-                    elif dep in dependencies.keys():
-                        _log.debug('Importing %r from dependency list', dep)
-                        globals()[dep] = dependencies[dep]
-                    else:
-                        # We don't know what this is.
-                        _log.error('Error while evaluating %r: %r', target, e)
-                        raise
-                else:
-                    raise
-            except Exception, e:
-                _log.error('Error while evaluating %r: %r', target, e)
-                raise
-    else:
+    if not isinstance(target, basestring):
         return target
+    namespace = build_namespace(dependencies) if dependencies \
+                else _current_config().namespace
+    code = _compile_expression(target)
+    try:
+        return eval(code, namespace)
+    except NameError, e:
+        missing = _re.findall("name '(\w+)' is not defined", str(e))
+        if missing and missing[0] in _resource_class_names():
+            # This is the name of a resource class registered after the config
+            # was loaded. Evaluate in a copy of the namespace that includes it
+            _log.debug('Importing %r from resource class list', missing[0])
+            namespace = dict(namespace)
+            namespace[missing[0]] = _get_resource(missing[0])
+            return eval(code, namespace)
+        _log.error('Error while evaluating %r: %r', target, e)
+        raise
+    except Exception, e:
+        _log.error('Error while evaluating %r: %r', target, e)
+        raise
 
-_cached_outputs = {}
-
-def exec_function(func, cache_output=True):
+def exec_function(func):
     """
     Handles the execution of a function which may or may not be a lambda
     with additional dependencies (i.e. the lambda may reference resource
     classes or other dependencies specified in the API config file). If
     this is the case, this function will attempt to resolve those dependencies.
+    Returns the function to call.
     """
-    def do_exec(*args, **kwargs):
-        key = (func, tuple(args), tuple(kwargs.iteritems()))
+    if isinstance(func, basestring):
+        # This is a lambda function. Evaluate it once per config and keep the
+        # result
+        functions = _current_config().functions
         try:
-            hash(key)
-        except TypeError:
-            key = None
-        if cache_output and key in _cached_outputs:
-            #_log.warning('Cache hit')
-            return _cached_outputs[key]
-        else:
-            #_log.warning('Cache miss')
-            if isinstance(func, basestring):
-                # This is a lambda function
-                out = eval_with_deps(func)(*args, **kwargs)
-                if key:
-                    _cached_outputs[key] = out
-                return out
-            else:
-                # This is a function in some actual code somewhere. If dependencies
-                # don't resolve, that's not our problem anymore.
-                out = func(*args, **kwargs)
-                if key:
-                    _cached_outputs[key] = out
-                return out
-    return do_exec
+            return functions[func]
+        except KeyError:
+            resolved = functions[func] = eval_with_deps(func)
+            return resolved
+    else:
+        # This is a function in some actual code somewhere. If dependencies
+        # don't resolve, that's not our problem anymore.
+        return func
+
+_func_params = {}
 
 def func_params(func):
-    if isinstance(func, basestring):
-        return _inspect.getargspec(eval(func))[0]
-    else:
-        return _inspect.getargspec(func)[0]
+    try:
+        return _func_params[func]
+    except KeyError:
+        params = _func_params[func] = _inspect.getargspec(exec_function(func))[0]
+        return params
+    except TypeError:
+        # Unhashable callable
+        return _inspect.getargspec(exec_function(func))[0]
+
+def preload_function(func):
+    """ Resolves a function (or lambda string) and its parameters ahead of its first call """
+    if func:
+        func_params(func)
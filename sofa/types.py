@@ -47,6 +47,9 @@ class Boolean(SofaType):
 		self.validator = BooleanValidator(nullable=nullable)
 		self.writer = boolean_writer
 
+	def coerce(self, value, attr):
+		return self.validator.parse(value, attr)
+
 	def __repr__(self):
 		return "<Boolean()>"
 
@@ -61,6 +64,9 @@ class Integer(SofaType):
 		self.validator = IntegerValidator(min=min, max=max, unique=unique, nullable=nullable)
 		self.writer = lambda value: int(value)
 
+	def coerce(self, value, attr):
+		return self.validator.parse(value, attr)
+
 	def __repr__(self):
 		return "<Integer(min=%r, max=%r)>" % (self.min, self.max)
 
@@ -75,6 +81,9 @@ class Float(SofaType):
 		self.validator = FloatValidator(min=min, max=max, unique=unique, nullable=nullable)
 		self.writer = lambda value: float(value)
 
+	def coerce(self, value, attr):
+		return self.validator.parse(value, attr)
+
 	def __repr__(self):
 		return "<Float(min=%r, max=%r)>" % (self.min, self.max)
 
@@ -110,6 +119,9 @@ class Date(SofaType):
 		self.reader = date_reader
 		self.writer = date_writer
 
+	def coerce(self, value, attr):
+		return self.validator.parse(value, attr)
+
 	def __repr__(self):
 		return "<Date(require_future=%r, require_past=%r)>" % (self.require_future, self.require_past)
 
@@ -123,6 +135,9 @@ class Datetime(SofaType):
 		self.reader = datetime_reader
 		self.writer = datetime_writer
 
+	def coerce(self, value, attr):
+		return self.validator.parse(value, attr)
+
 	def __repr__(self):
 		return "<Datetime(require_future=%r, require_past=%r)>" % (self.require_future, self.require_past)
 
@@ -11,44 +11,115 @@ from structure import APIValidator
 from responses import ResourceException
 from config import sqla_session
 
-from validate_email import validate_email
+# Patterns used by the validators below, compiled once
+_word_chars_re = re.compile(r'^[\w-]+$')
+_digit_re = re.compile(r'\d')
+_zip_code_re = re.compile(r'^\d{5}$')
 
 def build_unique_query(cls, key, value):
     return sqla_session().query(cls).filter(getattr(cls, key)==value)
 
+def find_existing(cls, key, values, chunk_size=500):
+    """
+    Returns the set of `values` already stored in the `key` column of `cls`'s
+    table, using one query per `chunk_size` values
+    """
+    column = getattr(cls, key)
+    values = list(set(values))
+    existing = set()
+    for start in range(0, len(values), chunk_size):
+        existing.update(row[0] for row in sqla_session().query(column)
+                                                      .filter(column.in_(values[start:start+chunk_size])))
+    return existing
+
+def duplicate_error(attr):
+    return ResourceException(400, 'duplicate_'+attr.key, "The %s field is not unique." % attr.key)
+
 
-class NumericIdValidator(APIValidator):
+class FieldValidator(APIValidator):
     """
-    Validates unique integer-based resource IDs
+    Base class for the validators below. Subclasses implement check(), which
+    validates one value (except for uniqueness, which is checked here) and
+    returns it converted to the type stored in the database.
     """
+    unique = False
+
+    def check(self, value, attr):
+        return value
+
     def validate(self, value, attr):
+        self.parse(value, attr)
+
+    def parse(self, value, attr):
+        """ Validates `value` and returns it converted by check() """
+        value = self.check(value, attr)
+        if self.unique and value is not None and build_unique_query(attr.cls, attr.key, value).first():
+            raise duplicate_error(attr)
+        return value
+
+    def validate_many(self, values, attr):
+        """
+        Validates a list of values, checking uniqueness with one query for all
+        of them (values repeated within the list are reported as duplicates
+        too). Returns a ResourceException or None for each value.
+        """
+        if getattr(self.validate, '__func__', None) is not FieldValidator.validate.__func__:
+            # validate was overridden, replaced, or extended (see
+            # APIValidator.validator), so check() isn't the whole validation
+            return super(FieldValidator, self).validate_many(values, attr)
+        errors = [None] * len(values)
+        checked = []
+        for i, value in enumerate(values):
+            try:
+                checked.append((i, self.check(value, attr)))
+            except ResourceException, e:
+                errors[i] = e
+        if self.unique:
+            existing = find_existing(attr.cls, attr.key,
+                                     [ value for i, value in checked if value is not None ])
+            seen = set()
+            for i, value in checked:
+                if value is None:
+                    continue
+                if value in existing or value in seen:
+                    errors[i] = duplicate_error(attr)
+                seen.add(value)
+        return errors
+
+
+class NumericIdValidator(FieldValidator):
+    """
+    Validates unique integer-based resource IDs
+    """
+    unique = True
+
+    def check(self, value, attr):
         if not str(value).isdigit():
             raise ResourceException(400, 'bad_'+attr.key, "The %s field is not a valid positive integer." % attr.key)
-        if build_unique_query(attr.cls, attr.key, value).first():
-            raise ResourceException(400, 'duplicate_'+attr.key, "The %s field is not unique." % attr.key)
+        return int(value)
 
 
-class StringIdValidator(APIValidator):
+class StringIdValidator(FieldValidator):
     """
     Validates unique string-based resource IDs
     """
+    unique = True
 
     def __init__(self, id_length=6):
         self.id_length = id_length
 
-    def validate(self, value, attr):
+    def check(self, value, attr):
         if value is None:
             raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot be null." % attr.key)
         value = str(value).strip()
         if len(value.strip()) != self.id_length:
             raise ResourceException(400, 'bad_'+attr.key, "The %s field must be %s characters long." % (attr.key, self.id_length))
-        if not re.match('^[\w-]+$', value.strip()):
+        if not _word_chars_re.match(value):
             raise ResourceException(400, 'bad_'+attr.key, "The %s field may only contain alphanumeric characters." % attr.key)
-        if build_unique_query(attr.cls, attr.key, value).first():
-            raise ResourceException(400, 'duplicate_'+attr.key, "The %s field is not unique." % attr.key)
+        return value
 
 
-class BooleanValidator(APIValidator):
+class BooleanValidator(FieldValidator):
     """
     Validates booleans
     """
@@ -56,15 +127,19 @@ class BooleanValidator(APIValidator):
     def __init__(self, nullable=False):
         self.nullable = nullable
 
-    def validate(self, value, attr):
-        valid_values = ['true', '1', 'false', '0']
-        if self.nullable:
-            valid_values.append(None)
-        if str(value).lower() not in valid_values:
-            raise ResourceException(400, 'bad_'+attr.key, "The %s field is invalid (%r is not a valid boolean value)." % (attr.key, value))
+    def check(self, value, attr):
+        """ Validates `value` and returns it as a bool (or None) """
+        if self.nullable and value is None:
+            return None
+        normalized = str(value).lower()
+        if normalized in ('true', '1'):
+            return True
+        elif normalized in ('false', '0'):
+            return False
+        raise ResourceException(400, 'bad_'+attr.key, "The %s field is invalid (%r is not a valid boolean value)." % (attr.key, value))
 
 
-class IntegerValidator(APIValidator):
+class IntegerValidator(FieldValidator):
     """
     Validates integers
     """
@@ -76,24 +151,24 @@ class IntegerValidator(APIValidator):
         self.unique = unique
         self.nullable = nullable
 
-    def validate(self, value, attr):
+    def check(self, value, attr):
+        """ Validates `value` and returns it as an int (or None) """
         if self.nullable and value is None:
-            return
+            return None
         try:
             value = int(value)
-            if self.min is not None and not int(value) >= self.min:
-                raise ResourceException(400, 'bad_'+attr.key, "The %s field must be at least %s." % (attr.key, self.min))
-            if self.max is not None and not int(value) <= self.max:
-                raise ResourceException(400, 'bad_'+attr.key, "The %s field must be less than %s." % (attr.key, self.max))
-            if not self.allow_negative and int(value) < 0:
-                raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot be less than zero." % attr.key)
         except (ValueError, TypeError):
             raise ResourceException(400, 'bad_'+attr.key, "The %s field must be an integer." % attr.key)
-        if self.unique and build_unique_query(attr.cls, attr.key, value).first():
-            raise ResourceException(400, 'duplicate_'+attr.key, "The %s field is not unique." % attr.key)
+        if self.min is not None and not value >= self.min:
+            raise ResourceException(400, 'bad_'+attr.key, "The %s field must be at least %s." % (attr.key, self.min))
+        if self.max is not None and not value <= self.max:
+            raise ResourceException(400, 'bad_'+attr.key, "The %s field must be less than %s." % (attr.key, self.max))
+        if not self.allow_negative and value < 0:
+            raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot be less than zero." % attr.key)
+        return value
 
 
-class FloatValidator(APIValidator):
+class FloatValidator(FieldValidator):
     """
     Validates decimal numbers
     """
@@ -104,22 +179,22 @@ class FloatValidator(APIValidator):
         self.unique = unique
         self.nullable = nullable
 
-    def validate(self, value, attr):
+    def check(self, value, attr):
+        """ Validates `value` and returns it as a float (or None) """
         if self.nullable and value is None:
-            return
+            return None
         try:
             value = float(value)
-            if self.min is not None and float(value) < self.min:
-                raise ResourceException(400, 'bad_'+attr.key, "The %s field must be at least %s." % (attr.key, self.min))
-            if self.max is not None and float(value) > self.max:
-                raise ResourceException(400, 'bad_'+attr.key, "The %s field must be less than %s." % (attr.key, self.max))
         except (ValueError, TypeError):
             raise ResourceException(400, 'bad_'+attr.key, "The %s field must be a decimal number." % attr.key)
-        if self.unique and build_unique_query(attr.cls, attr.key, value).first():
-            raise ResourceException(400, 'duplicate_'+attr.key, "The %s field is not unique." % attr.key)
+        if self.min is not None and value < self.min:
+            raise ResourceException(400, 'bad_'+attr.key, "The %s field must be at least %s." % (attr.key, self.min))
+        if self.max is not None and value > self.max:
+            raise ResourceException(400, 'bad_'+attr.key, "The %s field must be less than %s." % (attr.key, self.max))
+        return value
 
 
-class StringValidator(APIValidator):
+class StringValidator(FieldValidator):
     """
     Validates strings of text, with certain constraints
     """
@@ -133,9 +208,10 @@ class StringValidator(APIValidator):
         self.unique = unique
         self.nullable = nullable
 
-    def validate(self, value, attr):
+    def check(self, value, attr):
+        """ Validates `value` and returns it as a stripped string (or None) """
         if self.nullable and value is None:
-            return
+            return None
         elif value is None:
             raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot be null." % attr.key)
 
@@ -144,18 +220,17 @@ class StringValidator(APIValidator):
             raise ResourceException(400, 'bad_'+attr.key, "The %s field must be at least %s characters long." % (attr.key, self.min_len))
         if self.max_len and len(value) > self.max_len:
             raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot exceed %s characters." % (attr.key, self.max_len))
-        if not self.allow_digits and re.compile('\d').search(value):
+        if not self.allow_digits and _digit_re.search(value):
             raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot contain digits." % attr.key)
-        if not self.allow_special_chars and not re.match('^[\w-]+$', value):
+        if not self.allow_special_chars and not _word_chars_re.match(value):
             raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot contain special characters." % attr.key)
         if self.valid_values and value not in self.valid_values:
             raise ResourceException(400, 'bad_'+attr.key, "The %s field is invalid; %r is not a valid value. Accepted values: %s" \
                                                                 % (attr.key, value, ', '.join([ '%r' % val for val in self.valid_values ])))
-        if self.unique and build_unique_query(attr.cls, attr.key, value).first():
-            raise ResourceException(400, 'duplicate_'+attr.key, "The %s field is not unique." % attr.key)
+        return value
 
 
-class DateValidator(APIValidator):
+class DateValidator(FieldValidator):
     """
     Validates dates in YYYY-mm-dd form (%Y-%m-%d strftime form)
     """
@@ -165,23 +240,25 @@ class DateValidator(APIValidator):
         self.require_past = require_past
         self.nullable = nullable
 
-    def validate(self, value, attr):
+    def check(self, value, attr):
+        """ Validates `value` and returns it as a datetime (or None) """
         if self.nullable and value is None:
-            return
+            return None
         elif value is None:
             raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot be null." % attr.key)
 
         try:
-            datetime.strptime(value, '%Y-%m-%d')
-        except ValueError:
+            parsed = datetime.strptime(value, '%Y-%m-%d')
+        except (ValueError, TypeError):
             raise ResourceException(400, 'bad_'+attr.key, 'The date %r is invalid for the %s field. Dates must be in YYYY-mm-dd form.' % (value, attr.key))
-        if self.require_future and datetime.strptime(value, '%Y-%m-%d') < datetime.utcnow():
+        if self.require_future and parsed < datetime.utcnow():
             raise ResourceException(400, 'bad_'+attr.key, 'The %s field must be a future date, but a past date was submitted.' % attr.key)
-        if self.require_past and datetime.strptime(value, '%Y-%m-%d') > datetime.utcnow():
+        if self.require_past and parsed > datetime.utcnow():
             raise ResourceException(400, 'bad_'+attr.key, 'The %s field must be a past date, but a future date was submitted.' % attr.key)
+        return parsed
 
 
-class DatetimeValidator(APIValidator):
+class DatetimeValidator(FieldValidator):
     """
     Validates datetimes in YYYY-mm-ddTHH:MM:SSZ form (%Y-%m-%dT%H:%M:%SZ strftime form)
     """
@@ -191,20 +268,22 @@ class DatetimeValidator(APIValidator):
         self.require_past = require_past
         self.nullable = nullable
 
-    def validate(self, value, attr):
+    def check(self, value, attr):
+        """ Validates `value` and returns it as a datetime (or None) """
         if self.nullable and value is None:
-            return
+            return None
         elif value is None:
             raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot be null." % attr.key)
 
         try:
-            datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
-        except ValueError:
+            parsed = datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+        except (ValueError, TypeError):
             raise ResourceException(400, 'bad_'+attr.key, 'The date %s is invalid for the %s field. Dates must be in YYYY-mm-ddTHH:MM:SSZ (%%Y-%%m-%%dT%%H:%%M:%%SZ) form.' % (value, attr.key))
-        if self.require_future and datetime.strptime(value, '%Y-%m-%d') < datetime.utcnow():
+        if self.require_future and parsed < datetime.utcnow():
             raise ResourceException(400, 'bad_'+attr.key, 'The %s field must be a future date, but a past date was submitted.' % attr.key)
-        if self.require_past and datetime.strptime(value, '%Y-%m-%d') > datetime.utcnow():
+        if self.require_past and parsed > datetime.utcnow():
             raise ResourceException(400, 'bad_'+attr.key, 'The %s field must be a past date, but a future date was submitted.' % attr.key)
+        return parsed
 
 
 class EmailValidator(StringValidator):
@@ -213,21 +292,18 @@ class EmailValidator(StringValidator):
     """
 
     def __init__(self, unique=False, nullable=False):
-        self.unique = unique
-        self.nullable = nullable
-        super(EmailValidator, self).__init__(min_len=5, max_len=255)
+        super(EmailValidator, self).__init__(min_len=5, max_len=255, unique=unique, nullable=nullable)
 
-    def validate(self, value, attr):
-        if self.nullable and value is None:
-            return
-        elif value is None:
-            raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot be null." % attr.key)
-
-        super(EmailValidator, self).validate(value, attr)
+    def check(self, value, attr):
+        value = super(EmailValidator, self).check(value, attr)
+        if value is None:
+            return None
+        # validate_email is imported here since it's slow to import (it pulls in
+        # pyDNS) and most processes never validate an email address
+        from validate_email import validate_email
         if not validate_email(value):
             raise ResourceException(400, 'bad_'+attr.key, "The email address is not valid.")
-        if self.unique and build_unique_query(attr.cls, attr.key, value).first():
-            raise ResourceException(400, 'duplicate_'+attr.key, "The %s field is not unique." % attr.key)
+        return value
 
 
 class ZipCodeValidator(StringValidator):
@@ -236,17 +312,14 @@ class ZipCodeValidator(StringValidator):
     """
 
     def __init__(self, unique=False, nullable=False):
-        self.unique = unique
-        nullable = nullable
-        super(ZipCodeValidator, self).__init__(min_len=5, max_len=5)
+        super(ZipCodeValidator, self).__init__(min_len=5, max_len=5, unique=unique, nullable=nullable)
 
-    def validate(self, value, attr):
+    def check(self, value, attr):
         if self.nullable and value is None:
-            return
+            return None
         elif value is None:
             raise ResourceException(400, 'bad_'+attr.key, "The %s field cannot be null." % attr.key)
 
-        if not re.match(r'^\d{5}$', value):
+        if not _zip_code_re.match(value):
             raise ResourceException(400, 'bad_'+attr.key, 'The zip code "%s" is not valid.' % value)
-        if self.unique and build_unique_query(attr.cls, attr.key, value).first():
-            raise ResourceException(400, 'duplicate_'+attr.key, "The %s field is not unique." % attr.key)
+        return value
@@ -30,12 +30,20 @@ class CollectionViews(object):
         # Make sure the caller is authorized to list
         self.request.context.check_authorization(self.request,
             self.request.context.resource.get_api_config('list', 'auth'))
-        # OK, return the stuff
+        # OK, return the stuff, either as a list of objects or (if the caller
+        # asked for ?format=columns) as a list of values per attribute
+        response_format = self.request.GET.get('format', 'rows')
+        if response_format == 'columns':
+            return self.request.context.columns(self.request)
+        elif response_format != 'rows':
+            raise ResourceException(status_code=400, error_id='bad_format',
+                                    message='The format %r is not supported. Supported ' % response_format + \
+                                            'formats are: rows, columns')
         return self.request.context
 
     def post(self):
         """ Create a new instance of the given resource """
-        DBSession = sqla_session()
+        DBSession = sqla_session(self.request)
         # Make sure the caller is authorized to create
         self.request.context.check_authorization(self.request,
             self.request.context.resource.get_api_config('create', 'auth'))
@@ -125,6 +133,7 @@ def resource_exception_view(exc, request):
                 403:"403 Forbidden",
                 404:"404 Not Found",
                 422:"422 Unprocessable Entity",
+                429:"429 Too Many Requests",
                 500:"500 Internal Server Error"}
 
     request.response.status_int = exc.status_code
@@ -0,0 +1,96 @@
+"""
+Contains hot reloading of the API config. The config can be reloaded when
+api.yaml changes on disk (checked by a background thread) and/or when the
+process receives a signal. A reload parses the whole file before replacing the
+current config (see config.load_api_config), and a file that fails to parse is
+logged and leaves the current config in place.
+
+Reloading re-reads api.yaml only: resource modules that have already been
+imported are not reloaded, so changes to Python code still need a restart.
+"""
+
+import os
+import signal
+import threading
+
+from config import latest_config, load_api_config
+
+import logging
+log = logging.getLogger(__name__)
+
+# Seconds between checks for changes to api.yaml
+WATCH_INTERVAL = 2
+
+_reload_lock = threading.Lock()
+
+def reload_api_config():
+    """
+    Reloads the current API config from its file. Returns True if the config
+    was reloaded and False if it could not be (the error is logged).
+    """
+    with _reload_lock:
+        path = latest_config().path
+        if not path:
+            log.warning('Cannot reload the API config: no API config has been loaded')
+            return False
+        try:
+            load_api_config(path, snapshot_path=latest_config().snapshot_path)
+        except Exception:
+            log.exception('Could not reload the API config from %s; keeping the '
+                          'current config', path)
+            return False
+        log.info('Reloaded the API config from %s', path)
+        return True
+
+
+class ConfigWatcher(threading.Thread):
+    """ Reloads the API config whenever its file's modification time changes """
+
+    def __init__(self, interval=WATCH_INTERVAL):
+        super(ConfigWatcher, self).__init__(name='sofa-config-watcher')
+        self.daemon = True
+        self.interval = interval
+        self._stopped = threading.Event()
+        # Modification time of a file that failed to load, so that a broken
+        # file is only reported once
+        self._failed_mtime = None
+
+    def check(self):
+        config = latest_config()
+        try:
+            mtime = os.path.getmtime(config.path)
+        except OSError:
+            return
+        if mtime != config.mtime and mtime != self._failed_mtime:
+            if not reload_api_config():
+                self._failed_mtime = mtime
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        self._stopped.set()
+
+_watcher = None
+
+def watch_api_config(interval=WATCH_INTERVAL):
+    """ Starts a background thread that reloads the API config when its file changes """
+    global _watcher
+    if _watcher is None or not _watcher.is_alive():
+        _watcher = ConfigWatcher(interval)
+        _watcher.start()
+    return _watcher
+
+def install_reload_signal_handler(signum=signal.SIGHUP):
+    """
+    Reloads the API config when the process receives `signum`. This must be
+    called from the main thread.
+    """
+    def handle_signal(signum, frame):
+        # Signal handlers interrupt the main thread wherever it is (possibly
+        # while it holds _reload_lock), so do the work on another thread
+        thread = threading.Thread(target=reload_api_config, name='sofa-config-reload')
+        thread.daemon = True
+        thread.start()
+    signal.signal(signum, handle_signal)